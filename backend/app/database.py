@@ -1,18 +1,139 @@
-from sqlalchemy import create_engine
+"""
+Подключение к БД и сессии
+- Пул соединений настраивается через окружение (DB_POOL_*): размер,
+  переполнение, ожидание, pre-ping и recycle (Railway закрывает
+  простаивающие соединения - pre-ping/recycle не дают получить мёртвое)
+- PostgreSQL: statement_timeout на каждое соединение (DB_STATEMENT_TIMEOUT_MS)
+- DATABASE_READ_URL - реплика для чтения (поиск, списки в админке):
+  get_read_db / read_session_scope; без реплики - основная БД
+- SQLite (локально): WAL и synchronous=NORMAL, busy_timeout вместо
+  мгновенной ошибки "database is locked"
+- Метрики пула: ожидание соединения, загрузка, таймауты (get_pool_stats)
+"""
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from contextlib import contextmanager
+from typing import Dict, Optional
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+SQLITE_WAL = os.getenv("SQLITE_WAL", "true").lower() == "true"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool, который считает время ожидания свободного соединения
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0
+        }
+        self.wait_lock = threading.Lock()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            with self.wait_lock:
+                self.wait_stats["timeouts"] += 1
+            raise
+        wait_ms = (time.perf_counter() - started) * 1000
+        with self.wait_lock:
+            self.wait_stats["checkouts"] += 1
+            self.wait_stats["wait_ms_total"] += wait_ms
+            self.wait_stats["wait_ms_max"] = max(self.wait_stats["wait_ms_max"], wait_ms)
+        return connection
+
+    def recreate(self):
+        # Новый пул (dispose/fork) продолжает метрики старого
+        pool = super().recreate()
+        pool.wait_stats = self.wait_stats
+        pool.wait_lock = self.wait_lock
+        return pool
+
+
+def _is_sqlite(url: Optional[str]) -> bool:
+    return bool(url) and url.startswith("sqlite")
+
+
+def _is_sqlite_memory(url: str) -> bool:
+    return url in ("sqlite://", "sqlite:///:memory:") or "mode=memory" in url
+
+
+def _enable_sqlite_pragmas(engine) -> None:
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        if SQLITE_WAL:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+
+def make_engine(url: str):
+    """
+    Engine с настройками пула из окружения
+    """
+    if _is_sqlite(url):
+        if _is_sqlite_memory(url):
+            # In-memory БД живёт в одном соединении: пул SQLAlchemy по умолчанию
+            return create_engine(url, connect_args={"check_same_thread": False})
+        engine = create_engine(
+            url,
+            connect_args={"check_same_thread": False},
+            poolclass=TimedQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT
+        )
+        _enable_sqlite_pragmas(engine)
+        return engine
+
+    connect_args = {}
+    if url and url.startswith("postgres") and DB_STATEMENT_TIMEOUT_MS > 0:
+        connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+
+    return create_engine(
+        url,
+        connect_args=connect_args,
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING
+    )
+
+
+engine = make_engine(DATABASE_URL)
+read_engine = make_engine(DATABASE_READ_URL) if DATABASE_READ_URL else engine
 
-if DATABASE_URL and DATABASE_URL.startswith("sqlite"):
-    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-else:
-    engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
 
 Base = declarative_base()
 
@@ -23,3 +144,82 @@ def get_db():
     finally:
         db.close()
 
+
+def get_read_db():
+    """
+    Сессия для запросов только на чтение (реплика, если задан DATABASE_READ_URL)
+    """
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@contextmanager
+def session_scope():
+    """
+    Отдельная сессия для фоновой или параллельной работы вне запроса
+    """
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@contextmanager
+def read_session_scope():
+    """
+    session_scope для чтения (реплика, если задан DATABASE_READ_URL)
+    """
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def _pool_stats(engine) -> Dict:
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__}
+    if not isinstance(pool, QueuePool):
+        return stats
+
+    capacity = pool.size() + max(0, pool._max_overflow)
+    checked_out = pool.checkedout()
+    stats.update({
+        "size": pool.size(),
+        "max_overflow": pool._max_overflow,
+        "checked_out": checked_out,
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "utilization": round(checked_out / capacity, 4) if capacity else 0.0
+    })
+    if isinstance(pool, TimedQueuePool):
+        with pool.wait_lock:
+            wait = dict(pool.wait_stats)
+        checkouts = wait["checkouts"]
+        stats.update({
+            **wait,
+            "wait_ms_total": round(wait["wait_ms_total"], 2),
+            "wait_ms_max": round(wait["wait_ms_max"], 2),
+            "avg_wait_ms": round(wait["wait_ms_total"] / checkouts, 3) if checkouts else 0.0
+        })
+    return stats
+
+
+def get_pool_stats() -> Dict:
+    """
+    Состояние пулов соединений (основная БД и реплика для чтения)
+    """
+    stats = {
+        "primary": _pool_stats(engine),
+        "pre_ping": DB_POOL_PRE_PING,
+        "recycle": DB_POOL_RECYCLE,
+        "statement_timeout_ms": DB_STATEMENT_TIMEOUT_MS,
+        "read_replica": read_engine is not engine
+    }
+    if read_engine is not engine:
+        stats["replica"] = _pool_stats(read_engine)
+    return stats
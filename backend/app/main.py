@@ -1,7 +1,17 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from app.database import engine, Base
-from app.routers import qa, admin, slack
+from app.database import engine, Base, SessionLocal, get_pool_stats
+from app.routers import qa, admin, slack, jobs
+from app.services.search_index_service import build_search_index
+from app.services.executor_service import shutdown_executor
+from app.services.cache_service import get_cache_stats, start_invalidation_listener, stop_invalidation_listener
+from app.services.semantic_cache_service import get_semantic_cache
+from app.services.lemmatizer_service import get_lemmatizer
+from app.services.synonym_service import get_synonym_matcher
+from app.services.job_queue_service import start_job_workers, stop_job_workers
+from app.services.response_parser_service import get_parser_stats
+from app.services.context_packing_service import get_context_stats
+from app.services.question_log_service import start_question_log, stop_question_log, get_question_log_stats
 import os
 import logging
 from dotenv import load_dotenv
@@ -35,6 +45,28 @@ app.add_middleware(
 app.include_router(qa.router)
 app.include_router(admin.router)
 app.include_router(slack.router)
+app.include_router(jobs.router)
+
+@app.on_event("startup")
+async def startup():
+    start_invalidation_listener()
+    start_question_log()
+    get_synonym_matcher()
+    db = SessionLocal()
+    try:
+        build_search_index(db)
+    except Exception as e:
+        logger.error(f"Не удалось построить поисковый индекс: {e}. Используется ILIKE поиск")
+    finally:
+        db.close()
+    start_job_workers()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await stop_job_workers()
+    stop_question_log()
+    stop_invalidation_listener()
+    shutdown_executor()
 
 @app.get("/")
 async def root():
@@ -45,9 +77,32 @@ async def health():
     return {"status": "ok"}
 
 @app.get("/debug/tables")
-async def debug_tables():
+def debug_tables():
     from sqlalchemy import inspect
     inspector = inspect(engine)
     tables = inspector.get_table_names()
     return {"tables": tables}
 
+@app.get("/debug/lemmatizer")
+def debug_lemmatizer():
+    return get_lemmatizer().get_stats()
+
+@app.get("/debug/cache")
+def debug_cache():
+    return {**get_cache_stats(), "semantic": get_semantic_cache().get_stats()}
+
+@app.get("/debug/parser")
+def debug_parser():
+    return get_parser_stats()
+
+@app.get("/debug/context")
+def debug_context():
+    return get_context_stats()
+
+@app.get("/debug/question-log")
+def debug_question_log():
+    return get_question_log_stats()
+
+@app.get("/debug/db-pool")
+def debug_db_pool():
+    return get_pool_stats()
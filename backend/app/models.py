@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Enum
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Enum, Index, Float
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 import enum
@@ -14,6 +14,10 @@ class QAPairStatus(enum.Enum):
 
 class QAPair(Base):
     __tablename__ = "qa_pairs"
+    __table_args__ = (
+        # Списки по статусу, новые сверху (pending, unanswered, /api/qa)
+        Index("ix_qa_pairs_status_created_at", "status", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     question = Column(String, nullable=False)
@@ -23,6 +27,8 @@ class QAPair(Base):
     status = Column(Enum(QAPairStatus), default=QAPairStatus.pending, nullable=False)
     submitted_by = Column(String, nullable=True)
     slack_user = Column(String, nullable=True)
+    # event_id сообщения Slack: повторный запрос /api/slack/ask не создаёт второй тикет
+    slack_event_id = Column(String, nullable=True, unique=True, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     approved_at = Column(DateTime(timezone=True), nullable=True)
 
@@ -33,8 +39,10 @@ class Keyword(Base):
     __tablename__ = "keywords"
 
     id = Column(Integer, primary_key=True, index=True)
-    qa_pair_id = Column(Integer, ForeignKey("qa_pairs.id"), nullable=False)
+    qa_pair_id = Column(Integer, ForeignKey("qa_pairs.id"), nullable=False, index=True)
     keyword = Column(String, nullable=False)
+    # Ключевое слово в нормальной форме (леммы через пробел, см. keyword_lemma)
+    lemma = Column(String, nullable=True, index=True)
 
     qa_pair = relationship("QAPair", back_populates="keywords")
 
@@ -46,7 +54,11 @@ class Question(Base):
     text = Column(String, nullable=False)
     source = Column(String, nullable=True)
     external_id = Column(String, nullable=True)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Результат поиска агента: уверенность, id QA пар-источников и время этапов (JSON)
+    confidence = Column(Float, nullable=True)
+    sources = Column(Text, nullable=True)
+    timings = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
 
     answers = relationship("Answer", back_populates="question", cascade="all, delete-orphan")
 
@@ -62,3 +74,30 @@ class Answer(Base):
 
     question = relationship("Question", back_populates="answers")
 
+
+
+class JobStatus(enum.Enum):
+    pending = "pending"
+    running = "running"
+    done = "done"
+    dead = "dead"
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+    __table_args__ = (
+        Index("ix_jobs_status_run_after", "status", "run_after"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)
+    payload = Column(Text, nullable=False, default="{}")
+    status = Column(Enum(JobStatus), default=JobStatus.pending, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    max_attempts = Column(Integer, default=5, nullable=False)
+    run_after = Column(DateTime(timezone=True), nullable=False)
+    locked_by = Column(String, nullable=True)
+    locked_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
@@ -3,16 +3,18 @@ from sqlalchemy.orm import Session
 from datetime import datetime
 from typing import List, Optional
 
-from app.database import get_db
+from app.database import get_db, get_read_db
 from app.models import QAPair, QAPairStatus, Question, Keyword
 from app.schemas import QAPairResponse, QAPairPendingResponse, QuestionLogResponse, QAPairUpdate
 from app.auth import verify_admin_key
+from app.services.search_index_service import index_qa_pair, remove_qa_pair
+from app.services.cache_service import notify_kb_changed, invalidate_qa_pairs
 
 router = APIRouter(prefix="/api", tags=["admin"])
 
 
 @router.get("/pending", response_model=List[QAPairPendingResponse])
-async def get_pending(db: Session = Depends(get_db)):
+def get_pending(db: Session = Depends(get_read_db)):
     qa_pairs = db.query(QAPair).filter(
         QAPair.status == QAPairStatus.pending
     ).order_by(QAPair.created_at.desc()).all()
@@ -21,7 +23,7 @@ async def get_pending(db: Session = Depends(get_db)):
 
 
 @router.get("/qa/{qa_id}", response_model=QAPairResponse)
-async def get_qa(qa_id: int, db: Session = Depends(get_db)):
+def get_qa(qa_id: int, db: Session = Depends(get_db)):
     qa_pair = db.query(QAPair).filter(QAPair.id == qa_id).first()
     if not qa_pair:
         raise HTTPException(status_code=404, detail="Q&A не найден")
@@ -29,7 +31,7 @@ async def get_qa(qa_id: int, db: Session = Depends(get_db)):
 
 
 @router.post("/approve/{qa_id}", response_model=QAPairResponse)
-async def approve_qa(
+def approve_qa(
     qa_id: int,
     db: Session = Depends(get_db),
     api_key: str = Depends(verify_admin_key)
@@ -46,12 +48,14 @@ async def approve_qa(
 
     db.commit()
     db.refresh(qa_pair)
+    index_qa_pair(qa_pair)
+    notify_kb_changed([qa_pair.id])
 
     return qa_pair
 
 
 @router.post("/reject/{qa_id}", response_model=QAPairResponse)
-async def reject_qa(
+def reject_qa(
     qa_id: int,
     db: Session = Depends(get_db),
     api_key: str = Depends(verify_admin_key)
@@ -72,16 +76,16 @@ async def reject_qa(
 
 
 @router.get("/log/questions", response_model=List[QuestionLogResponse])
-async def get_recent_questions(limit: int = 50, db: Session = Depends(get_db)):
+def get_recent_questions(limit: int = 50, db: Session = Depends(get_read_db)):
     questions = db.query(Question).order_by(Question.created_at.desc()).limit(limit).all()
     return questions
 
 
 @router.get("/qa", response_model=List[QAPairResponse])
-async def get_all_qa(
+def get_all_qa(
     status: Optional[str] = None,
     limit: int = 100,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     query = db.query(QAPair)
     
@@ -97,7 +101,7 @@ async def get_all_qa(
 
 
 @router.put("/qa/{qa_id}", response_model=QAPairResponse)
-async def update_qa(
+def update_qa(
     qa_id: int,
     data: QAPairUpdate,
     db: Session = Depends(get_db),
@@ -125,11 +129,13 @@ async def update_qa(
     
     db.commit()
     db.refresh(qa_pair)
+    index_qa_pair(qa_pair)
+    invalidate_qa_pairs([qa_pair.id])
     return qa_pair
 
 
 @router.delete("/qa/{qa_id}")
-async def delete_qa(
+def delete_qa(
     qa_id: int,
     db: Session = Depends(get_db),
     api_key: str = Depends(verify_admin_key)
@@ -140,6 +146,8 @@ async def delete_qa(
     
     db.delete(qa_pair)
     db.commit()
+    remove_qa_pair(qa_id)
+    invalidate_qa_pairs([qa_id])
     return {"status": "deleted", "id": qa_id}
 
 
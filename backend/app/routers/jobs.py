@@ -0,0 +1,56 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from typing import List, Optional
+
+from app.database import get_db
+from app.models import Job, JobStatus
+from app.schemas import JobResponse
+from app.auth import verify_admin_key
+from app.services.job_queue_service import get_job_stats, retry_dead_job
+
+router = APIRouter(prefix="/api/jobs", tags=["jobs"])
+
+
+@router.get("", response_model=List[JobResponse])
+def list_jobs(
+    status: Optional[str] = None,
+    kind: Optional[str] = None,
+    limit: int = 100,
+    db: Session = Depends(get_db)
+):
+    query = db.query(Job)
+
+    if status:
+        try:
+            query = query.filter(Job.status == JobStatus(status))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Неверный статус")
+    if kind:
+        query = query.filter(Job.kind == kind)
+
+    return query.order_by(Job.id.desc()).limit(limit).all()
+
+
+@router.get("/stats")
+def jobs_stats(db: Session = Depends(get_db)):
+    return get_job_stats(db)
+
+
+@router.get("/{job_id}", response_model=JobResponse)
+def get_job(job_id: int, db: Session = Depends(get_db)):
+    job = db.get(Job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return job
+
+
+@router.post("/{job_id}/retry", response_model=JobResponse)
+def retry_job(
+    job_id: int,
+    db: Session = Depends(get_db),
+    api_key: str = Depends(verify_admin_key)
+):
+    job = retry_dead_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=400, detail="Повторить можно только задачу в статусе dead")
+    return job
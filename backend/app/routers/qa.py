@@ -1,142 +1,133 @@
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, UploadFile, File, HTTPException
 from sqlalchemy.orm import Session
 from typing import List
-import pandas as pd
-import io
+import os
 
-from app.database import get_db
-from app.models import QAPair, Keyword, QAPairStatus
+from app.database import get_db, get_read_db
+from app.models import QAPair, QAPairStatus
 from app.schemas import QAPairCreate, QAPairResponse, SearchRequest, SearchResponse, QAPairPendingResponse
-from app.services.gemini_service import process_qa_pair, process_voice_to_text
+from app.services.voice_service import VOICE_MAX_UPLOAD_BYTES, VoiceFileError, detect_audio_type, transcribe_file_async
+from app.services.gemini_service import VoiceTranscriptionError
+from app.services.executor_service import run_blocking
+from app.services.enrichment_service import enqueue_enrichment
+from app.services.job_queue_service import notify_job_workers
 from app.services.search_service import search
+from app.services.import_service import (
+    SUPPORTED_EXTENSIONS, ImportFileError, create_import_job, get_import_job, list_import_jobs,
+    run_import_job, validate_import_file
+)
+from app.services.upload_service import UploadTooLarge, spool_upload
 
 router = APIRouter(prefix="/api", tags=["qa"])
 
 @router.post("/add-qa", response_model=QAPairResponse)
-async def add_qa(qa_data: QAPairCreate, db: Session = Depends(get_db)):
-    processed = process_qa_pair(qa_data.question, qa_data.answer)
-    
+def add_qa(qa_data: QAPairCreate, db: Session = Depends(get_db)):
     qa_pair = QAPair(
         question=qa_data.question,
         answer=qa_data.answer,
-        question_processed=processed["question_processed"],
-        answer_processed=processed["answer_processed"],
         submitted_by=qa_data.submitted_by,
         status=QAPairStatus.pending
     )
     
     db.add(qa_pair)
+    db.flush()
+    enqueue_enrichment(db, qa_pair)
     db.commit()
     db.refresh(qa_pair)
-    
-    for keyword_text in processed["keywords"]:
-        keyword = Keyword(qa_pair_id=qa_pair.id, keyword=keyword_text)
-        db.add(keyword)
-    
-    db.commit()
-    db.refresh(qa_pair)
+    notify_job_workers()
     
     return qa_pair
 
-@router.post("/import-csv")
-async def import_csv(file: UploadFile = File(...), db: Session = Depends(get_db)):
-    if not file.filename.endswith(('.csv', '.xlsx', '.xls')):
+@router.post("/import-csv", status_code=202)
+def import_csv(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+    if not file.filename.endswith(SUPPORTED_EXTENSIONS):
         raise HTTPException(status_code=400, detail="Поддерживаются только CSV и Excel файлы")
+
+    path = spool_upload(file, suffix=os.path.splitext(file.filename)[1])
+    try:
+        validate_import_file(file.filename, path)
+    except ImportFileError as e:
+        os.remove(path)
+        raise HTTPException(status_code=400, detail=str(e))
+
+    job = create_import_job(file.filename)
+    background_tasks.add_task(run_import_job, job, path)
+    return job.to_dict()
+
+@router.get("/import-jobs")
+def import_jobs():
+    return [job.to_dict(include_ids=False) for job in list_import_jobs()]
+
+@router.get("/import-jobs/{job_id}")
+def import_job_status(job_id: str):
+    job = get_import_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Задача импорта не найдена")
+    return job.to_dict()
+
+def _parse_voice_text(text: str):
+    if "ВОПРОС:" in text and "ОТВЕТ:" in text:
+        parts = text.split("ОТВЕТ:")
+        question = parts[0].replace("ВОПРОС:", "").strip()
+        answer = parts[1].strip()
+    else:
+        lines = text.split('\n')
+        question = lines[0] if lines else ""
+        answer = '\n'.join(lines[1:]) if len(lines) > 1 else ""
+    return question, answer
+
+def _save_voice_pair(db: Session, question: str, answer: str) -> QAPairResponse:
+    qa_pair = QAPair(
+        question=question,
+        answer=answer,
+        status=QAPairStatus.pending
+    )
     
-    contents = await file.read()
+    db.add(qa_pair)
+    db.flush()
+    enqueue_enrichment(db, qa_pair)
+    db.commit()
+    db.refresh(qa_pair)
+    notify_job_workers()
     
-    try:
-        if file.filename.endswith('.csv'):
-            df = pd.read_csv(io.BytesIO(contents))
-        else:
-            df = pd.read_excel(io.BytesIO(contents))
-        
-        if 'question' not in df.columns or 'answer' not in df.columns:
-            raise HTTPException(status_code=400, detail="Файл должен содержать колонки 'question' и 'answer'")
-        
-        results = []
-        for _, row in df.iterrows():
-            question = str(row['question']).strip()
-            answer = str(row['answer']).strip()
-            
-            if not question or not answer:
-                continue
-            
-            processed = process_qa_pair(question, answer)
-            
-            qa_pair = QAPair(
-                question=question,
-                answer=answer,
-                question_processed=processed["question_processed"],
-                answer_processed=processed["answer_processed"],
-                submitted_by=row.get('submitted_by', None),
-                status=QAPairStatus.pending
-            )
-            
-            db.add(qa_pair)
-            db.commit()
-            db.refresh(qa_pair)
-            
-            for keyword_text in processed["keywords"]:
-                keyword = Keyword(qa_pair_id=qa_pair.id, keyword=keyword_text)
-                db.add(keyword)
-            
-            db.commit()
-            results.append(qa_pair.id)
-        
-        return {"imported": len(results), "ids": results}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Ошибка обработки файла: {str(e)}")
+    return QAPairResponse.from_orm(qa_pair)
 
 @router.post("/process-voice")
 async def process_voice(file: UploadFile = File(...), db: Session = Depends(get_db)):
-    if not file.content_type or not file.content_type.startswith('audio/'):
-        raise HTTPException(status_code=400, detail="Поддерживаются только аудио файлы")
-    
-    audio_data = await file.read()
+    try:
+        path = await run_blocking(spool_upload, file, "", VOICE_MAX_UPLOAD_BYTES)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     
     try:
-        text = process_voice_to_text(audio_data)
+        mime_type = await run_blocking(detect_audio_type, path)
+        if mime_type is None and file.content_type and file.content_type.startswith('audio/') and os.path.getsize(path):
+            mime_type = file.content_type
+        if mime_type is None:
+            raise HTTPException(status_code=400, detail="Поддерживаются только аудио файлы")
         
-        if "ВОПРОС:" in text and "ОТВЕТ:" in text:
-            parts = text.split("ОТВЕТ:")
-            question = parts[0].replace("ВОПРОС:", "").strip()
-            answer = parts[1].strip()
-        else:
-            lines = text.split('\n')
-            question = lines[0] if lines else ""
-            answer = '\n'.join(lines[1:]) if len(lines) > 1 else ""
+        try:
+            text = await transcribe_file_async(path, mime_type)
+        except VoiceFileError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except VoiceTranscriptionError as e:
+            # Распознавание недоступно: пара не сохраняется
+            raise HTTPException(status_code=502, detail=str(e))
         
+        question, answer = _parse_voice_text(text)
         if not question or not answer:
             return {"text": text, "question": None, "answer": None}
         
-        processed = process_qa_pair(question, answer)
-        
-        qa_pair = QAPair(
-            question=question,
-            answer=answer,
-            question_processed=processed["question_processed"],
-            answer_processed=processed["answer_processed"],
-            status=QAPairStatus.pending
-        )
-        
-        db.add(qa_pair)
-        db.commit()
-        db.refresh(qa_pair)
-        
-        for keyword_text in processed["keywords"]:
-            keyword = Keyword(qa_pair_id=qa_pair.id, keyword=keyword_text)
-            db.add(keyword)
-        
-        db.commit()
-        db.refresh(qa_pair)
-        
-        return QAPairResponse.from_orm(qa_pair)
+        return await run_blocking(_save_voice_pair, db, question, answer)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Ошибка обработки голоса: {str(e)}")
+    finally:
+        os.remove(path)
 
 @router.post("/search", response_model=SearchResponse)
-async def search_qa(search_request: SearchRequest, db: Session = Depends(get_db)):
+def search_qa(search_request: SearchRequest, db: Session = Depends(get_read_db)):
     results = search(db, search_request.query)
     return SearchResponse(qa_pairs=results)
 
@@ -1,21 +1,35 @@
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from typing import List
+from typing import Dict, List
+import asyncio
 import logging
 
-from app.database import get_db
-from app.models import QAPair, QAPairStatus, Question, Answer
-from app.schemas import QAPairUnansweredResponse, SlackQuestionRequest, AddAnswerRequest, QAPairResponse
+from app.database import get_db, get_read_db
+from app.models import QAPair, QAPairStatus
+from app.schemas import (
+    QAPairUnansweredResponse, SlackQuestionRequest, SlackAskRequest, SlackAskBatchRequest,
+    AddAnswerRequest, QAPairResponse
+)
 from app.services.search_service import search
-from app.services.ai_agent_service import process_question
+from app.services.ai_agent_service import process_question_async
+from app.services.search_index_service import index_qa_pair
+from app.services.cache_service import notify_kb_changed
+from app.services.executor_service import run_blocking
+from app.services.enrichment_service import enqueue_enrichment
+from app.services.job_queue_service import notify_job_workers
+from app.services.question_log_service import log_question
 from app.auth import verify_slack_key, verify_admin_key
 
 router = APIRouter(prefix="/api/slack", tags=["slack"])
 logger = logging.getLogger(__name__)
 
+ASK_CONFIDENCE_THRESHOLD = 0.8
+ASK_BATCH_MAX = 20
+
 
 @router.post("/question", response_model=dict)
-async def save_slack_question(
+def save_slack_question(
     request: SlackQuestionRequest,
     db: Session = Depends(get_db),
     api_key: str = Depends(verify_slack_key)
@@ -34,20 +48,13 @@ async def save_slack_question(
     db.commit()
     db.refresh(qa_pair)
 
-    question = Question(
-        text=request.question.strip(),
-        source="slack",
-        external_id=str(qa_pair.id)
-    )
-
-    db.add(question)
-    db.commit()
+    log_question(request.question.strip(), external_id=str(qa_pair.id))
 
     return {"id": qa_pair.id, "status": "saved"}
 
 
 @router.get("/unanswered", response_model=List[QAPairUnansweredResponse])
-async def get_unanswered(db: Session = Depends(get_db)):
+def get_unanswered(db: Session = Depends(get_read_db)):
     qa_pairs = db.query(QAPair).filter(
         QAPair.status == QAPairStatus.unanswered
     ).order_by(QAPair.created_at.desc()).all()
@@ -56,7 +63,7 @@ async def get_unanswered(db: Session = Depends(get_db)):
 
 
 @router.post("/qa/{qa_id}/answer", response_model=QAPairResponse)
-async def add_answer_to_question(
+def add_answer_to_question(
     qa_id: int,
     request: AddAnswerRequest,
     db: Session = Depends(get_db),
@@ -72,32 +79,38 @@ async def add_answer_to_question(
     if qa_pair.status != QAPairStatus.unanswered:
         raise HTTPException(status_code=400, detail="К этому вопросу уже есть ответ")
 
-    from app.services.gemini_service import process_qa_pair
     from datetime import datetime
 
-    processed = process_qa_pair(qa_pair.question, request.answer.strip())
-
     qa_pair.answer = request.answer.strip()
-    qa_pair.question_processed = processed["question_processed"]
-    qa_pair.answer_processed = processed["answer_processed"]
     qa_pair.status = QAPairStatus.approved
     qa_pair.approved_at = datetime.utcnow()
-
-    from app.models import Keyword
-    for keyword_text in processed["keywords"]:
-        keyword = Keyword(qa_pair_id=qa_pair.id, keyword=keyword_text)
-        db.add(keyword)
+    enqueue_enrichment(db, qa_pair)
 
     db.commit()
     db.refresh(qa_pair)
+    index_qa_pair(qa_pair)
+    notify_kb_changed([qa_pair.id])
+    notify_job_workers()
 
     return qa_pair
 
 
+def _log_agent_result(question: str, agent_result: Dict, answered: bool, ticket_id: int = None) -> None:
+    log_question(
+        question,
+        external_id=str(ticket_id) if ticket_id is not None else None,
+        answer=agent_result["answer"] if answered else None,
+        answer_source="kb_ai_agent",
+        confidence=agent_result.get("confidence"),
+        sources=agent_result.get("sources", []) if answered else [],
+        timings=agent_result.get("timings")
+    )
+
+
 @router.get("/search", response_model=dict)
 async def search_for_slack(
     query: str,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     api_key: str = Depends(verify_slack_key)
 ):
     if not query or not query.strip():
@@ -108,53 +121,41 @@ async def search_for_slack(
     logger.info(f"Поиск ответа для вопроса: '{query_clean}'")
 
     try:
-        question = Question(
-            text=query_clean,
-            source="slack"
-        )
-
-        db.add(question)
-        db.commit()
-        db.refresh(question)
-        logger.info(f"Вопрос сохранён в БД с ID: {question.id}")
-
         logger.info(f"Вызов process_question для: '{query_clean}'")
-        agent_result = process_question(db, query_clean, confidence_threshold=0.8)
+        agent_result = await process_question_async(db, query_clean, confidence_threshold=0.8)
         
         logger.info(f"Результат process_question: found={agent_result.get('found')}, confidence={agent_result.get('confidence', 0.0)}, call_manager={agent_result.get('call_manager', False)}")
         
         if agent_result.get("reason"):
             logger.info(f"Причина результата: {agent_result.get('reason')}")
+        if agent_result.get("timings"):
+            logger.info(f"Время этапов (мс): {agent_result['timings']}")
 
         if agent_result["found"] and agent_result["confidence"] >= 0.8:
             answer_text = agent_result["answer"]
             logger.info(f"Ответ найден! Confidence: {agent_result['confidence']}, длина ответа: {len(answer_text)} символов")
 
-            answer = Answer(
-                question_id=question.id,
-                text=answer_text,
-                source="kb_ai_agent"
-            )
-
-            db.add(answer)
-            db.commit()
+            _log_agent_result(query_clean, agent_result, answered=True)
 
             return {
                 "found": True,
                 "answer": answer_text,
                 "confidence": agent_result["confidence"],
                 "sources": agent_result["sources"],
-                "call_manager": False
+                "call_manager": False,
+                "timings": agent_result.get("timings")
             }
         else:
             confidence = agent_result.get("confidence", 0.0)
             reason = agent_result.get("reason", "")
             logger.warning(f"Ответ не найден или низкая уверенность. Confidence: {confidence}, Reason: {reason}")
+            _log_agent_result(query_clean, agent_result, answered=False)
             return {
                 "found": False,
                 "call_manager": True,
                 "confidence": confidence,
-                "reason": reason
+                "reason": reason,
+                "timings": agent_result.get("timings")
             }
     except Exception as e:
         logger.error(f"Ошибка при поиске ответа для '{query_clean}': {type(e).__name__}: {e}", exc_info=True)
@@ -165,3 +166,178 @@ async def search_for_slack(
             "reason": f"Ошибка обработки: {str(e)}"
         }
 
+
+
+async def _ask_agent(question: str) -> Dict:
+    try:
+        return await process_question_async(None, question, confidence_threshold=ASK_CONFIDENCE_THRESHOLD)
+    except Exception as e:
+        logger.error(f"Ошибка при поиске ответа для '{question}': {type(e).__name__}: {e}", exc_info=True)
+        return {"found": False, "confidence": 0.0, "reason": f"Ошибка обработки: {str(e)}"}
+
+
+def _is_answered(agent_result: Dict) -> bool:
+    return bool(agent_result.get("found")) and agent_result.get("confidence", 0.0) >= ASK_CONFIDENCE_THRESHOLD
+
+
+def _find_tickets(db: Session, event_ids: List[str]) -> Dict[str, int]:
+    """
+    Уже созданные тикеты по event_id сообщений Slack: event_id -> id QA пары
+    """
+    if not event_ids:
+        return {}
+    rows = db.query(QAPair.slack_event_id, QAPair.id).filter(QAPair.slack_event_id.in_(event_ids)).all()
+    return {event_id: qa_id for event_id, qa_id in rows}
+
+
+def _create_tickets(db: Session, requests: List[SlackAskRequest], retry: bool = True) -> List[int]:
+    """
+    Неотвеченные QA пары (тикеты) для менеджера, один commit
+    Для event_id, по которому тикет уже есть (повтор запроса бота), новый не создаётся
+
+    Returns:
+        id тикетов в порядке requests
+    """
+    existing = _find_tickets(db, [request.event_id for request in requests if request.event_id])
+    by_event: Dict[str, QAPair] = {}
+    tickets = []
+    new_tickets = []
+    for request in requests:
+        if request.event_id and request.event_id in existing:
+            tickets.append(None)
+            continue
+        if request.event_id and request.event_id in by_event:
+            tickets.append(by_event[request.event_id])
+            continue
+        ticket = QAPair(
+            question=request.question.strip(),
+            answer="",
+            status=QAPairStatus.unanswered,
+            slack_user=request.slack_user,
+            slack_event_id=request.event_id
+        )
+        tickets.append(ticket)
+        new_tickets.append(ticket)
+        if request.event_id:
+            by_event[request.event_id] = ticket
+
+    db.add_all(new_tickets)
+    try:
+        db.commit()
+    except IntegrityError as e:
+        db.rollback()
+        # Параллельный повтор того же события успел создать тикет: перечитываем (один раз)
+        if retry and "slack_event_id" in str(e.orig):
+            return _create_tickets(db, requests, retry=False)
+        raise
+
+    return [
+        existing[request.event_id] if ticket is None else ticket.id
+        for request, ticket in zip(requests, tickets)
+    ]
+
+
+async def _record_asks(db: Session, requests: List[SlackAskRequest], agent_results: List[Dict]) -> List[Dict]:
+    """
+    Тикеты для вопросов без уверенного ответа - одной транзакцией; вопросы и
+    ответы пишутся в журнал (question_log_service) без ожидания БД
+    """
+    unanswered = [request for request, agent_result in zip(requests, agent_results) if not _is_answered(agent_result)]
+    ticket_ids = iter(await run_blocking(_create_tickets, db, unanswered) if unanswered else [])
+
+    responses = []
+    for request, agent_result in zip(requests, agent_results):
+        answered = _is_answered(agent_result)
+        ticket_id = None if answered else next(ticket_ids)
+        _log_agent_result(request.question.strip(), agent_result, answered, ticket_id)
+        responses.append({
+            "event_id": request.event_id,
+            "found": answered,
+            "answer": agent_result["answer"] if answered else None,
+            "confidence": agent_result.get("confidence", 0.0),
+            "sources": agent_result.get("sources", []) if answered else [],
+            "call_manager": not answered,
+            "ticket_id": ticket_id,
+            "reason": agent_result.get("reason", ""),
+            "timings": agent_result.get("timings")
+        })
+    return responses
+
+
+def _existing_ticket_response(request: SlackAskRequest, ticket_id: int) -> Dict:
+    return {
+        "event_id": request.event_id,
+        "found": False,
+        "answer": None,
+        "confidence": 0.0,
+        "sources": [],
+        "call_manager": True,
+        "ticket_id": ticket_id,
+        "reason": "Вопрос уже передан менеджеру",
+        "timings": None
+    }
+
+
+async def _ask(db: Session, requests: List[SlackAskRequest]) -> List[Dict]:
+    # Повтор уже обработанного события: тикет есть, агент не запускается
+    event_ids = [request.event_id for request in requests if request.event_id]
+    existing = await run_blocking(_find_tickets, db, event_ids) if event_ids else {}
+    pending = [request for request in requests if request.event_id not in existing]
+
+    agent_results = await asyncio.gather(*[_ask_agent(request.question.strip()) for request in pending])
+    for request, agent_result in zip(pending, agent_results):
+        logger.info(
+            f"Вопрос '{request.question.strip()[:50]}': found={agent_result.get('found')}, "
+            f"confidence={agent_result.get('confidence', 0.0)}"
+        )
+    responses = iter(await _record_asks(db, pending, agent_results) if pending else [])
+
+    return [
+        _existing_ticket_response(request, existing[request.event_id])
+        if request.event_id in existing else next(responses)
+        for request in requests
+    ]
+
+
+@router.post("/ask", response_model=dict)
+async def ask_for_slack(
+    request: SlackAskRequest,
+    db: Session = Depends(get_db),
+    api_key: str = Depends(verify_slack_key)
+):
+    """
+    Поиск ответа и, если ответа нет, тикет менеджеру за один запрос
+    (заменяет пару GET /search + POST /question)
+    event_id делает запрос идемпотентным: повтор возвращает уже созданный тикет
+    """
+    if not request.question or not request.question.strip():
+        raise HTTPException(status_code=400, detail="Вопрос не может быть пустым")
+
+    responses = await _ask(db, [request])
+    return responses[0]
+
+
+@router.post("/ask/batch", response_model=dict)
+async def ask_batch_for_slack(
+    request: SlackAskBatchRequest,
+    db: Session = Depends(get_db),
+    api_key: str = Depends(verify_slack_key)
+):
+    """
+    Пакет вопросов (например, накопленные события Slack): поиск конкурентно,
+    все тикеты - одной транзакцией
+    Пустые вопросы пропускаются, порядок результатов совпадает с порядком запроса
+    """
+    if len(request.questions) > ASK_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"Не больше {ASK_BATCH_MAX} вопросов в пакете")
+
+    valid = [item for item in request.questions if item.question and item.question.strip()]
+    responses = iter(await _ask(db, valid) if valid else [])
+
+    results = []
+    for item in request.questions:
+        if item.question and item.question.strip():
+            results.append(next(responses))
+        else:
+            results.append({"event_id": item.event_id, "found": False, "call_manager": False, "reason": "Пустой вопрос"})
+    return {"results": results}
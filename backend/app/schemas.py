@@ -1,6 +1,8 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
 from datetime import datetime
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
+import enum
+import json
 
 
 class QAPairBase(BaseModel):
@@ -77,6 +79,16 @@ class SlackQuestionRequest(BaseModel):
         min_length = 1
 
 
+class SlackAskRequest(BaseModel):
+    question: str
+    slack_user: str
+    event_id: Optional[str] = None
+
+
+class SlackAskBatchRequest(BaseModel):
+    questions: List[SlackAskRequest]
+
+
 class AddAnswerRequest(BaseModel):
     answer: str
 
@@ -114,3 +126,30 @@ class QAPairUpdate(BaseModel):
     answer_processed: Optional[str] = None
     status: Optional[str] = None
 
+
+
+class JobResponse(BaseModel):
+    id: int
+    kind: str
+    payload: Dict[str, Any] = {}
+    status: str
+    attempts: int
+    max_attempts: int
+    run_after: datetime
+    locked_by: Optional[str] = None
+    last_error: Optional[str] = None
+    created_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    @field_validator("payload", mode="before")
+    @classmethod
+    def parse_payload(cls, value):
+        return json.loads(value) if isinstance(value, str) else value
+
+    @field_validator("status", mode="before")
+    @classmethod
+    def status_value(cls, value):
+        return value.value if isinstance(value, enum.Enum) else value
+
+    class Config:
+        from_attributes = True
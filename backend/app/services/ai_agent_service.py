@@ -1,13 +1,24 @@
 import google.generativeai as genai
+import asyncio
 import os
-import json
+import time
 import logging
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 from sqlalchemy.orm import Session
-from app.services.rate_limiter_service import get_rate_limiter
-from app.services.cache_service import get_cached_result, set_cached_result
-from app.services.search_service import search_semantic, search_by_keywords, search_full_text
+from app.services.rate_limiter_service import get_rate_limiter, estimate_tokens
+from app.services.cache_service import get_cached_result, set_cached_result, get_or_compute_async, CACHE_RESULT_TTL
+from app.services.search_service import (
+    search_semantic_async, search_by_keywords, search_full_text, fulltext_coverage
+)
+from app.services.executor_service import run_blocking
+from app.services.response_parser_service import Field, ResponseParseError, get_response_parser
+from app.services.context_packing_service import (
+    SYNTHESIS_CONTEXT_ANSWER_TOKENS, SYNTHESIS_CONTEXT_TOKEN_BUDGET, PackedContext, pack_context, record_prompt
+)
+from app.services.semantic_cache_service import lookup_answer, store_answer
+from app.services.query_analysis_service import AnalyzedQuery, analyze_query
+from app.database import read_session_scope
 from app.models import QAPair
 
 logger = logging.getLogger(__name__)
@@ -15,17 +26,17 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-rate_limiter = get_rate_limiter(rpm=10)
+rate_limiter = get_rate_limiter()
 
-def analyze_intent(question: str) -> Dict:
-    cache_key = f"intent:{question}"
-    cached = get_cached_result(cache_key)
-    if cached:
-        return cached
+# Быстрые уровни поиска считаются уверенными, если лучшая full-text пара
+# покрывает такую долю ключевых слов запроса (и слов не меньше CHEAP_TIER_MIN_KEYWORDS)
+CHEAP_TIER_CONFIDENT_COVERAGE = float(os.getenv("CHEAP_TIER_CONFIDENT_COVERAGE", "0.8"))
+CHEAP_TIER_MIN_KEYWORDS = int(os.getenv("CHEAP_TIER_MIN_KEYWORDS", "2"))
 
-    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+NO_MATCHES_REASON = "Не найдено релевантных QA пар в базе знаний"
 
-    prompt = f"""Проанализируй вопрос пользователя и извлеки ключевую информацию.
+def _build_intent_prompt(question: str) -> str:
+    return f"""Проанализируй вопрос пользователя и извлеки ключевую информацию.
 
 ВОПРОС: {question}
 
@@ -38,49 +49,82 @@ def analyze_intent(question: str) -> Dict:
 
 Верни только JSON без дополнительного текста."""
 
-    try:
-        def make_request():
-            return model.generate_content(prompt)
+INTENT_PARSER = get_response_parser("intent", Field("object", properties={
+    "intent": Field("string", default=""),
+    "entities": Field("array", items=Field("string"), default=list),
+    "search_queries": Field("array", items=Field("string"), required=True)
+}))
+
+SYNTHESIS_PARSER = get_response_parser("synthesis", Field("object", properties={
+    "found": Field("boolean", default=False),
+    "answer": Field("string", default=""),
+    "confidence": Field("number", default=0.0, minimum=0.0, maximum=1.0),
+    "sources": Field("array", items=Field("integer"), default=list),
+    "reason": Field("string", default="")
+}))
+
+def _default_intent(question: str) -> Dict:
+    return {
+        "intent": question,
+        "entities": [],
+        "search_queries": [question]
+    }
+
+def _parse_intent_response(response_text: str, question: str) -> Dict:
+    result = INTENT_PARSER.parse(response_text)
+    result["search_queries"] = [query for query in result["search_queries"] if query]
+    if not result["search_queries"]:
+        raise ResponseParseError("intent: empty search_queries")
+    result["intent"] = result["intent"] or question
+    return result
 
-        response = rate_limiter.call(make_request)
-        text = response.text.strip()
+async def analyze_intent_async(question: str) -> Dict:
+    """
+    Intent вопроса и поисковые запросы (при ошибке Gemini - сам вопрос)
+    """
+    cache_key = f"intent:{question}"
+    cached = get_cached_result(cache_key)
+    if cached:
+        return cached
 
-        if text.startswith("```json"):
-            text = text.replace("```json", "").replace("```", "").strip()
-        elif text.startswith("```"):
-            text = text.replace("```", "").strip()
+    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    prompt = _build_intent_prompt(question)
 
-        result = json.loads(text)
+    try:
+        response = await rate_limiter.acall(
+            model.generate_content_async, prompt,
+            generation_config=INTENT_PARSER.generation_config, tokens=estimate_tokens(prompt)
+        )
+        result = _parse_intent_response(response.text, question)
         set_cached_result(cache_key, result, ttl=3600)
         return result
 
     except Exception as e:
-        return {
-            "intent": question,
-            "entities": [],
-            "search_queries": [question]
-        }
-
-def synthesize_answer(question: str, qa_pairs: List[QAPair]) -> Dict:
-    if not qa_pairs:
-        logger.warning(f"synthesize_answer вызван без QA пар для вопроса: '{question}'")
-        return {
-            "found": False,
-            "answer": "",
-            "confidence": 0.0,
-            "sources": []
-        }
-    
-    logger.info(f"synthesize_answer для вопроса '{question}' с {len(qa_pairs)} QA парами")
-
-    model = genai.GenerativeModel('gemini-2.0-flash-exp')
-
+        logger.warning(f"Ошибка анализа intent для '{question}', поиск по самому вопросу: {e}")
+        return _default_intent(question)
+
+def _pack_synthesis_context(qa_pairs: List[QAPair]) -> Tuple[PackedContext, List[QAPair]]:
+    """
+    Пары в порядке релевантности в пределах SYNTHESIS_CONTEXT_TOKEN_BUDGET
+
+    Returns:
+        (упакованный контекст, пары, попавшие в промпт - номера sources ссылаются на них)
+    """
+    packed = pack_context(
+        "synthesis",
+        [(qa.id, qa.question, qa.answer) for qa in qa_pairs],
+        SYNTHESIS_CONTEXT_TOKEN_BUDGET,
+        SYNTHESIS_CONTEXT_ANSWER_TOKENS
+    )
+    return packed, [qa_pairs[index] for index in packed.indices]
+
+def _build_synthesis_prompt(question: str, packed: PackedContext) -> str:
     context = "\n\n".join([
-        f"Запись {i+1}:\nВопрос: {qa.question}\nОтвет: {qa.answer}"
-        for i, qa in enumerate(qa_pairs)
+        f"Запись {i+1}:\nВопрос: {entry.question}\nОтвет: {entry.answer}"
+        for i, entry in enumerate(packed.entries)
     ])
 
-    prompt = f"""Ты - финансовый помощник компании. Ответь на вопрос пользователя на основе базы знаний.
+    return f"""Ты - финансовый помощник компании. Ответь на вопрос пользователя на основе базы знаний.
 
 ВОПРОС ПОЛЬЗОВАТЕЛЯ: {question}
 
@@ -123,111 +167,94 @@ def synthesize_answer(question: str, qa_pairs: List[QAPair]) -> Dict:
 
 Верни только JSON."""
 
-    try:
-        def make_request():
-            return model.generate_content(prompt)
-
-        response = rate_limiter.call(make_request)
-        text = response.text.strip()
+def _empty_synthesis() -> Dict:
+    return {
+        "found": False,
+        "answer": "",
+        "confidence": 0.0,
+        "sources": []
+    }
 
-        if text.startswith("```json"):
-            text = text.replace("```json", "").replace("```", "").strip()
-        elif text.startswith("```"):
-            text = text.replace("```", "").strip()
+def _parse_synthesis_response(response_text: str, qa_pairs: List[QAPair]) -> Dict:
+    result = SYNTHESIS_PARSER.parse(response_text)
 
-        result = json.loads(text)
+    source_ids = []
+    for idx in result["sources"]:
+        if 0 < idx <= len(qa_pairs) and qa_pairs[idx - 1].id not in source_ids:
+            source_ids.append(qa_pairs[idx - 1].id)
 
-        source_ids = []
-        for idx in result.get("sources", []):
-            if isinstance(idx, int) and 0 < idx <= len(qa_pairs):
-                source_ids.append(qa_pairs[idx - 1].id)
+    # "found" без текста ответа - не ответ
+    found = result["found"] and bool(result["answer"])
 
-        return {
-            "found": result.get("found", False),
-            "answer": result.get("answer", ""),
-            "confidence": float(result.get("confidence", 0.0)),
-            "sources": source_ids,
-            "reason": result.get("reason", "")
-        }
-
-    except Exception as e:
-        if len(qa_pairs) == 1:
-            return {
-                "found": True,
-                "answer": qa_pairs[0].answer,
-                "confidence": 0.85,
-                "sources": [qa_pairs[0].id],
-                "reason": "fallback to single match"
-            }
+    return {
+        "found": found,
+        "answer": result["answer"] if found else "",
+        "confidence": result["confidence"] if found else 0.0,
+        "sources": source_ids if found else [],
+        "reason": result["reason"]
+    }
 
+def _synthesis_fallback(qa_pairs: List[QAPair], e: Exception) -> Dict:
+    if len(qa_pairs) == 1:
         return {
-            "found": False,
-            "answer": "",
-            "confidence": 0.0,
-            "sources": [],
-            "reason": f"error: {str(e)}"
+            "found": True,
+            "answer": qa_pairs[0].answer,
+            "confidence": 0.85,
+            "sources": [qa_pairs[0].id],
+            "reason": "fallback to single match"
         }
 
-def process_question(db: Session, question: str, confidence_threshold: float = 0.8) -> Dict:
-    cache_key = f"agent:{question}"
-    cached = get_cached_result(cache_key)
-    if cached:
-        logger.info(f"Кэш найден для вопроса: '{question}'")
-        return cached
-
-    logger.info(f"Анализ intent для вопроса: '{question}'")
-    intent_data = analyze_intent(question)
-    logger.info(f"Intent результат: {intent_data}")
+    return {
+        "found": False,
+        "answer": "",
+        "confidence": 0.0,
+        "sources": [],
+        "reason": f"error: {str(e)}"
+    }
 
-    search_queries = intent_data.get("search_queries", [question])
-    logger.info(f"Поисковые запросы: {search_queries}")
-    
-    all_results = []
-    seen_ids = set()
+async def synthesize_answer_async(question: str, qa_pairs: List[QAPair]) -> Dict:
+    """
+    Ответ на вопрос по найденным QA парам с оценкой уверенности
+    """
+    if not qa_pairs:
+        logger.warning(f"synthesize_answer вызван без QA пар для вопроса: '{question}'")
+        return _empty_synthesis()
 
-    for query in search_queries[:2]:
-        logger.info(f"Поиск для запроса: '{query}'")
-        
-        semantic_results = search_semantic(db, query)
-        logger.info(f"Semantic search нашел {len(semantic_results)} результатов")
-        
-        keyword_results = search_by_keywords(db, query)
-        logger.info(f"Keyword search нашел {len(keyword_results)} результатов")
-        
-        fulltext_results = search_full_text(db, query)
-        logger.info(f"Full-text search нашел {len(fulltext_results)} результатов")
+    logger.info(f"synthesize_answer для вопроса '{question}' с {len(qa_pairs)} QA парами")
 
-        combined_results = semantic_results + keyword_results + fulltext_results
-        
-        for qa in combined_results:
-            if qa.id not in seen_ids:
-                all_results.append(qa)
-                seen_ids.add(qa.id)
-                logger.debug(f"Добавлена QA пара ID={qa.id}, вопрос: '{qa.question[:50]}...'")
+    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    packed, prompt_pairs = _pack_synthesis_context(qa_pairs)
+    prompt = _build_synthesis_prompt(question, packed)
 
-    logger.info(f"Всего найдено уникальных QA пар: {len(all_results)}")
+    try:
+        started = time.perf_counter()
+        response = await rate_limiter.acall(
+            model.generate_content_async, prompt,
+            generation_config=SYNTHESIS_PARSER.generation_config, tokens=estimate_tokens(prompt)
+        )
+        prompt_tokens = record_prompt("synthesis", prompt, started)
+        return {**_parse_synthesis_response(response.text, prompt_pairs), "prompt_tokens": prompt_tokens}
 
-    if not all_results:
-        logger.warning(f"Не найдено ни одной QA пары для вопроса: '{question}'")
-        result = {
-            "found": False,
-            "answer": "",
-            "confidence": 0.0,
-            "sources": [],
-            "call_manager": True,
-            "intent": intent_data,
-            "reason": "Не найдено релевантных QA пар в базе знаний"
-        }
-        set_cached_result(cache_key, result, ttl=1800)
-        return result
+    except Exception as e:
+        return _synthesis_fallback(qa_pairs, e)
+
+def _not_found_result(intent_data: Dict) -> Dict:
+    return {
+        "found": False,
+        "answer": "",
+        "confidence": 0.0,
+        "sources": [],
+        "call_manager": True,
+        "intent": intent_data,
+        "reason": NO_MATCHES_REASON
+    }
 
-    logger.info(f"Генерация ответа на основе {len(all_results[:5])} QA пар")
-    synthesis = synthesize_answer(question, all_results[:5])
+def _agent_result(synthesis: Dict, intent_data: Dict, confidence_threshold: float) -> Dict:
     logger.info(f"Synthesis результат: found={synthesis.get('found')}, confidence={synthesis.get('confidence', 0.0)}, reason={synthesis.get('reason', '')}")
 
     call_manager = synthesis["confidence"] < confidence_threshold
 
-    result = {
+    return {
         "found": synthesis["found"],
         "answer": synthesis["answer"],
         "confidence": synthesis["confidence"],
@@ -237,7 +264,159 @@ def process_question(db: Session, question: str, confidence_threshold: float = 0
         "reason": synthesis.get("reason", "")
     }
 
-    if synthesis["found"]:
-        set_cached_result(cache_key, result, ttl=3600)
+def _merge_results(all_results: List[QAPair], seen_ids: set, combined_results: List[QAPair]) -> None:
+    for qa in combined_results:
+        if qa.id not in seen_ids:
+            all_results.append(qa)
+            seen_ids.add(qa.id)
+            logger.debug(f"Добавлена QA пара ID={qa.id}, вопрос: '{qa.question[:50]}...'")
+
+def _cheap_search(query: AnalyzedQuery) -> Dict:
+    """
+    Быстрые уровни поиска (keyword + full-text) в отдельной сессии
+    """
+    with read_session_scope() as db:
+        started = time.perf_counter()
+        keyword_results = search_by_keywords(db, query)
+        keyword_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        fulltext_results = search_full_text(db, query)
+        fulltext_ms = (time.perf_counter() - started) * 1000
+
+    confidence = 0.0
+    if fulltext_results and len(query.keywords) >= CHEAP_TIER_MIN_KEYWORDS:
+        confidence = fulltext_coverage(query, fulltext_results[0].id)
+
+    return {
+        "keyword": keyword_results,
+        "fulltext": fulltext_results,
+        "confidence": confidence,
+        "keyword_ms": keyword_ms,
+        "fulltext_ms": fulltext_ms
+    }
+
+async def _timed(coro) -> Tuple[object, float]:
+    started = time.perf_counter()
+    result = await coro
+    return result, _elapsed_ms(started)
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def _agent_cache_ttl(result: Dict) -> Optional[int]:
+    """
+    TTL кэша ответа агента: уверенные ответы и пустой поиск кэшируются надолго
+    (инвалидируются по событиям), неуверенный синтез (call_manager) не кэшируется
+    """
+    if (result["found"] and not result["call_manager"]) or result.get("reason") == NO_MATCHES_REASON:
+        return CACHE_RESULT_TTL
+    return None
+
+def _agent_cache_deps(result: Dict) -> List[int]:
+    """
+    Ответ зависит от QA пар-источников; пустой поиск ([]) устаревает
+    при добавлении новых пар
+    """
+    return result["sources"] if result["found"] else []
+
+async def process_question_async(db: Session, question: str, confidence_threshold: float = 0.8) -> Dict:
+    """
+    Ответ агента на вопрос (для FastAPI обработчиков)
+    - Вызовы Gemini и ожидание квоты не блокируют event loop
+    - Одинаковые одновременные вопросы объединяются в одно вычисление (single-flight)
+    - Перефразировки уже отвеченных вопросов берутся из семантического кэша
+    - Поиск по всем запросам из intent идёт параллельно: быстрые уровни
+      (keyword + full-text) и семантический уровень запускаются одновременно,
+      каждый в своей сессии БД
+    - Если быстрые уровни дали уверенное совпадение, семантический уровень
+      (с возможным reranking через Gemini) отменяется
+    - В результат добавляется разбивка времени по этапам (timings, мс)
+
+    db не используется: параллельные уровни поиска открывают собственные сессии
+    """
+    total_started = time.perf_counter()
+    timings = {}
+    outcome = {}
+
+    result = await get_or_compute_async(
+        f"agent:{question}",
+        lambda: _process_question_uncached(question, confidence_threshold, timings),
+        ttl=_agent_cache_ttl,
+        deps=_agent_cache_deps,
+        outcome=outcome
+    )
+
+    if outcome["source"] == "cache":
+        logger.info(f"Кэш найден для вопроса: '{question}'")
+        timings["cached"] = True
+    elif outcome["source"] == "coalesced":
+        # Ждали вычисление того же вопроса в другом запросе: время полное, этапы не свои
+        timings["coalesced"] = True
+    timings["total"] = _elapsed_ms(total_started)
+    logger.info(f"Timings (мс): {timings}")
+    return {**result, "timings": timings}
+
+async def _process_question_uncached(question: str, confidence_threshold: float, timings: Dict) -> Dict:
+    similar, timings["semantic_cache"] = await _timed(run_blocking(lookup_answer, question))
+    if similar:
+        result, similarity, cached_question = similar
+        logger.info(f"Семантический кэш: '{question}' ~ '{cached_question}' (similarity={similarity:.2f})")
+        timings["semantic_cache_similarity"] = round(similarity, 3)
+        return result
+
+    logger.info(f"Анализ intent для вопроса: '{question}'")
+    intent_data, timings["intent"] = await _timed(analyze_intent_async(question))
+    logger.info(f"Intent результат: {intent_data}")
+
+    search_queries = intent_data.get("search_queries", [question])[:2]
+    logger.info(f"Поисковые запросы: {search_queries}")
+
+    search_started = time.perf_counter()
+    # Каждый запрос разбирается один раз и передаётся во все уровни поиска
+    search_queries = await asyncio.gather(*[run_blocking(analyze_query, query) for query in search_queries])
+    semantic_tasks = [asyncio.create_task(_timed(search_semantic_async(None, query))) for query in search_queries]
+    cheap_results = await asyncio.gather(*[run_blocking(_cheap_search, query) for query in search_queries])
+    timings["keyword"] = round(max((result["keyword_ms"] for result in cheap_results), default=0.0), 1)
+    timings["fulltext"] = round(max((result["fulltext_ms"] for result in cheap_results), default=0.0), 1)
+
+    cheap_confidence = max((result["confidence"] for result in cheap_results), default=0.0)
+    if cheap_confidence >= CHEAP_TIER_CONFIDENT_COVERAGE:
+        logger.info(f"Быстрые уровни поиска уверены (coverage={cheap_confidence:.2f}), semantic search отменён")
+        for task in semantic_tasks:
+            task.cancel()
+        await asyncio.gather(*semantic_tasks, return_exceptions=True)
+        semantic_results = [[] for _ in search_queries]
+        timings["semantic"] = None
+        timings["semantic_cancelled"] = True
+    else:
+        semantic_outcomes = await asyncio.gather(*semantic_tasks)
+        semantic_results = [results for results, _ in semantic_outcomes]
+        timings["semantic"] = max((ms for _, ms in semantic_outcomes), default=0.0)
+    timings["search"] = _elapsed_ms(search_started)
 
+    all_results = []
+    seen_ids = set()
+
+    for query, semantic, cheap in zip(search_queries, semantic_results, cheap_results):
+        logger.info(
+            f"Запрос '{query}': semantic={len(semantic)}, keyword={len(cheap['keyword'])}, "
+            f"full-text={len(cheap['fulltext'])}"
+        )
+        _merge_results(all_results, seen_ids, semantic + cheap["keyword"] + cheap["fulltext"])
+
+    logger.info(f"Всего найдено уникальных QA пар: {len(all_results)}")
+
+    if not all_results:
+        logger.warning(f"Не найдено ни одной QA пары для вопроса: '{question}'")
+        return _not_found_result(intent_data)
+
+    logger.info(f"Генерация ответа на основе {len(all_results[:5])} QA пар")
+    synthesis, timings["synthesis"] = await _timed(synthesize_answer_async(question, all_results[:5]))
+    if "prompt_tokens" in synthesis:
+        timings["synthesis_prompt_tokens"] = synthesis["prompt_tokens"]
+    result = _agent_result(synthesis, intent_data, confidence_threshold)
+    # Неуверенный ответ в семантический кэш не попадает: похожий вопрос ушёл бы менеджеру без синтеза
+    if not result["call_manager"]:
+        store_answer(question, result)
     return result
@@ -1,12 +1,45 @@
+"""
+Двухуровневый кэш результатов
+- L1: in-process LRU с TTL, ограниченный по размеру в байтах
+- L2: Redis (общий для всех воркеров), опционально
+- Single-flight: одинаковые одновременные вычисления объединяются в одно
+- Инвалидация по событиям: запись хранит QA пары и версию базы знаний,
+  из которых она получена. Изменение/удаление пары удаляет только зависящие
+  от неё записи (Redis SCAN/UNLINK + pub/sub для L1 других воркеров),
+  добавление новых пар делает устаревшими только записи без зависимостей
+  ("ничего не найдено")
+"""
 import redis
+import asyncio
 import json
 import hashlib
 import os
-from typing import Optional, Any
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional, Any, Awaitable, Callable, Dict, Iterable, List, Tuple, Union
+from fnmatch import fnmatchcase
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# L1 (in-process) configuration
+CACHE_L1_MAX_BYTES = int(os.getenv("CACHE_L1_MAX_BYTES", str(16 * 1024 * 1024)))
+CACHE_L1_MAX_TTL = int(os.getenv("CACHE_L1_MAX_TTL", "300"))
+
+# TTL результатов, которые инвалидируются по событиям изменения базы знаний
+CACHE_RESULT_TTL = int(os.getenv("CACHE_RESULT_TTL", str(24 * 3600)))
+
+# Ключи служебных структур инвалидации
+KB_VERSION_KEY = "cache:kb_version"
+DEPS_KEY_PREFIX = "cache:deps:qa"
+INVALIDATION_CHANNEL = "cache:invalidate"
+# Отправитель события инвалидации (свои события воркер уже применил);
+# pid различает воркеры, созданные fork после импорта модуля
+_PROCESS_TOKEN = uuid.uuid4().hex
+SCAN_BATCH_SIZE = 500
+
 # Redis configuration
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
@@ -34,6 +67,128 @@ except Exception as e:
     REDIS_ENABLED = False
 
 
+class LRUCache:
+    """
+    In-process LRU кэш с TTL, ограниченный суммарным размером значений в байтах
+    Значения хранятся сериализованными в JSON, поэтому вызывающий код
+    не может случайно изменить закэшированный объект
+    """
+
+    def __init__(self, max_bytes: int = CACHE_L1_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # qa_id -> ключи записей, зависящих от этой QA пары
+        self._deps: Dict[int, set] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, size, expires_at, _ = entry
+            if expires_at <= time.monotonic():
+                self._pop_unlocked(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: str, ttl: float, deps: Iterable[int] = ()) -> None:
+        size = len(key) + len(value.encode('utf-8'))
+        if size > self.max_bytes or ttl <= 0:
+            return
+
+        deps = tuple(deps)
+        with self._lock:
+            self._pop_unlocked(key)
+            self._entries[key] = (value, size, time.monotonic() + ttl, deps)
+            self.size_bytes += size
+            for qa_id in deps:
+                self._deps.setdefault(qa_id, set()).add(key)
+
+            while self.size_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._pop_unlocked(oldest_key)
+                self.evictions += 1
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._pop_unlocked(key)
+
+    def delete_dependents(self, qa_id: int) -> int:
+        """
+        Удалить записи, зависящие от QA пары
+        """
+        with self._lock:
+            keys = self._deps.pop(qa_id, set())
+            return sum(1 for key in keys if self._pop_unlocked(key))
+
+    def _pop_unlocked(self, key: str) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self.size_bytes -= entry[1]
+        for qa_id in entry[3]:
+            dependents = self._deps.get(qa_id)
+            if dependents is not None:
+                dependents.discard(key)
+                if not dependents:
+                    del self._deps[qa_id]
+        return True
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._deps.clear()
+            self.size_bytes = 0
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self.size_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / max(self.hits + self.misses, 1) * 100
+            }
+
+
+l1_cache = LRUCache()
+
+# Счётчики L2 (Redis) для текущего воркера
+_l2_stats = {"hits": 0, "misses": 0, "errors": 0}
+
+# Single-flight: ключ -> future выполняющегося вычисления
+_inflight: Dict[str, asyncio.Future] = {}
+_coalesced_count = 0
+
+# Последняя известная версия базы знаний (обновляется из Redis и pub/sub)
+_kb_version = 0
+_invalidation_stats = {"stale": 0, "dropped": 0, "events": 0}
+_listener = None
+# Другие кэши и индексы процесса, которые нужно обновлять при изменении QA пар:
+# (обработчик, вызывать ли для изменений в этом же воркере)
+_invalidation_handlers: List[Tuple[Callable[[List[int]], Any], bool]] = []
+
+
 def normalize_query(query: str) -> str:
     """
     Нормализация запроса для кэширования
@@ -53,90 +208,404 @@ def get_cache_key(query: str, prefix: str = "search") -> str:
     return f"{prefix}:{hash_key}"
 
 
-def get_cached_result(query: str) -> Optional[Any]:
+def _wrap_entry(result: Any, deps: Optional[List[int]], kb_version: int) -> Dict:
+    """
+    Запись кэша: результат + версия базы знаний и QA пары, из которых он получен
+    deps=None - результат не зависит от базы знаний (например, intent)
+    """
+    return {"kb": kb_version, "deps": deps, "data": result}
+
+
+def _unwrap_entry(cache_key: str, raw: str) -> Optional[Any]:
     """
-    Получить результат из кэша
+    Вернуть результат из записи кэша или None, если запись устарела
+    Записи без зависимостей (deps == []) устаревают при любом изменении
+    базы знаний: новая QA пара может ответить на вопрос
+    """
+    entry = json.loads(raw)
+    if not isinstance(entry, dict) or "kb" not in entry:
+        return None
+    if entry["deps"] == [] and entry["kb"] != _kb_version:
+        _invalidation_stats["stale"] += 1
+        l1_cache.delete(cache_key)
+        return None
+    return entry["data"]
+
+
+def get_kb_version() -> int:
+    """
+    Версия базы знаний: снимок до вычисления результата передаётся в set_cached_result
+    """
+    return _kb_version
+
+
+def _observe_kb_version(version: Optional[str]) -> None:
+    """
+    Версия в Redis - источник истины (сравнение на равенство, поэтому
+    сброс счётчика в Redis только делает записи устаревшими)
+    """
+    global _kb_version
+    if version is not None:
+        _kb_version = int(version)
+
+
+def get_cached_result(query: str, cache_key: Optional[str] = None) -> Optional[Any]:
+    """
+    Получить результат из кэша (сначала L1, затем Redis)
+    cache_key - уже вычисленный ключ (AnalyzedQuery.cache_key)
     Returns: dict с результатами поиска или None
     """
+    cache_key = cache_key or get_cache_key(query)
+
+    cached_data = l1_cache.get(cache_key)
+    if cached_data is not None:
+        result = _unwrap_entry(cache_key, cached_data)
+        if result is not None:
+            print(f"✅ Cache HIT (L1) for query: '{query[:50]}...'")
+            return result
+
     if not REDIS_ENABLED:
         return None
 
     try:
-        cache_key = get_cache_key(query)
-        cached_data = redis_client.get(cache_key)
+        pipeline = redis_client.pipeline()
+        pipeline.get(cache_key)
+        pipeline.ttl(cache_key)
+        pipeline.get(KB_VERSION_KEY)
+        cached_data, ttl, kb_version = pipeline.execute()
+        _observe_kb_version(kb_version)
 
-        if cached_data:
-            print(f"✅ Cache HIT for query: '{query[:50]}...'")
-            return json.loads(cached_data)
+        result = _unwrap_entry(cache_key, cached_data) if cached_data else None
+        if result is not None:
+            _l2_stats["hits"] += 1
+            print(f"✅ Cache HIT (L2) for query: '{query[:50]}...'")
+            # Прогреваем L1 на оставшееся время жизни ключа
+            entry_deps = json.loads(cached_data)["deps"] or ()
+            l1_ttl = min(ttl if ttl and ttl > 0 else CACHE_L1_MAX_TTL, CACHE_L1_MAX_TTL)
+            l1_cache.set(cache_key, cached_data, l1_ttl, deps=entry_deps)
+            return result
         else:
+            _l2_stats["misses"] += 1
             print(f"⚠️  Cache MISS for query: '{query[:50]}...'")
             return None
     except Exception as e:
+        _l2_stats["errors"] += 1
         print(f"❌ Cache get error: {e}")
         return None
 
 
-def set_cached_result(query: str, result: Any, ttl: int = 3600) -> bool:
+def set_cached_result(
+    query: str,
+    result: Any,
+    ttl: int = 3600,
+    deps: Optional[Iterable[int]] = None,
+    cache_key: Optional[str] = None,
+    kb_version: Optional[int] = None
+) -> bool:
     """
-    Сохранить результат в кэш
+    Сохранить результат в кэш (L1 + Redis)
     Args:
         query: поисковый запрос
         result: результаты поиска (будут сериализованы в JSON)
         ttl: время жизни кэша в секундах (по умолчанию 1 час)
-    Returns: True если сохранено, False иначе
+        deps: id QA пар, из которых получен результат ([] - ничего не найдено,
+            None - результат не зависит от базы знаний)
+        cache_key: уже вычисленный ключ (AnalyzedQuery.cache_key)
+        kb_version: версия базы знаний на начало вычисления (get_kb_version);
+            если база знаний с тех пор изменилась, результат мог устареть и не кэшируется
+    Returns: True если сохранено хотя бы в один уровень
     """
-    if not REDIS_ENABLED:
+    if kb_version is None:
+        kb_version = _kb_version
+    elif kb_version != _kb_version:
+        _invalidation_stats["stale"] += 1
+        print(f"⚠️  Skip caching for query: '{query[:50]}...' (knowledge base changed during computation)")
+        return False
+
+    deps = sorted(set(deps)) if deps is not None else None
+    try:
+        cache_key = cache_key or get_cache_key(query)
+        serialized = json.dumps(_wrap_entry(result, deps, kb_version), ensure_ascii=False)
+    except Exception as e:
+        print(f"❌ Cache set error: {e}")
         return False
 
+    l1_cache.set(cache_key, serialized, min(ttl, CACHE_L1_MAX_TTL), deps=deps or ())
+
+    if not REDIS_ENABLED:
+        return True
+
     try:
-        cache_key = get_cache_key(query)
-        serialized = json.dumps(result, ensure_ascii=False)
-        redis_client.setex(cache_key, ttl, serialized)
+        pipeline = redis_client.pipeline()
+        pipeline.setex(cache_key, ttl, serialized)
+        for qa_id in deps or ():
+            dep_key = f"{DEPS_KEY_PREFIX}:{qa_id}"
+            pipeline.sadd(dep_key, cache_key)
+            # Множество зависимостей живёт не меньше самой долгой записи в нём
+            pipeline.expire(dep_key, max(ttl, CACHE_RESULT_TTL))
+        pipeline.execute()
         print(f"✅ Cached result for query: '{query[:50]}...' (TTL: {ttl}s)")
         return True
     except Exception as e:
+        _l2_stats["errors"] += 1
         print(f"❌ Cache set error: {e}")
-        return False
+        return True
+
+
+async def get_or_compute_async(
+    query: str,
+    compute: Callable[[], Awaitable[Any]],
+    ttl: Union[int, Callable[[Any], Optional[int]]] = 3600,
+    deps: Optional[Callable[[Any], Optional[Iterable[int]]]] = None,
+    outcome: Optional[Dict[str, str]] = None
+) -> Any:
+    """
+    Получить результат из кэша или вычислить его (single-flight)
+    Одновременные вызовы с одинаковым ключом ждут одно вычисление,
+    поэтому N одинаковых вопросов дают один вызов compute
+
+    Args:
+        query: ключ кэша (до нормализации)
+        compute: корутина-фабрика, вычисляющая результат
+        ttl: время жизни результата или функция result -> ttl (None - не кэшировать)
+        deps: функция result -> id QA пар, от которых зависит результат
+        outcome: словарь, в который пишется источник результата (outcome["source"]):
+            "cache", "coalesced" (дождались чужого вычисления) или "computed"
+    """
+    global _coalesced_count
+
+    if outcome is None:
+        outcome = {}
+
+    cached = get_cached_result(query)
+    if cached is not None:
+        outcome["source"] = "cache"
+        return cached
+
+    cache_key = get_cache_key(query)
+    inflight = _inflight.get(cache_key)
+    if inflight is not None:
+        _coalesced_count += 1
+        outcome["source"] = "coalesced"
+        print(f"🔗 Coalesced request for query: '{query[:50]}...'")
+        return await asyncio.shield(inflight)
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[cache_key] = future
+    outcome["source"] = "computed"
+    kb_version = _kb_version
+    try:
+        result = await compute()
+        result_ttl = ttl(result) if callable(ttl) else ttl
+        if result_ttl:
+            set_cached_result(
+                query, result, ttl=result_ttl, deps=deps(result) if deps else None, kb_version=kb_version
+            )
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        # Исключение получат ожидающие; для future без ожидающих не логируем предупреждение
+        future.exception()
+        raise
+    finally:
+        _inflight.pop(cache_key, None)
+
+
+def _unlink(keys: List[str]) -> int:
+    """
+    UNLINK пачками (освобождение памяти в Redis происходит в фоне)
+    """
+    deleted = 0
+    for start in range(0, len(keys), SCAN_BATCH_SIZE):
+        deleted += redis_client.unlink(*keys[start:start + SCAN_BATCH_SIZE])
+    return deleted
 
 
 def invalidate_cache(pattern: str = "search:*") -> int:
     """
     Удалить все ключи кэша по паттерну
+    Использует SCAN, чтобы не блокировать Redis на больших базах
     Args:
         pattern: паттерн для удаления (например, "search:*")
     Returns: количество удаленных ключей
     """
+    for key in l1_cache.keys():
+        if fnmatchcase(key, pattern):
+            l1_cache.delete(key)
+
     if not REDIS_ENABLED:
         return 0
 
     try:
-        keys = redis_client.keys(pattern)
-        if keys:
-            deleted = redis_client.delete(*keys)
+        deleted = _unlink(list(redis_client.scan_iter(match=pattern, count=SCAN_BATCH_SIZE)))
+        if deleted:
             print(f"✅ Invalidated {deleted} cache entries matching '{pattern}'")
-            return deleted
-        return 0
+        return deleted
     except Exception as e:
         print(f"❌ Cache invalidation error: {e}")
         return 0
 
 
+def _bump_kb_version() -> int:
+    global _kb_version
+    if REDIS_ENABLED:
+        try:
+            _observe_kb_version(redis_client.incr(KB_VERSION_KEY))
+            return _kb_version
+        except Exception as e:
+            _l2_stats["errors"] += 1
+            print(f"❌ KB version bump error: {e}")
+    _kb_version += 1
+    return _kb_version
+
+
+def _worker_id() -> str:
+    return f"{_PROCESS_TOKEN}:{os.getpid()}"
+
+
+def _publish_invalidation(qa_ids: List[int]) -> None:
+    if not REDIS_ENABLED:
+        return
+    try:
+        redis_client.publish(INVALIDATION_CHANNEL, json.dumps({"kb": _kb_version, "qa_ids": qa_ids, "origin": _worker_id()}))
+    except Exception as e:
+        _l2_stats["errors"] += 1
+        print(f"❌ Cache invalidation publish error: {e}")
+
+
+def notify_kb_changed(qa_ids: Iterable[int] = ()) -> int:
+    """
+    В базу знаний добавлена новая QA пара (approve, ответ из Slack)
+    Повышает версию базы знаний: записи "ничего не найдено" становятся
+    устаревшими, найденные результаты остаются в кэше
+    qa_ids - добавленные пары: их получают обработчики инвалидации всех воркеров
+    Returns: новая версия базы знаний
+    """
+    qa_ids = sorted(set(qa_ids))
+    version = _bump_kb_version()
+    if qa_ids:
+        _run_invalidation_handlers(qa_ids)
+    _publish_invalidation(qa_ids)
+    return version
+
+
+def register_invalidation_handler(handler: Callable[[List[int]], Any], local: bool = True) -> None:
+    """
+    Подписать локальный кэш или индекс на инвалидацию QA пар (в т.ч. от других воркеров)
+    local=False - только события других воркеров (этот воркер обновляется сам)
+    """
+    _invalidation_handlers.append((handler, local))
+
+
+def _run_invalidation_handlers(qa_ids: List[int], remote: bool = False) -> None:
+    for handler, local in _invalidation_handlers:
+        if not local and not remote:
+            continue
+        try:
+            handler(qa_ids)
+        except Exception as e:
+            print(f"❌ Cache invalidation handler error: {e}")
+
+
+def invalidate_qa_pairs(qa_ids: Iterable[int]) -> int:
+    """
+    QA пары изменены или удалены: удалить записи кэша, зависящие от них
+    (в L1 этого воркера, в Redis и, через pub/sub, в L1 остальных воркеров)
+    Returns: количество удалённых записей
+    """
+    qa_ids = sorted(set(qa_ids))
+    _bump_kb_version()
+
+    deleted = sum(l1_cache.delete_dependents(qa_id) for qa_id in qa_ids)
+    _run_invalidation_handlers(qa_ids)
+
+    if REDIS_ENABLED and qa_ids:
+        try:
+            dep_keys = [f"{DEPS_KEY_PREFIX}:{qa_id}" for qa_id in qa_ids]
+            pipeline = redis_client.pipeline()
+            for dep_key in dep_keys:
+                pipeline.smembers(dep_key)
+            cache_keys = sorted(set().union(*pipeline.execute()))
+            if cache_keys:
+                deleted = max(deleted, _unlink(cache_keys))
+            _unlink(dep_keys)
+        except Exception as e:
+            _l2_stats["errors"] += 1
+            print(f"❌ Cache invalidation error: {e}")
+
+    _publish_invalidation(qa_ids)
+    _invalidation_stats["dropped"] += deleted
+    if deleted:
+        print(f"✅ Invalidated {deleted} cache entries for QA pairs {qa_ids}")
+    return deleted
+
+
+def _handle_invalidation_message(message: dict) -> None:
+    """
+    Событие инвалидации от другого воркера: чистим свой L1
+    """
+    try:
+        event = json.loads(message["data"])
+        _observe_kb_version(event.get("kb"))
+        if event.get("origin") == _worker_id():
+            return
+        qa_ids = event.get("qa_ids", [])
+        for qa_id in qa_ids:
+            l1_cache.delete_dependents(qa_id)
+        if qa_ids:
+            _run_invalidation_handlers(qa_ids, remote=True)
+        _invalidation_stats["events"] += 1
+    except Exception as e:
+        print(f"❌ Cache invalidation event error: {e}")
+
+
+def start_invalidation_listener() -> None:
+    """
+    Подписаться на события инвалидации (фоновый поток redis pub/sub)
+    """
+    global _listener
+    if not REDIS_ENABLED or _listener is not None:
+        return
+    try:
+        _observe_kb_version(redis_client.get(KB_VERSION_KEY))
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: _handle_invalidation_message})
+        _listener = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+        print("✅ Cache invalidation listener started")
+    except Exception as e:
+        print(f"⚠️  Cache invalidation listener not started: {e}")
+
+
+def stop_invalidation_listener() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
 def get_cache_stats() -> dict:
     """
-    Получить статистику кэша
+    Получить статистику кэша по уровням
     """
+    stats = {
+        "l1": l1_cache.get_stats(),
+        "l2": {"enabled": REDIS_ENABLED, **_l2_stats},
+        "coalesced": _coalesced_count,
+        "inflight": len(_inflight),
+        "kb_version": _kb_version,
+        "invalidation": dict(_invalidation_stats)
+    }
+
     if not REDIS_ENABLED:
-        return {
-            "enabled": False,
-            "message": "Redis caching is disabled"
-        }
+        stats["l2"]["message"] = "Redis caching is disabled"
+        return stats
 
     try:
         info = redis_client.info("stats")
-        search_keys = len(redis_client.keys("search:*"))
+        search_keys = sum(1 for _ in redis_client.scan_iter(match="search:*", count=SCAN_BATCH_SIZE))
 
-        return {
-            "enabled": True,
+        stats["l2"].update({
             "total_keys": redis_client.dbsize(),
             "search_cache_keys": search_keys,
             "keyspace_hits": info.get("keyspace_hits", 0),
@@ -144,9 +613,8 @@ def get_cache_stats() -> dict:
             "hit_rate": info.get("keyspace_hits", 0) / max(
                 info.get("keyspace_hits", 0) + info.get("keyspace_misses", 0), 1
             ) * 100
-        }
+        })
     except Exception as e:
-        return {
-            "enabled": False,
-            "error": str(e)
-        }
+        stats["l2"]["error"] = str(e)
+
+    return stats
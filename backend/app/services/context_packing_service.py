@@ -0,0 +1,278 @@
+"""
+Упаковка QA пар в контекст промптов Gemini (semantic search, синтез ответа)
+- Пары добавляются в порядке релевантности, пока не исчерпан бюджет токенов
+  контекста; не поместившиеся пары отбрасываются
+- Длинные вопросы/ответы сокращаются до фрагмента по границе предложения
+- Оценка токенов и фрагменты кэшируются по id QA пары (LRU), записи
+  сбрасываются при изменении/удалении пары
+- Метрики по каждому виду промпта: размер промпта, задержка вызова,
+  сколько пар упаковано/сокращено/отброшено (get_context_stats)
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+from dotenv import load_dotenv
+
+from app.services.cache_service import register_invalidation_handler
+from app.services.rate_limiter_service import estimate_tokens
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Бюджет токенов на записи базы знаний в промпте и максимальная длина ответа в записи
+SEMANTIC_CONTEXT_TOKEN_BUDGET = int(os.getenv("SEMANTIC_CONTEXT_TOKEN_BUDGET", "4000"))
+SEMANTIC_CONTEXT_ANSWER_TOKENS = int(os.getenv("SEMANTIC_CONTEXT_ANSWER_TOKENS", "150"))
+SYNTHESIS_CONTEXT_TOKEN_BUDGET = int(os.getenv("SYNTHESIS_CONTEXT_TOKEN_BUDGET", "3000"))
+SYNTHESIS_CONTEXT_ANSWER_TOKENS = int(os.getenv("SYNTHESIS_CONTEXT_ANSWER_TOKENS", "800"))
+CONTEXT_QUESTION_TOKENS = int(os.getenv("CONTEXT_QUESTION_TOKENS", "100"))
+CONTEXT_CACHE_SIZE = int(os.getenv("CONTEXT_CACHE_SIZE", "5000"))
+
+# "ID N:\nВопрос: ...\nОтвет: ..." и разделители между записями
+ENTRY_OVERHEAD_TOKENS = 8
+# Фрагмент короче этого не выделяется: запись отбрасывается целиком
+MIN_SNIPPET_TOKENS = 30
+SNIPPET_SUFFIX = "…"
+
+_SENTENCE_END_RE = re.compile(r"[.!?;:…](?=\s)|\n")
+
+
+@dataclass(frozen=True)
+class PackedEntry:
+    """
+    Запись контекста: index - позиция пары во входном списке
+    """
+    index: int
+    question: str
+    answer: str
+    tokens: int
+    truncated: bool
+
+
+@dataclass
+class PackedContext:
+    entries: List[PackedEntry]
+    tokens: int
+    dropped: int
+
+    @property
+    def indices(self) -> List[int]:
+        return [entry.index for entry in self.entries]
+
+
+def make_snippet(text: str, max_tokens: int) -> Tuple[str, bool]:
+    """
+    Сократить текст до ~max_tokens по последней границе предложения
+    (или слова, если предложение слишком длинное)
+
+    Returns:
+        (фрагмент, был ли текст сокращён)
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text, False
+
+    limit = max(1, max_tokens * 4 - len(SNIPPET_SUFFIX))
+    head = text[:limit]
+    boundaries = [match.end() for match in _SENTENCE_END_RE.finditer(head)]
+    # Граница предложения в первой половине фрагмента теряет слишком много текста
+    cut = boundaries[-1] if boundaries and boundaries[-1] >= limit // 2 else head.rfind(" ")
+    if cut <= 0:
+        cut = limit
+    return head[:cut].rstrip() + SNIPPET_SUFFIX, True
+
+
+class ContextPacker:
+    """
+    Кэш фрагментов QA пар и метрики промптов
+    """
+
+    def __init__(self, cache_size: int = CONTEXT_CACHE_SIZE):
+        self.cache_size = cache_size
+        # (qa_id, лимит вопроса, лимит ответа) -> (hash исходных текстов, вопрос, ответ, токены, сокращено)
+        self._cache: "OrderedDict[Tuple[int, int, int], Tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.invalidations = 0
+        self._prompts: Dict[str, Dict] = {}
+
+    def _entry(self, qa_id: Optional[int], question: str, answer: str,
+               question_tokens: int, answer_tokens: int) -> Tuple[str, str, int, bool]:
+        key = (qa_id, question_tokens, answer_tokens)
+        source = hash((question, answer))
+        if qa_id is not None:
+            with self._lock:
+                cached = self._cache.get(key)
+                if cached is not None and cached[0] == source:
+                    self._cache.move_to_end(key)
+                    self.cache_hits += 1
+                    return cached[1:]
+                self.cache_misses += 1
+
+        question_snippet, question_cut = make_snippet(question, question_tokens)
+        answer_snippet, answer_cut = make_snippet(answer, answer_tokens)
+        tokens = estimate_tokens(question_snippet) + estimate_tokens(answer_snippet) + ENTRY_OVERHEAD_TOKENS
+        entry = (question_snippet, answer_snippet, tokens, question_cut or answer_cut)
+
+        if qa_id is not None:
+            with self._lock:
+                self._cache[key] = (source, *entry)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return entry
+
+    def pack(self, name: str, items: Sequence[Tuple[Optional[int], str, str]], budget: int,
+             answer_tokens: int, question_tokens: int = CONTEXT_QUESTION_TOKENS) -> PackedContext:
+        """
+        Упаковать пары (qa_id, вопрос, ответ) в порядке релевантности в budget токенов
+        Первая пара попадает в контекст всегда (при нехватке бюджета - сокращённой)
+        """
+        entries: List[PackedEntry] = []
+        used = 0
+        for index, (qa_id, question, answer) in enumerate(items):
+            question_text, answer_text, tokens, truncated = self._entry(
+                qa_id, question or "", answer or "", question_tokens, answer_tokens
+            )
+            remaining = budget - used
+            if tokens > remaining:
+                # Не помещается целиком: сокращённый ответ, если остаток бюджета это позволяет
+                answer_room = remaining - estimate_tokens(question_text) - ENTRY_OVERHEAD_TOKENS
+                if answer_room < MIN_SNIPPET_TOKENS and entries:
+                    continue
+                answer_text, _ = make_snippet(answer_text, max(MIN_SNIPPET_TOKENS, answer_room))
+                tokens = estimate_tokens(question_text) + estimate_tokens(answer_text) + ENTRY_OVERHEAD_TOKENS
+                truncated = True
+            entries.append(PackedEntry(index, question_text, answer_text, tokens, truncated))
+            used += tokens
+
+        packed = PackedContext(entries=entries, tokens=used, dropped=len(items) - len(entries))
+        with self._lock:
+            stats = self._prompt_stats(name)
+            stats["pairs_in"] += len(items)
+            stats["pairs_packed"] += len(entries)
+            stats["pairs_truncated"] += sum(1 for entry in entries if entry.truncated)
+            stats["pairs_dropped"] += packed.dropped
+            stats["context_tokens_total"] += used
+        if packed.dropped:
+            logger.info(f"Контекст {name}: {len(entries)}/{len(items)} пар в бюджете {budget} токенов")
+        return packed
+
+    def _prompt_stats(self, name: str) -> Dict:
+        stats = self._prompts.get(name)
+        if stats is None:
+            stats = self._prompts[name] = {
+                "calls": 0,
+                "pairs_in": 0,
+                "pairs_packed": 0,
+                "pairs_truncated": 0,
+                "pairs_dropped": 0,
+                "context_tokens_total": 0,
+                "prompt_tokens_total": 0,
+                "prompt_tokens_max": 0,
+                "prompt_tokens_last": 0,
+                "latency_ms_total": 0.0,
+                "latency_ms_max": 0.0,
+                "latency_ms_last": 0.0
+            }
+        return stats
+
+    def record_call(self, name: str, prompt_tokens: int, latency_ms: float) -> None:
+        """
+        Учесть вызов Gemini с упакованным промптом (размер промпта и задержка)
+        """
+        with self._lock:
+            stats = self._prompt_stats(name)
+            stats["calls"] += 1
+            stats["prompt_tokens_total"] += prompt_tokens
+            stats["prompt_tokens_max"] = max(stats["prompt_tokens_max"], prompt_tokens)
+            stats["prompt_tokens_last"] = prompt_tokens
+            stats["latency_ms_total"] += latency_ms
+            stats["latency_ms_max"] = max(stats["latency_ms_max"], latency_ms)
+            stats["latency_ms_last"] = round(latency_ms, 1)
+        logger.debug(f"Промпт {name}: ~{prompt_tokens} токенов, {latency_ms:.0f} мс")
+
+    def invalidate(self, qa_ids: List[int]) -> int:
+        """
+        Сбросить фрагменты изменённых/удалённых QA пар (пустой список - ничего)
+        """
+        ids = set(qa_ids)
+        if not ids:
+            return 0
+        with self._lock:
+            stale = [key for key in self._cache if key[0] in ids]
+            for key in stale:
+                del self._cache[key]
+            self.invalidations += len(stale)
+        return len(stale)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            prompts = {}
+            for name, stats in self._prompts.items():
+                calls = stats["calls"]
+                prompts[name] = {
+                    **stats,
+                    "latency_ms_total": round(stats["latency_ms_total"], 1),
+                    "latency_ms_max": round(stats["latency_ms_max"], 1),
+                    "avg_prompt_tokens": round(stats["prompt_tokens_total"] / calls, 1) if calls else 0.0,
+                    "avg_latency_ms": round(stats["latency_ms_total"] / calls, 1) if calls else 0.0
+                }
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                "budgets": {
+                    "semantic_search": SEMANTIC_CONTEXT_TOKEN_BUDGET,
+                    "synthesis": SYNTHESIS_CONTEXT_TOKEN_BUDGET
+                },
+                "cache_size": len(self._cache),
+                "cache_capacity": self.cache_size,
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+                "cache_hit_rate": round(self.cache_hits / lookups, 4) if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "prompts": prompts
+            }
+
+
+# Глобальный экземпляр (singleton)
+_global_packer = None
+_global_packer_lock = threading.Lock()
+
+
+def get_context_packer() -> ContextPacker:
+    """
+    Получить глобальный упаковщик контекста (singleton)
+    """
+    global _global_packer
+    if _global_packer is None:
+        with _global_packer_lock:
+            if _global_packer is None:
+                _global_packer = ContextPacker()
+                register_invalidation_handler(_global_packer.invalidate)
+    return _global_packer
+
+
+def pack_context(name: str, items: Sequence[Tuple[Optional[int], str, str]], budget: int,
+                 answer_tokens: int) -> PackedContext:
+    return get_context_packer().pack(name, items, budget, answer_tokens)
+
+
+def record_prompt(name: str, prompt: str, started: float) -> int:
+    """
+    Учесть вызов с промптом prompt, начатый в started (time.perf_counter())
+
+    Returns:
+        оценка размера промпта в токенах
+    """
+    prompt_tokens = estimate_tokens(prompt)
+    get_context_packer().record_call(name, prompt_tokens, (time.perf_counter() - started) * 1000)
+    return prompt_tokens
+
+
+def get_context_stats() -> Dict:
+    return get_context_packer().get_stats()
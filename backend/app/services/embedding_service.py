@@ -0,0 +1,650 @@
+"""
+Сервис эмбеддингов для семантического поиска
+- Подключаемые backend'ы: hashing (локальный, CPU, по умолчанию),
+  sentence-transformers (если установлен), stub (детерминированный, для тестов)
+- VectorIndex: матрица нормализованных векторов approved QA пар в NumPy
+- MemmapVectorStore: та же матрица на диске, открывается через numpy.memmap
+  и разделяется всеми uvicorn воркерами (страницы page cache общие)
+- Поиск: один векторизованный cosine top-k вместо отправки всей БЗ в Gemini
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy.orm import Session
+
+from app.models import QAPair, QAPairStatus
+from app.services.text_processing_service import tokenize_lemmas
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "hashing")
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "512"))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+# Каталог персистентного хранилища векторов (пусто - только in-memory индекс);
+# относительный путь - от каталога backend, а не от текущего каталога процесса
+EMBEDDING_STORE_DIR = os.getenv("EMBEDDING_STORE_DIR", "data/embeddings")
+if EMBEDDING_STORE_DIR:
+    EMBEDDING_STORE_DIR = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), EMBEDDING_STORE_DIR
+    )
+
+# Межпроцессная блокировка записи (только Unix; на других ОС - один процесс)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def _stable_hash(value: str) -> int:
+    """
+    Детерминированный хэш строки (hash() в Python рандомизирован между процессами)
+    """
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32, copy=False)
+
+
+class EmbeddingBackend:
+    """
+    Базовый класс backend'а эмбеддингов
+    """
+
+    name = "base"
+    dim = EMBEDDING_DIM
+
+    def embed_batch(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Вернуть матрицу (len(texts), dim) float32 с L2-нормализованными строками
+        """
+        raise NotImplementedError
+
+    def embed(self, text: str) -> np.ndarray:
+        return self.embed_batch([text])[0]
+
+
+class HashingEmbeddingBackend(EmbeddingBackend):
+    """
+    Локальный CPU backend без моделей: feature hashing лемм и символьных триграмм
+    Триграммы сглаживают словоформы, если pymorphy2 недоступен
+    """
+
+    name = "hashing"
+
+    def __init__(self, dim: int = EMBEDDING_DIM, trigram_weight: float = 2.0):
+        self.dim = dim
+        self.trigram_weight = trigram_weight
+
+    def _features(self, text: str) -> Dict[int, float]:
+        features: Dict[int, float] = {}
+
+        def add(feature: str, weight: float):
+            hashed = _stable_hash(feature)
+            bucket = hashed % self.dim
+            sign = 1.0 if (hashed >> 63) & 1 else -1.0
+            features[bucket] = features.get(bucket, 0.0) + sign * weight
+
+        for lemma in tokenize_lemmas(text or "", min_length=2):
+            add(f"w:{lemma}", 1.0)
+            padded = f"<{lemma}>"
+            trigrams = [padded[i:i + 3] for i in range(len(padded) - 2)]
+            for trigram in trigrams:
+                add(f"t:{trigram}", self.trigram_weight / len(trigrams))
+
+        return features
+
+    def embed_batch(self, texts: Sequence[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for bucket, value in self._features(text).items():
+                matrix[row, bucket] = value
+        return _normalize_rows(matrix)
+
+
+class StubEmbeddingBackend(EmbeddingBackend):
+    """
+    Детерминированный backend для тестов: вектор зависит только от текста
+    """
+
+    name = "stub"
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+
+    def embed_batch(self, texts: Sequence[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            rng = np.random.default_rng(_stable_hash(' '.join((text or "").lower().split())))
+            matrix[row] = rng.standard_normal(self.dim)
+        return _normalize_rows(matrix)
+
+
+class SentenceTransformerBackend(EmbeddingBackend):
+    """
+    Нейросетевые эмбеддинги через sentence-transformers (опционально, CPU)
+    """
+
+    name = "sentence-transformers"
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed_batch(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = self.model.encode(list(texts), batch_size=32, show_progress_bar=False)
+        return _normalize_rows(np.asarray(vectors, dtype=np.float32))
+
+
+EMBEDDING_BACKENDS = {
+    HashingEmbeddingBackend.name: HashingEmbeddingBackend,
+    StubEmbeddingBackend.name: StubEmbeddingBackend,
+    SentenceTransformerBackend.name: SentenceTransformerBackend,
+}
+
+
+class VectorIndex:
+    """
+    Индекс нормализованных векторов: ID QA пары -> строка матрицы
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._matrix = np.zeros((0, dim), dtype=np.float32)
+        self._lock = threading.RLock()
+        self.ready = False
+
+    def set_all(self, ids: Sequence[int], matrix: np.ndarray) -> None:
+        with self._lock:
+            self._ids = np.asarray(ids, dtype=np.int64)
+            self._matrix = np.asarray(matrix, dtype=np.float32).reshape(len(self._ids), self.dim)
+
+    def upsert(self, qa_id: int, vector: np.ndarray) -> None:
+        with self._lock:
+            rows = np.flatnonzero(self._ids == qa_id)
+            if rows.size:
+                self._matrix[rows[0]] = vector
+            else:
+                self._ids = np.append(self._ids, np.int64(qa_id))
+                self._matrix = np.vstack([self._matrix, vector.reshape(1, self.dim)])
+
+    def remove(self, qa_id: int) -> None:
+        with self._lock:
+            keep = self._ids != qa_id
+            if not keep.all():
+                self._ids = self._ids[keep]
+                self._matrix = self._matrix[keep]
+
+    def search(self, vector: np.ndarray, limit: int = 10) -> List[Tuple[int, float]]:
+        """
+        Cosine top-k (векторы нормализованы, поэтому это скалярное произведение)
+
+        Returns:
+            список (ID QA пары, similarity), по убыванию similarity
+        """
+        with self._lock:
+            ids, matrix = self._ids, self._matrix
+
+        if not len(ids):
+            return []
+
+        scores = matrix @ vector.astype(np.float32, copy=False)
+        limit = min(limit, len(ids))
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+
+        return [(int(ids[i]), float(scores[i])) for i in top]
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "vectors": int(len(self._ids)),
+                "dim": self.dim,
+                "memory_bytes": int(self._matrix.nbytes + self._ids.nbytes)
+            }
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+
+class MemmapVectorStore:
+    """
+    Версионированное хранилище векторов на диске
+
+    Файлы в каталоге хранилища:
+    - meta.json: версия формата, сигнатура backend'а, поколение файлов, число строк
+    - ids-<generation>.i64: ID QA пар по строкам (-1 - tombstone)
+    - vectors-<generation>.f32: матрица float32 (rows x dim)
+
+    Новые строки дописываются в конец, удалённые помечаются tombstone на месте.
+    Воркеры открывают файлы через numpy.memmap и перечитывают meta.json при
+    изменении. Когда tombstone'ов больше, чем живых строк, файлы переписываются
+    в новое поколение.
+    """
+
+    FORMAT_VERSION = 1
+    TOMBSTONE = -1
+
+    def __init__(self, path: str, dim: int, signature: str):
+        self.path = path
+        self.dim = dim
+        self.signature = signature
+        self._lock = threading.RLock()
+        self._meta_mtime = None
+        self._meta: Optional[dict] = None
+        # Последнее поколение файлов на диске (в том числе несовместимых)
+        self._disk_generation = 0
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._matrix = np.zeros((0, dim), dtype=np.float32)
+        self.ready = False
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.path, "meta.json")
+
+    def _data_paths(self, generation: int) -> Tuple[str, str]:
+        return (
+            os.path.join(self.path, f"ids-{generation}.i64"),
+            os.path.join(self.path, f"vectors-{generation}.f32"),
+        )
+
+    @contextmanager
+    def _write_lock(self):
+        """
+        Эксклюзивная блокировка записи между воркерами
+        """
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, "store.lock"), "a") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write_meta(self, meta: dict) -> None:
+        tmp_path = f"{self._meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def _refresh(self) -> bool:
+        """
+        Переоткрыть memmap, если meta.json изменился
+
+        Returns:
+            True если хранилище совместимо и открыто
+        """
+        try:
+            stat = os.stat(self._meta_path)
+        except FileNotFoundError:
+            return False
+
+        # meta.json заменяется через os.replace, поэтому у новой версии новый inode
+        mtime = (stat.st_ino, stat.st_mtime_ns)
+        if mtime == self._meta_mtime and self._meta is not None:
+            return True
+
+        with open(self._meta_path) as f:
+            meta = json.load(f)
+        self._disk_generation = meta.get("generation", 0)
+
+        if meta.get("format_version") != self.FORMAT_VERSION or meta.get("signature") != self.signature:
+            return False
+
+        rows = meta["rows"]
+        ids_path, vectors_path = self._data_paths(meta["generation"])
+        if rows:
+            # Обе матрицы открываются до замены: при ошибке остаётся прежнее поколение целиком
+            ids = np.memmap(ids_path, dtype=np.int64, mode="r", shape=(rows,))
+            matrix = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+        else:
+            ids = np.zeros(0, dtype=np.int64)
+            matrix = np.zeros((0, self.dim), dtype=np.float32)
+
+        self._ids, self._matrix = ids, matrix
+        self._meta = meta
+        self._meta_mtime = mtime
+        return True
+
+    def _refresh_for_read(self) -> None:
+        """
+        _refresh для чтения без блокировки записи: компакция в другом воркере могла
+        удалить файлы поколения из прочитанного meta.json - meta перечитывается
+        один раз, при повторной ошибке остаётся уже открытая матрица
+        """
+        for attempt in range(2):
+            try:
+                self._refresh()
+                return
+            except (OSError, ValueError) as e:
+                if attempt:
+                    logger.warning(f"⚠️  Vector store {self.path} refresh failed, using open generation: {e}")
+
+    def open(self) -> bool:
+        """
+        Открыть существующее хранилище (без пересчёта векторов)
+        """
+        with self._lock:
+            try:
+                return self._refresh()
+            except Exception as e:
+                logger.warning(f"⚠️  Vector store {self.path} is unreadable: {e}")
+                return False
+
+    def set_all(self, ids: Sequence[int], matrix: np.ndarray) -> None:
+        """
+        Переписать хранилище целиком в новое поколение файлов
+        """
+        with self._write_lock():
+            self._set_all_unlocked(ids, matrix)
+
+    def _set_all_unlocked(self, ids: Sequence[int], matrix: np.ndarray) -> None:
+        ids = np.asarray(ids, dtype=np.int64)
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32).reshape(len(ids), self.dim)
+
+        self._refresh()
+        old_generation = self._disk_generation
+        generation = old_generation + 1
+
+        ids_path, vectors_path = self._data_paths(generation)
+        with open(ids_path, "wb") as f:
+            f.write(ids.tobytes())
+        with open(vectors_path, "wb") as f:
+            f.write(matrix.tobytes())
+
+        self._write_meta({
+            "format_version": self.FORMAT_VERSION,
+            "signature": self.signature,
+            "generation": generation,
+            "rows": int(len(ids)),
+            "tombstones": 0
+        })
+
+        # Старые файлы можно удалять: открытые memmap держат inode до переоткрытия
+        for old_path in self._data_paths(old_generation):
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+        self._refresh()
+
+    def _tombstone_unlocked(self, qa_id: int) -> int:
+        rows = np.flatnonzero(self._ids == qa_id)
+        if not rows.size:
+            return 0
+
+        ids_path, _ = self._data_paths(self._meta["generation"])
+        tombstone = np.int64(self.TOMBSTONE).tobytes()
+        with open(ids_path, "r+b") as f:
+            for row in rows:
+                f.seek(int(row) * 8)
+                f.write(tombstone)
+        return int(rows.size)
+
+    def upsert(self, qa_id: int, vector: np.ndarray) -> None:
+        """
+        Дописать вектор в конец (старая строка этого ID помечается tombstone)
+        """
+        with self._write_lock():
+            if not self._refresh():
+                return
+
+            meta = dict(self._meta)
+            meta["tombstones"] += self._tombstone_unlocked(qa_id)
+
+            ids_path, vectors_path = self._data_paths(meta["generation"])
+            with open(vectors_path, "ab") as f:
+                f.write(np.ascontiguousarray(vector, dtype=np.float32).reshape(self.dim).tobytes())
+            with open(ids_path, "ab") as f:
+                f.write(np.int64(qa_id).tobytes())
+
+            meta["rows"] += 1
+            self._write_meta(meta)
+            self._refresh()
+            self._maybe_compact()
+
+    def remove(self, qa_id: int) -> None:
+        """
+        Пометить строки ID как удалённые
+        """
+        with self._write_lock():
+            if not self._refresh():
+                return
+
+            removed = self._tombstone_unlocked(qa_id)
+            if removed:
+                meta = dict(self._meta)
+                meta["tombstones"] += removed
+                self._write_meta(meta)
+                self._refresh()
+                self._maybe_compact()
+
+    def _maybe_compact(self) -> None:
+        tombstones = self._meta["tombstones"]
+        if tombstones > 64 and tombstones * 2 > self._meta["rows"]:
+            live = self._ids >= 0
+            self._set_all_unlocked(np.array(self._ids[live]), np.array(self._matrix[live]))
+
+    def live_ids(self) -> set:
+        with self._lock:
+            self._refresh_for_read()
+            return set(np.unique(self._ids[self._ids >= 0]).tolist())
+
+    def search(self, vector: np.ndarray, limit: int = 10) -> List[Tuple[int, float]]:
+        """
+        Cosine top-k по memmap матрице (tombstone строки пропускаются)
+        """
+        with self._lock:
+            self._refresh_for_read()
+            ids, matrix = self._ids, self._matrix
+
+        if not len(ids):
+            return []
+
+        scores = matrix @ vector.astype(np.float32, copy=False)
+        scores[ids < 0] = -np.inf
+
+        limit = min(limit, int((ids >= 0).sum()))
+        if limit <= 0:
+            return []
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+
+        return [(int(ids[i]), float(scores[i])) for i in top]
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            self._refresh_for_read()
+            meta = self._meta or {}
+            return {
+                "ready": self.ready,
+                "path": self.path,
+                "vectors": int((self._ids >= 0).sum()),
+                "rows": meta.get("rows", 0),
+                "tombstones": meta.get("tombstones", 0),
+                "generation": meta.get("generation"),
+                "dim": self.dim,
+                "file_bytes": int(self._matrix.nbytes + self._ids.nbytes)
+            }
+
+    def __len__(self) -> int:
+        return int((self._ids >= 0).sum())
+
+
+# Глобальные backend и индекс (singleton)
+_global_backend = None
+_global_vector_index = None
+
+
+def get_embedding_backend() -> EmbeddingBackend:
+    """
+    Получить backend эмбеддингов, выбранный через EMBEDDING_BACKEND (singleton)
+    Если backend не удалось инициализировать, используется hashing
+    """
+    global _global_backend
+    if _global_backend is None:
+        backend_class = EMBEDDING_BACKENDS.get(EMBEDDING_BACKEND, HashingEmbeddingBackend)
+        try:
+            _global_backend = backend_class()
+        except Exception as e:
+            logger.warning(f"⚠️  Embedding backend '{EMBEDDING_BACKEND}' not available: {e}. Using hashing backend.")
+            _global_backend = HashingEmbeddingBackend()
+        logger.info(f"✅ Embedding backend: {_global_backend.name} (dim={_global_backend.dim})")
+    return _global_backend
+
+
+def get_vector_index():
+    """
+    Получить глобальный векторный индекс (singleton)
+    Если задан EMBEDDING_STORE_DIR - персистентное memmap хранилище,
+    иначе in-memory VectorIndex
+    """
+    global _global_vector_index
+    if _global_vector_index is None:
+        backend = get_embedding_backend()
+        if EMBEDDING_STORE_DIR:
+            _global_vector_index = MemmapVectorStore(
+                EMBEDDING_STORE_DIR,
+                dim=backend.dim,
+                signature=f"{backend.name}:{backend.dim}"
+            )
+        else:
+            _global_vector_index = VectorIndex(backend.dim)
+    return _global_vector_index
+
+
+def get_qa_pair_embedding_text(qa_pair: QAPair) -> str:
+    """
+    Текст QA пары, по которому считается вектор
+    """
+    return qa_pair.question_processed or qa_pair.question or ""
+
+
+def embed_query(query: str) -> np.ndarray:
+    return get_embedding_backend().embed(query)
+
+
+def build_vector_index(db: Session):
+    """
+    Подготовить векторный индекс approved QA пар
+    - Если персистентное хранилище уже есть, оно открывается без пересчёта,
+      досчитываются только недостающие векторы
+    - Иначе считаются векторы всех пар
+    """
+    index = get_vector_index()
+
+    if isinstance(index, MemmapVectorStore):
+        try:
+            if index.open():
+                _reconcile_vector_store(db, index)
+                index.ready = True
+                logger.info(f"✅ Vector store opened: {index.get_stats()}")
+                return index
+        except OSError as e:
+            logger.warning(f"⚠️  Vector store not available: {e}. Using in-memory index.")
+            global _global_vector_index
+            index = _global_vector_index = VectorIndex(index.dim)
+
+    qa_pairs = db.query(QAPair).filter(QAPair.status == QAPairStatus.approved).all()
+    texts = [get_qa_pair_embedding_text(qa) for qa in qa_pairs]
+    matrix = get_embedding_backend().embed_batch(texts) if texts else np.zeros((0, index.dim), dtype=np.float32)
+
+    index.set_all([qa.id for qa in qa_pairs], matrix)
+    index.ready = True
+
+    logger.info(f"✅ Vector index built: {index.get_stats()}")
+    return index
+
+
+def _reconcile_vector_store(db: Session, store: MemmapVectorStore) -> None:
+    """
+    Синхронизировать хранилище с БД: досчитать новые approved пары, убрать лишние
+    """
+    approved_ids = set(
+        qa_id for (qa_id,) in db.query(QAPair.id).filter(QAPair.status == QAPairStatus.approved)
+    )
+    stored_ids = store.live_ids()
+
+    for qa_id in stored_ids - approved_ids:
+        store.remove(qa_id)
+
+    missing_ids = approved_ids - stored_ids
+    if missing_ids:
+        qa_pairs = db.query(QAPair).filter(QAPair.id.in_(missing_ids)).all()
+        vectors = get_embedding_backend().embed_batch([get_qa_pair_embedding_text(qa) for qa in qa_pairs])
+        for qa, vector in zip(qa_pairs, vectors):
+            store.upsert(qa.id, vector)
+
+
+def index_qa_pair_vector(qa_pair: QAPair) -> None:
+    """
+    Пересчитать вектор QA пары (approved) или убрать её из индекса
+    """
+    index = get_vector_index()
+
+    if qa_pair.status == QAPairStatus.approved:
+        index.upsert(qa_pair.id, embed_query(get_qa_pair_embedding_text(qa_pair)))
+    else:
+        index.remove(qa_pair.id)
+
+
+def remove_qa_pair_vector(qa_id: int) -> None:
+    get_vector_index().remove(qa_id)
+
+
+def sync_qa_pair_vector(qa_id: int, qa_pair: Optional[QAPair]) -> None:
+    """
+    QA пару изменил другой воркер (qa_pair=None - удалена): in-memory индекс
+    обновляется, memmap хранилище общее - его уже записал тот воркер,
+    новое поколение перечитывается при поиске
+    """
+    index = get_vector_index()
+    if isinstance(index, MemmapVectorStore) or not index.ready:
+        return
+    if qa_pair is not None:
+        index_qa_pair_vector(qa_pair)
+    else:
+        index.remove(qa_id)
+
+
+def semantic_candidates(
+    query: str,
+    limit: int = 10,
+    min_similarity: float = 0.0,
+    vector: Optional[np.ndarray] = None
+) -> Optional[List[Tuple[int, float]]]:
+    """
+    Top-k кандидатов по cosine similarity
+    vector - уже вычисленный эмбеддинг запроса (иначе считается здесь)
+
+    Returns:
+        список (ID, similarity) или None, если индекс ещё не построен
+    """
+    index = get_vector_index()
+    if not index.ready:
+        return None
+
+    if vector is None:
+        vector = embed_query(query)
+    return [
+        (qa_id, similarity)
+        for qa_id, similarity in index.search(vector, limit=limit)
+        if similarity >= min_similarity
+    ]
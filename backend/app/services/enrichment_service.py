@@ -0,0 +1,109 @@
+"""
+Обработка QA пар через Gemini в фоне (очередь задач jobs)
+- QA пара сохраняется сразу, question_processed/answer_processed пустые
+  до выполнения задачи enrich_qa_pair
+- Задача заполняет обработанные тексты (если их не задали вручную)
+  и заменяет ключевые слова; approved пары переиндексируются,
+  зависимые кэши инвалидируются
+"""
+import logging
+from typing import Any, Dict, List
+
+from sqlalchemy.orm import Session
+
+from app.database import session_scope
+from app.models import QAPair, QAPairStatus, Keyword, Job
+from app.services.cache_service import invalidate_qa_pairs
+from app.services.executor_service import run_blocking
+from app.services.gemini_service import enrich_qa_pairs_async
+from app.services.job_queue_service import enqueue_job, register_job_handler
+from app.services.search_index_service import index_qa_pair
+from app.services.text_processing_service import keyword_lemma
+
+logger = logging.getLogger(__name__)
+
+ENRICH_QA_PAIR_JOB = "enrich_qa_pair"
+
+# Сколько раз повторить обработку, если пару отредактировали во время запроса к Gemini
+MAX_STALE_RETRIES = 3
+
+
+class EnrichmentError(Exception):
+    """Gemini не вернул результат для QA пары"""
+
+
+def enqueue_enrichment(db: Session, qa_pair: QAPair) -> Job:
+    """
+    Поставить QA пару в очередь на обработку (qa_pair должна иметь id - после flush/commit)
+    """
+    return enqueue_job(db, ENRICH_QA_PAIR_JOB, {"qa_pair_id": qa_pair.id})
+
+
+def enqueue_enrichments(db: Session, qa_pair_ids: List[int]) -> List[Job]:
+    """
+    Поставить в очередь QA пары по id (bulk insert без ORM объектов)
+    """
+    return [enqueue_job(db, ENRICH_QA_PAIR_JOB, {"qa_pair_id": qa_pair_id}) for qa_pair_id in qa_pair_ids]
+
+
+def _load_pair(qa_pair_id: int):
+    with session_scope() as db:
+        qa_pair = db.get(QAPair, qa_pair_id)
+        if qa_pair is None:
+            return None
+        return qa_pair.question, qa_pair.answer
+
+
+def save_enrichment(qa_pair_id: int, question: str, answer: str, processed: Dict[str, Any]) -> bool:
+    """
+    Записать результат обработки, если пара не изменилась с момента запроса к Gemini
+
+    Returns:
+        False - пару отредактировали, результат устарел
+    """
+    with session_scope() as db:
+        qa_pair = db.get(QAPair, qa_pair_id)
+        if qa_pair is None:
+            return True
+        if qa_pair.question != question or qa_pair.answer != answer:
+            return False
+
+        if not qa_pair.question_processed:
+            qa_pair.question_processed = processed["question_processed"]
+        if not qa_pair.answer_processed:
+            qa_pair.answer_processed = processed["answer_processed"]
+
+        db.query(Keyword).filter(Keyword.qa_pair_id == qa_pair_id).delete(synchronize_session=False)
+        db.add_all([
+            Keyword(qa_pair_id=qa_pair_id, keyword=keyword, lemma=keyword_lemma(keyword))
+            for keyword in processed["keywords"]
+        ])
+        db.commit()
+
+        if qa_pair.status == QAPairStatus.approved:
+            db.refresh(qa_pair)
+            index_qa_pair(qa_pair)
+            invalidate_qa_pairs([qa_pair_id])
+        return True
+
+
+async def enrich_qa_pair_job(payload: Dict[str, Any]) -> None:
+    qa_pair_id = payload["qa_pair_id"]
+    for _ in range(MAX_STALE_RETRIES):
+        pair = await run_blocking(_load_pair, qa_pair_id)
+        if pair is None:
+            logger.info(f"QA pair {qa_pair_id} no longer exists, skipping enrichment")
+            return
+
+        question, answer = pair
+        results: List = await enrich_qa_pairs_async([(question, answer)])
+        if not results or results[0] is None:
+            raise EnrichmentError(f"No enrichment result for QA pair {qa_pair_id}")
+
+        if await run_blocking(save_enrichment, qa_pair_id, question, answer, results[0]):
+            return
+
+    raise EnrichmentError(f"QA pair {qa_pair_id} kept changing during enrichment")
+
+
+register_job_handler(ENRICH_QA_PAIR_JOB, enrich_qa_pair_job)
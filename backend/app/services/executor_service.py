@@ -0,0 +1,54 @@
+"""
+Ограниченный пул потоков для блокирующей работы из async кода
+- Синхронные запросы SQLAlchemy и CPU-bound обработка текста (лемматизация)
+  выполняются вне event loop
+- Размер пула ограничен (BLOCKING_WORKERS), чтобы тяжёлые запросы не
+  вытесняли остальные обработчики из общего threadpool FastAPI
+"""
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "8"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Получить глобальный пул потоков (singleton)
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=BLOCKING_WORKERS,
+                    thread_name_prefix="blocking"
+                )
+    return _executor
+
+
+async def run_blocking(func: Callable, *args, **kwargs) -> Any:
+    """
+    Выполнить блокирующую функцию в ограниченном пуле и дождаться результата
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def shutdown_executor() -> None:
+    """
+    Остановить пул (при завершении приложения)
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -1,115 +1,317 @@
 import google.generativeai as genai
+import asyncio
 import os
-from typing import Dict, List, Optional
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
 from dotenv import load_dotenv
-from app.services.rate_limiter_service import get_rate_limiter
+from app.services.rate_limiter_service import get_rate_limiter, estimate_tokens
+from app.services.response_parser_service import Field, ResponseParseError, get_response_parser
+from app.services.context_packing_service import (
+    SEMANTIC_CONTEXT_ANSWER_TOKENS, SEMANTIC_CONTEXT_TOKEN_BUDGET, PackedContext, pack_context, record_prompt
+)
 
 load_dotenv()
 
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
 # Инициализация rate limiter для Gemini API
-# 10 RPM для Gemini 2.0 Flash free tier
-rate_limiter = get_rate_limiter(rpm=10)
+# 10 RPM для Gemini 2.0 Flash free tier (GEMINI_RPM)
+rate_limiter = get_rate_limiter()
 
-def process_qa_pair(question: str, answer: str) -> Dict[str, str]:
-    model = genai.GenerativeModel('gemini-2.0-flash-exp')
-    
-    prompt = f"""Обработай следующий вопрос и ответ для базы знаний финансового менеджера.
+# Пакетная обработка QA пар: максимум пар в одном промпте и бюджет токенов пакета
+# (промпт + ожидаемый ответ, ответ модели ограничен ~8K токенов)
+QA_BATCH_MAX_PAIRS = int(os.getenv("QA_BATCH_MAX_PAIRS", "10"))
+QA_BATCH_TOKEN_BUDGET = int(os.getenv("QA_BATCH_TOKEN_BUDGET", "6000"))
+QA_BATCH_PROMPT_OVERHEAD = 250
+QA_BATCH_ITEM_OVERHEAD = 60
+
+QA_BATCH_PARSER = get_response_parser("qa_batch", Field("array", items=Field("object", properties={
+    "id": Field("integer", required=True),
+    "question": Field("string", default=""),
+    "answer": Field("string", default=""),
+    "keywords": Field("array", items=Field("string"), default=list)
+})))
 
-Вопрос: {question}
-Ответ: {answer}
+SEMANTIC_SEARCH_PARSER = get_response_parser("semantic_search", Field("object", properties={
+    "found": Field("boolean", default=False),
+    "matches": Field("array", default=list, items=Field("object", properties={
+        "id": Field("integer", required=True),
+        "similarity": Field("number", default=0.0, minimum=0.0, maximum=1.0),
+        "reason": Field("string", default="")
+    }))
+}))
+
+def _build_qa_batch_prompt(pairs: List[Tuple[str, str]]) -> str:
+    items = "\n\n".join([
+        f"ID {i+1}:\nВопрос: {question}\nОтвет: {answer}"
+        for i, (question, answer) in enumerate(pairs)
+    ])
 
-Выполни следующие задачи:
+    return f"""Обработай следующие вопросы и ответы для базы знаний финансового менеджера.
+
+{items}
+
+Для КАЖДОЙ пары:
 1. Улучши формулировку вопроса, сделав его более понятным и структурированным
 2. Улучши формулировку ответа, сделав его более четким и профессиональным
-3. Извлеки 5-10 ключевых слов или фраз для поиска (каждое на новой строке, без нумерации)
-
-Верни ответ в формате:
-ВОПРОС_ОБРАБОТАННЫЙ: [улучшенный вопрос]
-ОТВЕТ_ОБРАБОТАННЫЙ: [улучшенный ответ]
-КЛЮЧЕВЫЕ_СЛОВА:
-[список ключевых слов, каждое на новой строке]
-"""
-    
+3. Извлеки 5-10 ключевых слов или фраз для поиска
+
+ФОРМАТ ОТВЕТА (верни ТОЛЬКО валидный JSON, по одному элементу на каждый ID):
+[
+  {{"id": 1, "question": "улучшенный вопрос", "answer": "улучшенный ответ", "keywords": ["слово", "фраза"]}}
+]
+
+Верни только JSON, без дополнительного текста."""
+
+def _parse_qa_batch_response(response_text: str, pairs: List[Tuple[str, str]]) -> List[Optional[Dict]]:
+    """
+    Разобрать ответ на пакетный промпт
+    None - для пар, которых нет в ответе (или их элемент не прошёл проверку)
+    """
+    results: List[Optional[Dict]] = [None] * len(pairs)
+
     try:
-        response = model.generate_content(prompt)
-        text = response.text
-        
-        result = {
-            "question_processed": question,
-            "answer_processed": answer,
-            "keywords": []
-        }
-        
-        lines = text.split('\n')
-        current_section = None
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            if 'ВОПРОС_ОБРАБОТАННЫЙ:' in line or 'ВОПРОС ОБРАБОТАННЫЙ:' in line:
-                current_section = 'question'
-                result["question_processed"] = line.split(':', 1)[-1].strip()
-            elif 'ОТВЕТ_ОБРАБОТАННЫЙ:' in line or 'ОТВЕТ ОБРАБОТАННЫЙ:' in line:
-                current_section = 'answer'
-                result["answer_processed"] = line.split(':', 1)[-1].strip()
-            elif 'КЛЮЧЕВЫЕ_СЛОВА:' in line or 'КЛЮЧЕВЫЕ СЛОВА:' in line:
-                current_section = 'keywords'
-            elif current_section == 'question' and line:
-                result["question_processed"] = line
-            elif current_section == 'answer' and line:
-                result["answer_processed"] = line
-            elif current_section == 'keywords' and line:
-                keyword = line.strip().lstrip('- ').lstrip('* ').strip()
-                if keyword:
-                    result["keywords"].append(keyword)
-        
-        if not result["question_processed"] or result["question_processed"] == question:
-            result["question_processed"] = question
-        if not result["answer_processed"] or result["answer_processed"] == answer:
-            result["answer_processed"] = answer
-            
-        return result
-    except Exception as e:
-        return {
-            "question_processed": question,
-            "answer_processed": answer,
-            "keywords": []
+        items = QA_BATCH_PARSER.parse(response_text)
+    except ResponseParseError:
+        return results
+
+    for item in items:
+        idx = item["id"] - 1
+        if not 0 <= idx < len(pairs) or results[idx] is not None:
+            continue
+
+        question, answer = pairs[idx]
+        results[idx] = {
+            "question_processed": item["question"] or question,
+            "answer_processed": item["answer"] or answer,
+            "keywords": [
+                keyword for keyword in (k.lstrip('- ').lstrip('* ').strip() for k in item["keywords"])
+                if keyword
+            ]
         }
 
-def process_voice_to_text(audio_data: bytes) -> str:
+    return results
+
+async def enrich_qa_pairs_async(pairs: List[Tuple[str, str]]) -> List[Optional[Dict]]:
+    """
+    Обработать несколько QA пар одним запросом к Gemini (через rate limiter)
+
+    Returns:
+        результаты в порядке pairs, None - пара не разобрана в ответе
+    Raises:
+        ошибки Gemini API / квоты (для повторов в очереди задач)
+    """
+    if not pairs:
+        return []
+
+    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    prompt = _build_qa_batch_prompt(pairs)
+    response = await rate_limiter.acall(
+        model.generate_content_async, prompt,
+        generation_config=QA_BATCH_PARSER.generation_config, tokens=estimate_tokens(prompt)
+    )
     try:
-        model = genai.GenerativeModel('gemini-2.0-flash-exp')
-        
-        prompt = """Распознай речь из этого аудио файла и верни текст. Если это вопрос и ответ, раздели их на две части: ВОПРОС: и ОТВЕТ:"""
-        
+        text = response.text
+    except ValueError as e:
+        # Ответ без текста (обрезан по лимиту / заблокирован) - как неразобранный
+        print(f"QA batch empty response: {e}")
+        return [None] * len(pairs)
+    return _parse_qa_batch_response(text, pairs)
+
+def estimate_pair_tokens(question: str, answer: str) -> int:
+    """
+    Оценка токенов пары в пакете: текст в промпте + переписанный текст
+    и ключевые слова в ответе
+    """
+    return 2 * estimate_tokens(question + answer) + QA_BATCH_ITEM_OVERHEAD
+
+def plan_qa_batches(
+    pairs: List[Tuple[str, str]],
+    max_pairs: int,
+    token_budget: int = QA_BATCH_TOKEN_BUDGET
+) -> List[List[int]]:
+    """
+    Разбить пары на пакеты (индексы) по max_pairs пар, не превышая token_budget
+    Пара больше бюджета уходит отдельным пакетом
+    """
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = QA_BATCH_PROMPT_OVERHEAD
+
+    for idx, (question, answer) in enumerate(pairs):
+        tokens = estimate_pair_tokens(question, answer)
+        if current and (len(current) >= max_pairs or current_tokens + tokens > token_budget):
+            batches.append(current)
+            current, current_tokens = [], QA_BATCH_PROMPT_OVERHEAD
+        current.append(idx)
+        current_tokens += tokens
+
+    if current:
+        batches.append(current)
+    return batches
+
+class AdaptiveBatchLimit:
+    """
+    Адаптивный размер пакета: уменьшается вдвое, когда пакет пришлось делить,
+    растёт на 1 после полностью разобранного пакета (до QA_BATCH_MAX_PAIRS)
+    """
+
+    def __init__(self, max_pairs: int = QA_BATCH_MAX_PAIRS):
+        self.max_pairs = max(1, max_pairs)
+        self.current = self.max_pairs
+        self.splits = 0
+        self.batches = 0
+        self.lock = threading.Lock()
+
+    def on_success(self) -> None:
+        with self.lock:
+            self.batches += 1
+            self.current = min(self.max_pairs, self.current + 1)
+
+    def on_split(self, size: int) -> None:
+        with self.lock:
+            self.splits += 1
+            self.current = max(1, min(self.current, size // 2))
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            return {
+                "max_pairs": self.max_pairs,
+                "current_pairs": self.current,
+                "token_budget": QA_BATCH_TOKEN_BUDGET,
+                "batches": self.batches,
+                "splits": self.splits
+            }
+
+batch_limit = AdaptiveBatchLimit()
+
+async def _enrich_with_bisection(pairs: List[Tuple[str, str]]) -> List[Optional[Dict]]:
+    """
+    Пакетный запрос; неразобранные пары запрашиваются повторно половинами,
+    пока не останутся одиночные
+    """
+    results = await enrich_qa_pairs_async(pairs)
+    missing = [idx for idx, result in enumerate(results) if result is None]
+    if not missing:
+        batch_limit.on_success()
+        return results
+    if len(pairs) == 1:
+        return results
+
+    batch_limit.on_split(len(pairs))
+    retry = missing if len(missing) < len(pairs) else list(range(len(pairs)))
+    if len(retry) > 1:
+        middle = len(retry) // 2
+        halves = [retry[:middle], retry[middle:]]
+    else:
+        halves = [retry]
+
+    for half in halves:
         try:
-            response = model.generate_content([prompt, {"mime_type": "audio/mpeg", "data": audio_data}])
-            return response.text
-        except:
-            return "ВОПРОС: [Распознавание голоса временно недоступно]\nОТВЕТ: [Пожалуйста, используйте текстовый ввод]"
+            sub_results = await _enrich_with_bisection([pairs[idx] for idx in half])
+        except Exception as e:
+            print(f"QA batch processing error ({len(half)} pairs): {e}")
+            continue
+        for idx, result in zip(half, sub_results):
+            results[idx] = result
+    return results
+
+async def enrich_qa_pairs_adaptive_async(pairs: List[Tuple[str, str]]) -> List[Optional[Dict]]:
+    """
+    Обработать любое количество QA пар: пакеты по адаптивному размеру и бюджету
+    токенов, выполняются конкурентно (не больше max_concurrent rate limiter)
+
+    Returns:
+        результаты в порядке pairs, None - пара не обработана (ошибка API для её пакета
+        или не разобралась даже отдельным запросом)
+    """
+    results: List[Optional[Dict]] = [None] * len(pairs)
+    semaphore = asyncio.Semaphore(rate_limiter.max_concurrent)
+
+    async def process(batch: List[int]) -> None:
+        async with semaphore:
+            try:
+                batch_results = await _enrich_with_bisection([pairs[idx] for idx in batch])
+            except Exception as e:
+                print(f"QA batch processing error ({len(batch)} pairs): {e}")
+                return
+        for idx, result in zip(batch, batch_results):
+            results[idx] = result
+
+    await asyncio.gather(*[process(batch) for batch in plan_qa_batches(pairs, batch_limit.current)])
+    return results
+
+VOICE_QA_PROMPT = """Распознай речь из этого аудио файла и верни текст. Если это вопрос и ответ, раздели их на две части: ВОПРОС: и ОТВЕТ:"""
+
+VOICE_TRANSCRIBE_PROMPT = """Распознай речь из этого фрагмента аудио и верни только распознанный текст, без пояснений."""
+
+class VoiceTranscriptionError(Exception):
+    """Gemini не распознал запись (ошибка API)"""
+
+async def transcribe_audio_async(audio_data: bytes, mime_type: str, split_qa: bool = True) -> str:
+    """
+    Распознать аудио через rate limiter
+    split_qa=True - сразу разделить на ВОПРОС:/ОТВЕТ:, False - только текст (сегмент записи)
+
+    Raises:
+        VoiceTranscriptionError: ошибка Gemini
+    """
+    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    prompt = VOICE_QA_PROMPT if split_qa else VOICE_TRANSCRIBE_PROMPT
+
+    try:
+        response = await rate_limiter.acall(
+            model.generate_content_async,
+            [prompt, {"mime_type": mime_type, "data": audio_data}],
+            tokens=estimate_tokens(prompt) + len(audio_data) // 1000
+        )
+        return response.text
     except Exception as e:
-        raise Exception(f"Ошибка обработки голоса: {str(e)}")
+        print(f"Voice transcription error: {e}")
+        raise VoiceTranscriptionError(f"Ошибка распознавания голоса: {str(e)}")
 
-def semantic_search(query: str, qa_pairs: List[Dict]) -> List[Dict]:
+async def split_transcript_async(text: str) -> str:
     """
-    Улучшенный семантический поиск с использованием Gemini 2.0 Flash
-    - Убран лимит на количество QA пар
-    - Структурированный JSON ответ
-    - Оценка релевантности для каждого результата
+    Разделить распознанный текст длинной записи на ВОПРОС: и ОТВЕТ:
     """
     model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    prompt = f"""Это расшифровка голосовой записи для базы знаний финансового менеджера.
+Если в ней есть вопрос и ответ, раздели текст на две части: ВОПРОС: и ОТВЕТ:
+Сохрани формулировки, ничего не добавляй.
+
+РАСШИФРОВКА:
+{text}"""
+
+    try:
+        response = await rate_limiter.acall(model.generate_content_async, prompt, tokens=estimate_tokens(prompt))
+        return response.text
+    except Exception as e:
+        print(f"Transcript split error: {e}")
+        return text
+
+def _pack_semantic_context(qa_pairs: List[Dict]) -> Tuple[PackedContext, List[Dict]]:
+    """
+    Пары в порядке релевантности в пределах SEMANTIC_CONTEXT_TOKEN_BUDGET
 
-    # Форматируем все QA пары (без лимита)
+    Returns:
+        (упакованный контекст, пары, попавшие в промпт - по ним разбирается ответ)
+    """
+    packed = pack_context(
+        "semantic_search",
+        [(qa.get("id"), qa["question"], qa["answer"]) for qa in qa_pairs],
+        SEMANTIC_CONTEXT_TOKEN_BUDGET,
+        SEMANTIC_CONTEXT_ANSWER_TOKENS
+    )
+    return packed, [qa_pairs[index] for index in packed.indices]
+
+def _build_semantic_search_prompt(query: str, packed: PackedContext) -> str:
     context = "\n\n".join([
-        f"ID {i+1}:\nВопрос: {qa['question']}\nОтвет: {qa['answer']}"
-        for i, qa in enumerate(qa_pairs)
+        f"ID {i+1}:\nВопрос: {entry.question}\nОтвет: {entry.answer}"
+        for i, entry in enumerate(packed.entries)
     ])
 
-    prompt = f"""Ты - система семантического поиска для финансовой базы знаний компании.
+    return f"""Ты - система семантического поиска для финансовой базы знаний компании.
 
 ЗАДАЧА: Найди наиболее релевантные вопросы из базы знаний, которые отвечают на вопрос пользователя.
 
@@ -141,60 +343,70 @@ def semantic_search(query: str, qa_pairs: List[Dict]) -> List[Dict]:
 
 Верни только JSON, без дополнительного текста."""
 
+def _parse_semantic_search_response(response_text: str, qa_pairs: List[Dict]) -> List[Dict]:
+    """
+    Пары из ответа в порядке убывания similarity
+    Неразобранный ответ - пустой результат (id из текста не угадываются)
+    """
     try:
-        # Используем rate limiter для соблюдения API limits
-        def make_request():
-            return model.generate_content(prompt)
-
-        response = rate_limiter.call(make_request)
-        text = response.text.strip()
+        result = SEMANTIC_SEARCH_PARSER.parse(response_text)
+    except ResponseParseError:
+        return []
 
-        # Убираем markdown code blocks если есть
-        if text.startswith("```json"):
-            text = text.replace("```json", "").replace("```", "").strip()
-        elif text.startswith("```"):
-            text = text.replace("```", "").strip()
+    if not result["found"]:
+        return []
 
-        # Парсим JSON
-        import json
-        result = json.loads(text)
+    matched_pairs = []
+    seen = set()
+    for match in sorted(result["matches"], key=lambda match: -match["similarity"]):
+        idx = match["id"] - 1  # ID начинается с 1
+        if 0 <= idx < len(qa_pairs) and idx not in seen:
+            seen.add(idx)
+            matched_pairs.append(qa_pairs[idx])
 
-        if not result.get("found", False) or not result.get("matches"):
-            return []
+    return matched_pairs
 
-        # Собираем результаты, отсортированные по similarity
-        matched_pairs = []
-        for match in result["matches"]:
-            idx = match["id"] - 1  # ID начинается с 1
-            if 0 <= idx < len(qa_pairs):
-                matched_pairs.append(qa_pairs[idx])
+def semantic_search(query: str, qa_pairs: List[Dict]) -> List[Dict]:
+    """
+    Улучшенный семантический поиск с использованием Gemini 2.0 Flash
+    - Структурированный JSON ответ
+    - Оценка релевантности для каждого результата
+    - qa_pairs - в порядке релевантности: в промпт попадают первые пары
+      в пределах SEMANTIC_CONTEXT_TOKEN_BUDGET, длинные ответы сокращаются
+    """
+    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    packed, qa_pairs = _pack_semantic_context(qa_pairs)
+    prompt = _build_semantic_search_prompt(query, packed)
 
-        return matched_pairs
+    try:
+        # Используем rate limiter для соблюдения API limits
+        def make_request():
+            return model.generate_content(prompt, generation_config=SEMANTIC_SEARCH_PARSER.generation_config)
 
-    except json.JSONDecodeError as e:
-        # Fallback: если JSON не распарсился, попробуем старый метод
-        print(f"JSON parse error: {e}. Trying fallback parsing...")
-        try:
-            text = response.text.lower()
-            if "нет совпадений" in text or "не найдено" in text or '"found": false' in text:
-                return []
-
-            # Ищем числа в ответе
-            import re
-            numbers = re.findall(r'"id":\s*(\d+)', text)
-            if not numbers:
-                numbers = re.findall(r'\b(\d+)\b', text)
-
-            indices = []
-            for num in numbers:
-                idx = int(num) - 1
-                if 0 <= idx < len(qa_pairs):
-                    indices.append(idx)
-
-            return [qa_pairs[i] for i in indices[:10]]  # Топ-10
-        except:
-            return []
+        started = time.perf_counter()
+        response = rate_limiter.call(make_request, tokens=estimate_tokens(prompt))
+        record_prompt("semantic_search", prompt, started)
+        return _parse_semantic_search_response(response.text, qa_pairs)
     except Exception as e:
         print(f"Semantic search error: {e}")
         return []
 
+async def semantic_search_async(query: str, qa_pairs: List[Dict]) -> List[Dict]:
+    """
+    Async версия semantic_search: ожидание квоты и ответа Gemini не блокирует event loop
+    """
+    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    packed, qa_pairs = _pack_semantic_context(qa_pairs)
+    prompt = _build_semantic_search_prompt(query, packed)
+
+    try:
+        started = time.perf_counter()
+        response = await rate_limiter.acall(
+            model.generate_content_async, prompt,
+            generation_config=SEMANTIC_SEARCH_PARSER.generation_config, tokens=estimate_tokens(prompt)
+        )
+        record_prompt("semantic_search", prompt, started)
+        return _parse_semantic_search_response(response.text, qa_pairs)
+    except Exception as e:
+        print(f"Semantic search error: {e}")
+        return []
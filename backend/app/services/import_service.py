@@ -0,0 +1,321 @@
+"""
+Потоковый импорт QA пар из CSV/Excel фоновой задачей
+- Файл сохраняется во временный файл и читается чанками (IMPORT_CHUNK_SIZE строк),
+  целиком в память не загружается
+- Несколько пар обрабатываются одним промптом Gemini (адаптивный размер пакета,
+  QA_BATCH_MAX_PAIRS / QA_BATCH_TOKEN_BUDGET), пакеты чанка выполняются
+  конкурентно в пределах квоты rate limiter
+- Строки пишутся bulk insert'ами QAPair + Keyword, один commit на чанк;
+  запись чанка идёт параллельно с обработкой следующего
+- Пары, которые Gemini не обработал, сохраняются без обработанных текстов
+  и в том же commit ставятся в очередь enrich_qa_pair (enrichment_service)
+- Прогресс и статус задачи - в in-memory реестре (get_import_job)
+"""
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+from dotenv import load_dotenv
+from sqlalchemy import insert
+
+from app.database import session_scope
+from app.models import QAPair, QAPairStatus, Keyword
+from app.services.executor_service import run_blocking
+from app.services.enrichment_service import enqueue_enrichments
+from app.services.gemini_service import enrich_qa_pairs_adaptive_async
+from app.services.job_queue_service import notify_job_workers
+from app.services.text_processing_service import keyword_lemma
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "200"))
+IMPORT_JOBS_KEEP = int(os.getenv("IMPORT_JOBS_KEEP", "50"))
+
+SUPPORTED_EXTENSIONS = ('.csv', '.xlsx', '.xls')
+REQUIRED_COLUMNS = ('question', 'answer')
+
+
+class ImportFileError(Exception):
+    """Файл нельзя импортировать (формат, колонки)"""
+
+
+class ImportJob:
+    """
+    Состояние одной задачи импорта
+    """
+
+    def __init__(self, filename: str):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.status = "queued"
+        self.rows_read = 0
+        self.imported = 0
+        self.skipped = 0
+        self.enriched = 0
+        self.ids: List[int] = []
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "failed")
+
+    def to_dict(self, include_ids: bool = True) -> Dict:
+        elapsed = None
+        if self.started_at:
+            elapsed = round((self.finished_at or time.time()) - self.started_at, 2)
+        result = {
+            "job_id": self.id,
+            "filename": self.filename,
+            "status": self.status,
+            "rows_read": self.rows_read,
+            "imported": self.imported,
+            "skipped": self.skipped,
+            "enriched": self.enriched,
+            "elapsed_seconds": elapsed,
+            "rows_per_second": round(self.imported / elapsed, 2) if elapsed else None,
+            "error": self.error
+        }
+        if include_ids:
+            result["ids"] = self.ids
+        return result
+
+
+_jobs: "OrderedDict[str, ImportJob]" = OrderedDict()
+_jobs_lock = threading.Lock()
+
+
+def create_import_job(filename: str) -> ImportJob:
+    """
+    Зарегистрировать новую задачу (старые завершённые вытесняются сверх IMPORT_JOBS_KEEP)
+    """
+    job = ImportJob(filename)
+    with _jobs_lock:
+        _jobs[job.id] = job
+        finished = [job_id for job_id, existing in _jobs.items() if existing.finished]
+        for job_id in finished[:max(0, len(_jobs) - IMPORT_JOBS_KEEP)]:
+            del _jobs[job_id]
+    return job
+
+
+def get_import_job(job_id: str) -> Optional[ImportJob]:
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def list_import_jobs() -> List[ImportJob]:
+    with _jobs_lock:
+        return list(reversed(_jobs.values()))
+
+
+def _read_columns(path: str) -> List[str]:
+    if path.endswith('.csv'):
+        return list(pd.read_csv(path, nrows=0).columns)
+    return list(pd.read_excel(path, nrows=0).columns)
+
+
+def validate_import_file(filename: str, path: str) -> None:
+    """
+    Проверить расширение и наличие колонок question/answer (читается только заголовок)
+
+    Raises:
+        ImportFileError: файл нельзя импортировать
+    """
+    if not filename.endswith(SUPPORTED_EXTENSIONS):
+        raise ImportFileError("Поддерживаются только CSV и Excel файлы")
+    try:
+        columns = _read_columns(path)
+    except Exception as e:
+        raise ImportFileError(f"Ошибка обработки файла: {str(e)}")
+    if not all(column in columns for column in REQUIRED_COLUMNS):
+        raise ImportFileError("Файл должен содержать колонки 'question' и 'answer'")
+
+
+def _iter_excel_chunks(path: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    Excel чанками: .xlsx через openpyxl в read_only режиме (строки читаются потоком),
+    .xls (xlrd) читается целиком и режется на чанки
+    """
+    if not path.endswith('.xlsx'):
+        df = pd.read_excel(path)
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start + chunk_size]
+        return
+
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(cell) if cell is not None else "" for cell in next(rows, ())]
+        chunk = []
+        for row in rows:
+            chunk.append(row[:len(header)])
+            if len(chunk) >= chunk_size:
+                yield pd.DataFrame(chunk, columns=header)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=header)
+    finally:
+        workbook.close()
+
+
+def iter_chunks(path: str, chunk_size: int = IMPORT_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    if path.endswith('.csv'):
+        yield from pd.read_csv(path, chunksize=chunk_size)
+    else:
+        yield from _iter_excel_chunks(path, chunk_size)
+
+
+def _cell(value) -> Optional[str]:
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    text = str(value).strip()
+    return text or None
+
+
+def _chunk_rows(df: pd.DataFrame) -> Tuple[List[Dict], int]:
+    """
+    Строки чанка с непустыми question/answer
+
+    Returns:
+        (строки, количество пропущенных)
+    """
+    rows = []
+    has_submitter = 'submitted_by' in df.columns
+    for record in df.to_dict('records'):
+        question, answer = _cell(record.get('question')), _cell(record.get('answer'))
+        if not question or not answer:
+            continue
+        rows.append({
+            "question": question,
+            "answer": answer,
+            "submitted_by": _cell(record.get('submitted_by')) if has_submitter else None
+        })
+    return rows, len(df) - len(rows)
+
+
+def _next_chunk(chunks: Iterator[pd.DataFrame]) -> Optional[pd.DataFrame]:
+    return next(chunks, None)
+
+
+async def enrich_rows(rows: List[Dict]) -> List[Optional[Dict]]:
+    """
+    Обработать строки через Gemini пакетами (размер пакета - адаптивный,
+    см. gemini_service.plan_qa_batches); None - строка не обработана
+    """
+    return await enrich_qa_pairs_adaptive_async([(row["question"], row["answer"]) for row in rows])
+
+
+def insert_qa_pairs(rows: List[Dict], processed: List[Optional[Dict]]) -> List[int]:
+    """
+    Bulk insert QA пар (status=pending) и их ключевых слов, один commit
+    Необработанные пары (None) остаются без обработанных текстов и ставятся
+    в очередь enrich_qa_pair в той же транзакции
+
+    Returns:
+        id созданных QA пар в порядке rows
+    """
+    if not rows:
+        return []
+
+    qa_rows = [
+        {
+            "question": row["question"],
+            "answer": row["answer"],
+            "question_processed": result["question_processed"] if result else None,
+            "answer_processed": result["answer_processed"] if result else None,
+            "submitted_by": row["submitted_by"],
+            "status": QAPairStatus.pending
+        }
+        for row, result in zip(rows, processed)
+    ]
+
+    with session_scope() as db:
+        try:
+            ids = db.scalars(
+                insert(QAPair).returning(QAPair.id, sort_by_parameter_order=True),
+                qa_rows
+            ).all()
+            keyword_rows = [
+                {"qa_pair_id": qa_pair_id, "keyword": keyword, "lemma": keyword_lemma(keyword)}
+                for qa_pair_id, result in zip(ids, processed) if result
+                for keyword in result["keywords"]
+            ]
+            if keyword_rows:
+                db.execute(insert(Keyword), keyword_rows)
+            unprocessed = [qa_pair_id for qa_pair_id, result in zip(ids, processed) if result is None]
+            enqueue_enrichments(db, unprocessed)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    if unprocessed:
+        notify_job_workers()
+    return list(ids)
+
+
+async def run_import_job(job: ImportJob, path: str) -> None:
+    """
+    Выполнить импорт: чтение чанка -> пакетная обработка Gemini -> bulk insert
+    Запись чанка N выполняется, пока обрабатывается чанк N+1
+    """
+    job.status = "running"
+    job.started_at = time.time()
+    pending_insert: Optional[asyncio.Future] = None
+
+    async def wait_insert() -> None:
+        nonlocal pending_insert
+        if pending_insert is not None:
+            insert_future, pending_insert = pending_insert, None
+            ids = await insert_future
+            job.ids.extend(ids)
+            job.imported += len(ids)
+
+    try:
+        chunks = iter_chunks(path)
+        while True:
+            df = await run_blocking(_next_chunk, chunks)
+            if df is None:
+                break
+            rows, skipped = _chunk_rows(df)
+            job.rows_read += len(df)
+            job.skipped += skipped
+
+            processed = await enrich_rows(rows)
+            job.enriched += sum(1 for result in processed if result)
+
+            await wait_insert()
+            pending_insert = asyncio.ensure_future(run_blocking(insert_qa_pairs, rows, processed))
+
+        await wait_insert()
+        job.status = "completed"
+        logger.info(
+            f"✅ Import {job.id} ({job.filename}): {job.imported} imported, "
+            f"{job.skipped} skipped in {time.time() - job.started_at:.1f}s"
+        )
+    except Exception as e:
+        try:
+            await wait_insert()
+        except Exception:
+            pass
+        job.status = "failed"
+        job.error = str(e)
+        logger.error(f"❌ Import {job.id} ({job.filename}) failed after {job.imported} rows: {e}")
+    finally:
+        job.finished_at = time.time()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
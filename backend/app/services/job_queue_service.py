@@ -0,0 +1,342 @@
+"""
+Персистентная очередь фоновых задач в таблице jobs (SQLite и PostgreSQL)
+- enqueue_job добавляет задачу в сессию вызывающего: задача коммитится
+  вместе с данными, для которых она создана
+- Захват задачи - compare-and-swap UPDATE ... WHERE status = 'pending'
+  (без SELECT FOR UPDATE, работает на обеих БД и с несколькими процессами)
+- Повторы с экспоненциальной задержкой, после max_attempts задача
+  переходит в dead (dead-letter) и ждёт ручного retry через /api/jobs
+- Задачи, зависшие в running дольше JOB_LOCK_TIMEOUT (упавший процесс),
+  возвращаются в очередь
+- JOB_WORKERS async воркеров на процесс; запросы к БД - в пуле run_blocking
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from dotenv import load_dotenv
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.database import session_scope
+from app.models import Job, JobStatus
+from app.services.executor_service import run_blocking
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "2"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "30"))
+JOB_RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "3600"))
+JOB_LOCK_TIMEOUT = int(os.getenv("JOB_LOCK_TIMEOUT", "600"))
+
+# Сколько готовых задач просматривать за одну попытку захвата
+CLAIM_CANDIDATES = 5
+MAX_ERROR_LENGTH = 2000
+
+JobHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+_handlers: Dict[str, JobHandler] = {}
+_worker_tasks: List[asyncio.Task] = []
+_wakeup: Optional[asyncio.Event] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+_stats_lock = threading.Lock()
+_stats = {"processed": 0, "failed": 0, "dead": 0, "requeued_stale": 0}
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def register_job_handler(kind: str, handler: JobHandler) -> None:
+    """
+    Зарегистрировать обработчик задач вида kind: async handler(payload)
+    Исключение в обработчике - повтор задачи (или dead после max_attempts)
+    """
+    _handlers[kind] = handler
+
+
+def enqueue_job(
+    db: Session,
+    kind: str,
+    payload: Optional[Dict[str, Any]] = None,
+    max_attempts: int = JOB_MAX_ATTEMPTS,
+    delay: float = 0
+) -> Job:
+    """
+    Добавить задачу в сессию (коммит - за вызывающим, затем notify_job_workers)
+    """
+    job = Job(
+        kind=kind,
+        payload=json.dumps(payload or {}, ensure_ascii=False),
+        status=JobStatus.pending,
+        attempts=0,
+        max_attempts=max_attempts,
+        run_after=utcnow() + timedelta(seconds=delay)
+    )
+    db.add(job)
+    return job
+
+
+def notify_job_workers() -> None:
+    """
+    Разбудить воркеры, не дожидаясь JOB_POLL_INTERVAL (можно вызывать из любого потока)
+    """
+    if _loop is not None and _wakeup is not None and not _loop.is_closed():
+        _loop.call_soon_threadsafe(_wakeup.set)
+
+
+def retry_delay(attempts: int) -> float:
+    """
+    Задержка перед повтором: base, 2*base, 4*base ... (не больше JOB_RETRY_MAX_SECONDS)
+    """
+    return min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** max(0, attempts - 1))
+
+
+def claim_job(worker_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Захватить готовую к выполнению задачу
+
+    Returns:
+        {"id", "kind", "payload", "attempts"} или None, если задач нет
+    """
+    now = utcnow()
+    with session_scope() as db:
+        candidates = db.query(Job.id).filter(
+            Job.status == JobStatus.pending,
+            Job.run_after <= now
+        ).order_by(Job.run_after, Job.id).limit(CLAIM_CANDIDATES).all()
+
+        for (job_id,) in candidates:
+            claimed = db.query(Job).filter(
+                Job.id == job_id,
+                Job.status == JobStatus.pending
+            ).update({
+                Job.status: JobStatus.running,
+                Job.locked_by: worker_id,
+                Job.locked_at: now,
+                Job.attempts: Job.attempts + 1
+            }, synchronize_session=False)
+            db.commit()
+
+            if claimed:
+                job = db.get(Job, job_id)
+                return {
+                    "id": job.id,
+                    "kind": job.kind,
+                    "payload": json.loads(job.payload or "{}"),
+                    "attempts": job.attempts,
+                    "max_attempts": job.max_attempts
+                }
+    return None
+
+
+def _finish_job(job_id: int, worker_id: str, values: Dict) -> None:
+    with session_scope() as db:
+        db.query(Job).filter(
+            Job.id == job_id,
+            Job.status == JobStatus.running,
+            Job.locked_by == worker_id
+        ).update({**values, Job.locked_by: None, Job.locked_at: None}, synchronize_session=False)
+        db.commit()
+
+
+def complete_job(job_id: int, worker_id: str) -> None:
+    _finish_job(job_id, worker_id, {Job.status: JobStatus.done, Job.finished_at: utcnow(), Job.last_error: None})
+
+
+def fail_job(job_id: int, worker_id: str, attempts: int, max_attempts: int, error: str) -> bool:
+    """
+    Зафиксировать ошибку: повтор с задержкой или dead
+
+    Returns:
+        True, если задача переведена в dead
+    """
+    error = error[:MAX_ERROR_LENGTH]
+    if attempts >= max_attempts:
+        _finish_job(job_id, worker_id, {
+            Job.status: JobStatus.dead,
+            Job.finished_at: utcnow(),
+            Job.last_error: error
+        })
+        return True
+
+    _finish_job(job_id, worker_id, {
+        Job.status: JobStatus.pending,
+        Job.run_after: utcnow() + timedelta(seconds=retry_delay(attempts)),
+        Job.last_error: error
+    })
+    return False
+
+
+def release_job(job_id: int, worker_id: str) -> None:
+    """
+    Вернуть задачу в очередь без траты попытки (остановка воркера)
+    """
+    _finish_job(job_id, worker_id, {
+        Job.status: JobStatus.pending,
+        Job.attempts: Job.attempts - 1,
+        Job.run_after: utcnow()
+    })
+
+
+def requeue_stale_jobs() -> int:
+    """
+    Вернуть в очередь задачи, зависшие в running дольше JOB_LOCK_TIMEOUT
+
+    Returns:
+        количество возвращённых задач
+    """
+    cutoff = utcnow() - timedelta(seconds=JOB_LOCK_TIMEOUT)
+    with session_scope() as db:
+        stale = db.query(Job).filter(Job.status == JobStatus.running, Job.locked_at < cutoff)
+        dead = stale.filter(Job.attempts >= Job.max_attempts).update({
+            Job.status: JobStatus.dead,
+            Job.finished_at: utcnow(),
+            Job.last_error: "Lock timeout",
+            Job.locked_by: None,
+            Job.locked_at: None
+        }, synchronize_session=False)
+        requeued = stale.update({
+            Job.status: JobStatus.pending,
+            Job.run_after: utcnow(),
+            Job.last_error: "Lock timeout",
+            Job.locked_by: None,
+            Job.locked_at: None
+        }, synchronize_session=False)
+        db.commit()
+
+    if dead or requeued:
+        logger.warning(f"⚠️  Stale jobs: {requeued} requeued, {dead} moved to dead")
+        with _stats_lock:
+            _stats["requeued_stale"] += requeued
+            _stats["dead"] += dead
+    return requeued
+
+
+def retry_dead_job(db: Session, job_id: int) -> Optional[Job]:
+    """
+    Вернуть dead задачу в очередь с новым запасом попыток
+    """
+    job = db.get(Job, job_id)
+    if job is None or job.status != JobStatus.dead:
+        return None
+    job.status = JobStatus.pending
+    job.attempts = 0
+    job.run_after = utcnow()
+    job.finished_at = None
+    db.commit()
+    db.refresh(job)
+    notify_job_workers()
+    return job
+
+
+async def _run_job(job: Dict[str, Any], worker_id: str) -> None:
+    handler = _handlers.get(job["kind"])
+    try:
+        if handler is None:
+            raise LookupError(f"No handler for job kind '{job['kind']}'")
+        await handler(job["payload"])
+    except asyncio.CancelledError:
+        await asyncio.shield(run_blocking(release_job, job["id"], worker_id))
+        raise
+    except Exception as e:
+        attempts = job["attempts"] if handler is not None else job["max_attempts"]
+        dead = await run_blocking(
+            fail_job, job["id"], worker_id, attempts, job["max_attempts"], f"{type(e).__name__}: {e}"
+        )
+        with _stats_lock:
+            _stats["dead" if dead else "failed"] += 1
+        log = logger.error if dead else logger.warning
+        log(
+            f"{'❌' if dead else '⚠️ '} Job {job['id']} ({job['kind']}) failed "
+            f"(attempt {job['attempts']}/{job['max_attempts']}){', moved to dead' if dead else ''}: {e}"
+        )
+        return
+
+    await run_blocking(complete_job, job["id"], worker_id)
+    with _stats_lock:
+        _stats["processed"] += 1
+
+
+async def _worker(index: int) -> None:
+    worker_id = f"{_worker_prefix}:{index}:{uuid.uuid4().hex[:6]}"
+    stale_check_interval = max(JOB_POLL_INTERVAL, JOB_LOCK_TIMEOUT / 2)
+    next_stale_check = 0.0
+    loop = asyncio.get_running_loop()
+
+    while True:
+        try:
+            if index == 0 and loop.time() >= next_stale_check:
+                next_stale_check = loop.time() + stale_check_interval
+                await run_blocking(requeue_stale_jobs)
+
+            job = await run_blocking(claim_job, worker_id)
+            if job is not None:
+                await _run_job(job, worker_id)
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Job worker {worker_id} error: {e}")
+
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_job_workers(workers: int = JOB_WORKERS) -> None:
+    """
+    Запустить воркеры очереди в текущем event loop (при старте приложения)
+    """
+    global _wakeup, _loop
+    if _worker_tasks or workers <= 0:
+        return
+    _loop = asyncio.get_running_loop()
+    _wakeup = asyncio.Event()
+    for index in range(workers):
+        _worker_tasks.append(asyncio.create_task(_worker(index)))
+    logger.info(f"✅ Job queue: {workers} workers started, handlers: {sorted(_handlers)}")
+
+
+async def stop_job_workers() -> None:
+    """
+    Остановить воркеры; выполняемые задачи возвращаются в очередь
+    """
+    global _wakeup, _loop
+    for task in _worker_tasks:
+        task.cancel()
+    await asyncio.gather(*_worker_tasks, return_exceptions=True)
+    _worker_tasks.clear()
+    _wakeup = None
+    _loop = None
+
+
+def get_job_stats(db: Session) -> Dict[str, Any]:
+    """
+    Количество задач по статусам и счётчики воркеров этого процесса
+    """
+    counts = {status.value: 0 for status in JobStatus}
+    for status, count in db.query(Job.status, func.count(Job.id)).group_by(Job.status).all():
+        counts[status.value] = count
+
+    with _stats_lock:
+        worker_stats = dict(_stats)
+
+    return {
+        "counts": counts,
+        "workers": len(_worker_tasks),
+        "handlers": sorted(_handlers),
+        **worker_stats
+    }
@@ -0,0 +1,184 @@
+"""
+Лемматизатор с кэшированием
+- Таблица лемм словаря базы знаний (строится при построении поискового индекса)
+- Ограниченный LRU кэш по словоформе для остальных слов
+- Batch API: весь список токенов за один вызов, pymorphy2 - только для
+  словоформ, которых нет ни в таблице, ни в LRU
+- Статистика попаданий и времени вызовов
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LEMMA_CACHE_SIZE = int(os.getenv("LEMMA_CACHE_SIZE", "50000"))
+
+# Инициализация морфологического анализатора для русского языка
+try:
+    import pymorphy2
+    morph = pymorphy2.MorphAnalyzer()
+    PYMORPHY_AVAILABLE = True
+    print("✅ Pymorphy2 loaded successfully")
+except Exception as e:
+    print(f"⚠️  Pymorphy2 not available: {e}. Lemmatization will use simple fallback.")
+    morph = None
+    PYMORPHY_AVAILABLE = False
+
+
+def _parse_lemma(word: str) -> str:
+    """
+    Лемма через pymorphy2 (или lowercase, если он недоступен)
+    """
+    if PYMORPHY_AVAILABLE and morph:
+        try:
+            return morph.parse(word)[0].normal_form
+        except:
+            pass
+
+    # Fallback: простое приведение к lowercase
+    return word
+
+
+class Lemmatizer:
+    """
+    Словоформа (lowercase) -> лемма
+
+    Порядок поиска: таблица словаря БЗ (без ограничения размера, заполняется
+    preload) -> LRU кэш (LEMMA_CACHE_SIZE словоформ) -> pymorphy2
+    """
+
+    def __init__(self, cache_size: int = LEMMA_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._table: Dict[str, str] = {}
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.table_hits = 0
+        self.cache_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.parse_seconds = 0.0
+        self.calls = 0
+        self.call_seconds = 0.0
+        self.max_call_seconds = 0.0
+
+    def _lookup_unlocked(self, word: str):
+        lemma = self._table.get(word)
+        if lemma is not None:
+            self.table_hits += 1
+            return lemma
+
+        lemma = self._cache.get(word)
+        if lemma is not None:
+            self._cache.move_to_end(word)
+            self.cache_hits += 1
+        return lemma
+
+    def _remember_unlocked(self, word: str, lemma: str) -> None:
+        if self.cache_size <= 0:
+            return
+        self._cache[word] = lemma
+        self._cache.move_to_end(word)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+    def lemmatize_batch(self, words: Iterable[str]) -> List[str]:
+        """
+        Леммы для списка словоформ (порядок и повторы сохраняются)
+        """
+        started = time.perf_counter()
+        words = [word.lower() for word in words]
+        lemmas: Dict[str, str] = {}
+        missing: List[str] = []
+
+        with self._lock:
+            for word in words:
+                if word in lemmas:
+                    continue
+                lemma = self._lookup_unlocked(word)
+                if lemma is None:
+                    lemmas[word] = None
+                    missing.append(word)
+                else:
+                    lemmas[word] = lemma
+
+        if missing:
+            parse_started = time.perf_counter()
+            parsed = {word: _parse_lemma(word) for word in missing}
+            parse_seconds = time.perf_counter() - parse_started
+            lemmas.update(parsed)
+
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            if missing:
+                self.misses += len(missing)
+                self.parse_seconds += parse_seconds
+                for word, lemma in parsed.items():
+                    self._remember_unlocked(word, lemma)
+            self.calls += 1
+            self.call_seconds += elapsed
+            self.max_call_seconds = max(self.max_call_seconds, elapsed)
+
+        return [lemmas[word] for word in words]
+
+    def lemmatize(self, word: str) -> str:
+        return self.lemmatize_batch([word])[0]
+
+    def preload(self, words: Iterable[str]) -> int:
+        """
+        Построить таблицу лемм для словаря (например, всех слов базы знаний)
+        Returns: размер таблицы
+        """
+        vocabulary = sorted({word.lower() for word in words} - self._table.keys())
+        table = dict(zip(vocabulary, self.lemmatize_batch(vocabulary)))
+        with self._lock:
+            self._table.update(table)
+            for word in table:
+                self._cache.pop(word, None)
+            return len(self._table)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._table.clear()
+            self._cache.clear()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self.table_hits + self.cache_hits + self.misses
+            return {
+                "pymorphy_available": PYMORPHY_AVAILABLE,
+                "table_size": len(self._table),
+                "cache_size": len(self._cache),
+                "cache_capacity": self.cache_size,
+                "table_hits": self.table_hits,
+                "cache_hits": self.cache_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.table_hits + self.cache_hits) / max(lookups, 1) * 100,
+                "calls": self.calls,
+                "avg_call_ms": self.call_seconds / max(self.calls, 1) * 1000,
+                "max_call_ms": self.max_call_seconds * 1000,
+                "parse_ms_total": self.parse_seconds * 1000
+            }
+
+
+# Глобальный лемматизатор (singleton)
+_global_lemmatizer = None
+_global_lemmatizer_lock = threading.Lock()
+
+
+def get_lemmatizer() -> Lemmatizer:
+    """
+    Получить глобальный лемматизатор (singleton)
+    """
+    global _global_lemmatizer
+    if _global_lemmatizer is None:
+        with _global_lemmatizer_lock:
+            if _global_lemmatizer is None:
+                _global_lemmatizer = Lemmatizer()
+    return _global_lemmatizer
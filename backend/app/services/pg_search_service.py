@@ -0,0 +1,153 @@
+"""
+Поиск средствами PostgreSQL
+- Keyword уровень: ILIKE по keywords через GIN индекс pg_trgm (без seq scan)
+  и совпадение нормальной формы keywords.lemma (btree индекс)
+- Full-text уровень: хранимая generated колонка qa_pairs.search_vector
+  (tsvector, конфигурация russian, вопрос - вес A, ответ - вес B),
+  GIN индекс и сортировка по ts_rank
+- Колонка и индексы создаются миграцией 20251215_0002_pg_search и в модель
+  не входят; на SQLite этот backend недоступен (используется ILIKE)
+
+SEARCH_BACKEND:
+- memory (по умолчанию): in-memory индексы, PostgreSQL вместо ILIKE,
+  пока индексы не построены
+- postgres: keyword и full-text уровни всегда выполняются в PostgreSQL
+"""
+import logging
+import os
+import threading
+from functools import reduce
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+from sqlalchemy import desc, func, inspect, literal_column, or_
+from sqlalchemy.orm import Session
+
+from app.models import QAPair, QAPairStatus, Keyword
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "memory").lower()
+TS_CONFIG = literal_column("'russian'::regconfig")
+
+# Есть ли в БД колонка search_vector (проверяется один раз на процесс)
+_pg_search_ready: Optional[bool] = None
+_pg_search_lock = threading.Lock()
+
+search_vector = literal_column("qa_pairs.search_vector")
+
+
+def pg_search_available(db: Session) -> bool:
+    """
+    PostgreSQL с применённой миграцией поиска
+    """
+    global _pg_search_ready
+    if _pg_search_ready is None:
+        with _pg_search_lock:
+            if _pg_search_ready is None:
+                bind = db.get_bind()
+                _pg_search_ready = bind.dialect.name == "postgresql" and "search_vector" in [
+                    column["name"] for column in inspect(bind).get_columns("qa_pairs")
+                ]
+                if _pg_search_ready:
+                    logger.info("✅ PostgreSQL search backend available (pg_trgm + tsvector)")
+    return _pg_search_ready
+
+
+def use_postgres_search(db: Session, index_ready: bool) -> bool:
+    """
+    Выполнять ли уровень поиска в PostgreSQL вместо in-memory индекса / ILIKE
+    """
+    if SEARCH_BACKEND == "memory" and index_ready:
+        return False
+    return pg_search_available(db)
+
+
+def _ordered(db: Session, qa_pair_ids: List[int]) -> List[QAPair]:
+    if not qa_pair_ids:
+        return []
+    qa_pairs = db.query(QAPair).filter(QAPair.id.in_(qa_pair_ids)).all()
+    qa_pairs_dict = {qa.id: qa for qa in qa_pairs}
+    return [qa_pairs_dict[qa_id] for qa_id in qa_pair_ids if qa_id in qa_pairs_dict]
+
+
+def search_keywords_pg(db: Session, all_keywords: List[str], limit: Optional[int] = None) -> List[QAPair]:
+    """
+    Keyword поиск: QA пары по убыванию числа совпавших ключевых слов
+    ILIKE '%слово%' обслуживается trigram индексом ix_keywords_keyword_trgm,
+    lemma IN (...) - индексом ix_keywords_lemma (словоформы: "зарплаты" -> "зарплата")
+    """
+    matched = func.count(func.distinct(Keyword.keyword)).label("matched")
+    query = db.query(Keyword.qa_pair_id, matched).join(
+        QAPair, QAPair.id == Keyword.qa_pair_id
+    ).filter(
+        QAPair.status == QAPairStatus.approved,
+        or_(Keyword.lemma.in_(all_keywords), *[Keyword.keyword.ilike(f"%{word}%") for word in all_keywords])
+    ).group_by(Keyword.qa_pair_id).order_by(desc(matched), Keyword.qa_pair_id)
+
+    if limit:
+        query = query.limit(limit)
+
+    return _ordered(db, [qa_pair_id for qa_pair_id, _ in query.all()])
+
+
+def _tsquery(terms: List[str]):
+    """
+    OR-запрос из терминов: plainto_tsquery(t1) || plainto_tsquery(t2) ...
+    """
+    return reduce(
+        lambda left, right: left.op('||')(right),
+        [func.plainto_tsquery(TS_CONFIG, term) for term in terms]
+    )
+
+
+def search_full_text_pg(db: Session, term_weights: Dict[str, float], limit: int = 10) -> List[QAPair]:
+    """
+    Полнотекстовый поиск по search_vector с сортировкой по ts_rank
+    Термины группируются по весу (слова запроса / синонимы), ранг - взвешенная сумма
+    """
+    groups: Dict[float, List[str]] = {}
+    for term, weight in term_weights.items():
+        groups.setdefault(weight, []).append(term)
+    if not groups:
+        return []
+
+    queries = {weight: _tsquery(sorted(terms)) for weight, terms in groups.items()}
+    rank = reduce(
+        lambda left, right: left + right,
+        [func.ts_rank(search_vector, tsquery) * weight for weight, tsquery in queries.items()]
+    ).label("rank")
+
+    rows = db.query(QAPair.id, rank).filter(
+        QAPair.status == QAPairStatus.approved,
+        search_vector.op('@@')(_tsquery(sorted(term_weights)))
+    ).order_by(desc(rank), QAPair.id).limit(limit).all()
+
+    return _ordered(db, [qa_pair_id for qa_pair_id, _ in rows])
+
+
+def create_pg_search_schema(connection) -> None:
+    """
+    Колонка search_vector и индексы (как в миграции 20251215_0002_pg_search)
+    Для бенчмарков и отдельных схем; в рабочей БД используйте миграции
+    """
+    connection.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    connection.exec_driver_sql(
+        "ALTER TABLE qa_pairs ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('russian', coalesce(question, '') || ' ' || coalesce(question_processed, '')), 'A') || "
+        "setweight(to_tsvector('russian', coalesce(answer, '') || ' ' || coalesce(answer_processed, '')), 'B')"
+        ") STORED"
+    )
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_qa_pairs_search_vector ON qa_pairs USING GIN (search_vector)"
+    )
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_keywords_keyword_trgm ON keywords USING GIN (keyword gin_trgm_ops)"
+    )
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_qa_pairs_question_trgm ON qa_pairs USING GIN (question gin_trgm_ops)"
+    )
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_qa_pairs_answer_trgm ON qa_pairs USING GIN (answer gin_trgm_ops)"
+    )
@@ -0,0 +1,90 @@
+"""
+Анализ поискового запроса за один проход
+- AnalyzedQuery: токены, леммы, ключевые слова, расширение синонимами,
+  ключ кэша и (лениво) эмбеддинг запроса
+- Строится один раз на запрос и передаётся во все уровни поиска
+  (keyword, full-text, semantic) вместо повторной токенизации и лемматизации
+"""
+from dataclasses import dataclass, field
+from typing import List, Optional, Union
+
+import numpy as np
+
+from app.services.cache_service import get_cache_key
+from app.services.embedding_service import embed_query
+from app.services.lemmatizer_service import get_lemmatizer
+from app.services.synonym_service import split_words
+from app.services.text_processing_service import clean_words, expand_lemmas, keywords_from_lemmas
+
+
+@dataclass
+class AnalyzedQuery:
+    """
+    Результат анализа запроса
+
+    keywords - леммы исходного запроса (как extract_keywords),
+    expanded_keywords - леммы запроса, расширенного синонимами
+    """
+    text: str
+    tokens: List[str]
+    lemmas: List[str]
+    keywords: List[str]
+    expansions: List[str]
+    expanded_keywords: List[str]
+    cache_key: str
+    _embedding: Optional[np.ndarray] = field(default=None, repr=False, compare=False)
+
+    @property
+    def all_keywords(self) -> List[str]:
+        """
+        Ключевые слова вместе с синонимами (fallback - слова запроса как есть)
+        """
+        combined = list(set(self.keywords + self.expanded_keywords))
+        return combined or self.text.lower().split()
+
+    @property
+    def embedding(self) -> np.ndarray:
+        """
+        Эмбеддинг запроса (вычисляется при первом обращении)
+        """
+        if self._embedding is None:
+            self._embedding = embed_query(self.text)
+        return self._embedding
+
+    def __str__(self) -> str:
+        return self.text
+
+
+def analyze_query(text: str) -> AnalyzedQuery:
+    """
+    Разобрать запрос: одна batch лемматизация слов запроса,
+    один проход автомата синонимов
+    """
+    lemmatizer = get_lemmatizer()
+
+    tokens = split_words(text)
+    keyword_words = clean_words(text)
+    lemmas = lemmatizer.lemmatize_batch(tokens + keyword_words)
+    token_lemmas, keyword_lemmas = lemmas[:len(tokens)], lemmas[len(tokens):]
+
+    expansions = sorted(expand_lemmas(tokens, token_lemmas))
+    expanded_words = clean_words(' '.join(expansions))
+
+    return AnalyzedQuery(
+        text=text,
+        tokens=tokens,
+        lemmas=token_lemmas,
+        keywords=keywords_from_lemmas(keyword_lemmas),
+        expansions=expansions,
+        expanded_keywords=keywords_from_lemmas(lemmatizer.lemmatize_batch(expanded_words)),
+        cache_key=get_cache_key(text)
+    )
+
+
+def as_analyzed(query: Union[str, AnalyzedQuery]) -> AnalyzedQuery:
+    """
+    Принять запрос строкой или уже разобранным
+    """
+    if isinstance(query, AnalyzedQuery):
+        return query
+    return analyze_query(query)
@@ -0,0 +1,257 @@
+"""
+Журнал вопросов Slack (questions/answers) с отложенной пакетной записью
+- log_question только кладёт запись в буфер в памяти: обработчик запроса
+  не ждёт commit в БД
+- Фоновый поток пишет буфер bulk insert'ами (questions, затем answers),
+  когда набралось QUESTION_LOG_BATCH_SIZE записей или прошло
+  QUESTION_LOG_FLUSH_INTERVAL секунд
+- При ошибке БД записи возвращаются в буфер (не больше QUESTION_LOG_MAX_BUFFER,
+  сверх лимита старые записи отбрасываются и считаются в dropped)
+- При остановке приложения буфер дописывается (stop_question_log)
+"""
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+from sqlalchemy import insert
+
+from app.database import session_scope
+from app.models import Question, Answer
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+QUESTION_LOG_BATCH_SIZE = int(os.getenv("QUESTION_LOG_BATCH_SIZE", "100"))
+QUESTION_LOG_FLUSH_INTERVAL = float(os.getenv("QUESTION_LOG_FLUSH_INTERVAL", "2"))
+QUESTION_LOG_MAX_BUFFER = int(os.getenv("QUESTION_LOG_MAX_BUFFER", "10000"))
+
+
+@dataclass
+class QuestionLogEntry:
+    text: str
+    source: str
+    created_at: datetime
+    external_id: Optional[str] = None
+    answer: Optional[str] = None
+    answer_source: Optional[str] = None
+    confidence: Optional[float] = None
+    sources: Optional[List[int]] = None
+    timings: Optional[Dict[str, Any]] = None
+
+
+def write_entries(entries: List[QuestionLogEntry]) -> None:
+    """
+    Bulk insert вопросов и их ответов, один commit
+    """
+    question_rows = [
+        {
+            "text": entry.text,
+            "source": entry.source,
+            "external_id": entry.external_id,
+            "confidence": entry.confidence,
+            "sources": json.dumps(entry.sources) if entry.sources is not None else None,
+            "timings": json.dumps(entry.timings, ensure_ascii=False) if entry.timings is not None else None,
+            "created_at": entry.created_at
+        }
+        for entry in entries
+    ]
+
+    with session_scope() as db:
+        try:
+            ids = db.scalars(
+                insert(Question).returning(Question.id, sort_by_parameter_order=True),
+                question_rows
+            ).all()
+            answer_rows = [
+                {
+                    "question_id": question_id,
+                    "text": entry.answer,
+                    "source": entry.answer_source,
+                    "created_at": entry.created_at
+                }
+                for question_id, entry in zip(ids, entries)
+                if entry.answer
+            ]
+            if answer_rows:
+                db.execute(insert(Answer), answer_rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+
+class QuestionLog:
+    """
+    Буфер записей журнала и фоновый поток записи
+    """
+
+    def __init__(self, batch_size: int = QUESTION_LOG_BATCH_SIZE,
+                 flush_interval: float = QUESTION_LOG_FLUSH_INTERVAL,
+                 max_buffer: int = QUESTION_LOG_MAX_BUFFER):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buffer: List[QuestionLogEntry] = []
+        self._lock = threading.Lock()
+        # Один поток записи за раз (фоновый поток и flush при остановке)
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.logged = 0
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_ms = 0.0
+        self.last_error: Optional[str] = None
+
+    def log(self, entry: QuestionLogEntry) -> None:
+        with self._lock:
+            self._buffer.append(entry)
+            self.logged += 1
+            overflow = len(self._buffer) - self.max_buffer
+            if overflow > 0:
+                del self._buffer[:overflow]
+                self.dropped += overflow
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        """
+        Записать всё, что есть в буфере (пакетами по batch_size)
+
+        Returns:
+            количество записанных записей
+        """
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = self._buffer[:self.batch_size]
+                    del self._buffer[:self.batch_size]
+                if not batch:
+                    return written
+
+                started = time.perf_counter()
+                try:
+                    write_entries(batch)
+                except Exception as e:
+                    with self._lock:
+                        # Назад в начало буфера, порядок записей сохраняется
+                        self._buffer[:0] = batch
+                        overflow = len(self._buffer) - self.max_buffer
+                        if overflow > 0:
+                            del self._buffer[:overflow]
+                            self.dropped += overflow
+                        self.failed_flushes += 1
+                        self.last_error = f"{type(e).__name__}: {e}"
+                    logger.error(f"❌ Question log flush failed ({len(batch)} entries kept in buffer): {e}")
+                    return written
+
+                written += len(batch)
+                with self._lock:
+                    self.written += len(batch)
+                    self.flushes += 1
+                    self.last_flush_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"❌ Question log writer error: {e}")
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="question-log-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Остановить поток записи и дописать остаток буфера
+        """
+        if self._thread is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._lock:
+            pending = len(self._buffer)
+        if pending:
+            logger.error(f"❌ Question log: {pending} entries not written on shutdown")
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                "running": self._thread is not None,
+                "buffered": len(self._buffer),
+                "batch_size": self.batch_size,
+                "flush_interval": self.flush_interval,
+                "logged": self.logged,
+                "written": self.written,
+                "dropped": self.dropped,
+                "flushes": self.flushes,
+                "failed_flushes": self.failed_flushes,
+                "last_flush_ms": self.last_flush_ms,
+                "last_error": self.last_error
+            }
+
+
+# Глобальный экземпляр (singleton)
+_global_question_log = QuestionLog()
+
+
+def get_question_log() -> QuestionLog:
+    return _global_question_log
+
+
+def log_question(
+    text: str,
+    source: str = "slack",
+    external_id: Optional[str] = None,
+    answer: Optional[str] = None,
+    answer_source: Optional[str] = None,
+    confidence: Optional[float] = None,
+    sources: Optional[List[int]] = None,
+    timings: Optional[Dict[str, Any]] = None
+) -> None:
+    """
+    Записать вопрос (и ответ, если он найден) в журнал без ожидания БД
+    """
+    _global_question_log.log(QuestionLogEntry(
+        text=text,
+        source=source,
+        created_at=datetime.now(timezone.utc),
+        external_id=external_id,
+        answer=answer,
+        answer_source=answer_source,
+        confidence=confidence,
+        sources=sources,
+        timings=timings
+    ))
+
+
+def start_question_log() -> None:
+    _global_question_log.start()
+
+
+def stop_question_log() -> None:
+    _global_question_log.stop()
+
+
+def get_question_log_stats() -> Dict:
+    return _global_question_log.get_stats()
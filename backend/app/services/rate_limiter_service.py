@@ -1,56 +1,241 @@
 """
 Rate Limiter для Gemini API
-- Управление лимитами RPM (requests per minute)
-- Очередь запросов
+- Token bucket лимиты: RPM (requests per minute), RPD (requests per day),
+  TPM (tokens per minute)
+- Несколько запросов одновременно в пределах квоты (без общего worker thread)
+- Async API: ожидание квоты и backoff через asyncio.sleep, event loop не блокируется
+- Sync API: ожидание только в вызывающем потоке
 - Retry logic с exponential backoff
 """
-import time
+import asyncio
+import os
 import threading
-from queue import Queue, Empty
-from concurrent.futures import Future
-from typing import Any, Callable
+import time
+from datetime import date, datetime, timezone
+from typing import Any, Awaitable, Callable, Optional
 import logging
+from dotenv import load_dotenv
+
+load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "10"))
+GEMINI_RPD = int(os.getenv("GEMINI_RPD", "250"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "1000000"))
+GEMINI_MAX_CONCURRENT = int(os.getenv("GEMINI_MAX_CONCURRENT", "4"))
+
+# Интервал повторной проверки, когда заняты все слоты конкурентности
+CONCURRENCY_POLL_INTERVAL = 0.05
+
+
+class RateLimitTimeout(Exception):
+    """Квота не освободилась за отведённое время ожидания"""
+
+
+class TokenBucket:
+    """
+    Token bucket: capacity токенов, равномерно пополняется за period секунд
+    """
+
+    def __init__(self, capacity: float, period: float):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """
+        Сколько секунд ждать, пока в bucket наберётся amount токенов
+        """
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
 
 class GeminiRateLimiter:
     """
-    Rate limiter для Gemini API с поддержкой очереди запросов
+    Rate limiter для Gemini API
 
     Лимиты Gemini 2.0 Flash (free tier):
     - 10 RPM (requests per minute)
     - 250 RPD (requests per day)
+    - 1M TPM (tokens per minute)
+
+    Состояние квоты общее для sync и async вызовов. Слот занимается
+    атомарно под threading.Lock, само ожидание происходит вне блокировки:
+    в async вызовах - через asyncio.sleep, в sync - в потоке вызывающего.
     """
 
-    def __init__(self, rpm: int = 10, max_retries: int = 3):
+    def __init__(
+        self,
+        rpm: int = GEMINI_RPM,
+        rpd: int = GEMINI_RPD,
+        tpm: Optional[int] = GEMINI_TPM,
+        max_concurrent: int = GEMINI_MAX_CONCURRENT,
+        max_retries: int = 3,
+        max_wait: float = 60.0
+    ):
         """
         Args:
             rpm: максимальное количество запросов в минуту
+            rpd: максимальное количество запросов в день
+            tpm: максимальное количество токенов в минуту (None - без лимита)
+            max_concurrent: максимум одновременных запросов
             max_retries: максимальное количество повторных попыток
+            max_wait: сколько секунд ждать квоту, прежде чем выбросить RateLimitTimeout
         """
         self.rpm = rpm
+        self.rpd = rpd
+        self.tpm = tpm
+        self.max_concurrent = max_concurrent
         self.max_retries = max_retries
-        self.min_interval = 60.0 / rpm  # секунд между запросами
-        self.queue = Queue()
+        self.max_wait = max_wait
+
         self.lock = threading.Lock()
-        self.last_request_time = 0
-        self.request_count = 0
+        self.minute_bucket = TokenBucket(rpm, 60.0)
+        self.day_bucket = TokenBucket(rpd, 86400.0)
+        self.token_bucket = TokenBucket(tpm, 60.0) if tpm else None
+
+        self.in_flight = 0
+        self.waiting = 0
+        # Запросы за текущие сутки (UTC), сбрасывается при смене даты
         self.daily_count = 0
-        self.last_reset_time = time.time()
+        self._count_day: date = datetime.now(timezone.utc).date()
+        self.failed_count = 0
+        self.retry_count = 0
 
-        # Запускаем worker thread
-        self.worker_thread = threading.Thread(target=self._process_queue, daemon=True)
-        self.worker_thread.start()
+        logger.info(
+            f"✅ Gemini Rate Limiter initialized: {rpm} RPM, {rpd} RPD, "
+            f"{tpm or '∞'} TPM, {max_concurrent} concurrent"
+        )
 
-        logger.info(f"✅ Gemini Rate Limiter initialized: {rpm} RPM")
+    def _try_acquire(self, tokens: int) -> float:
+        """
+        Попробовать занять слот
 
-    def call(self, func: Callable, *args, **kwargs) -> Any:
+        Returns:
+            0 если слот занят, иначе сколько секунд подождать до следующей попытки
         """
-        Выполнить функцию с соблюдением rate limits
+        with self.lock:
+            if self.in_flight >= self.max_concurrent:
+                return CONCURRENCY_POLL_INTERVAL
+
+            now = time.monotonic()
+            wait = max(
+                self.minute_bucket.wait_time(1, now),
+                self.day_bucket.wait_time(1, now),
+                self.token_bucket.wait_time(tokens, now) if self.token_bucket else 0.0
+            )
+            if wait > 0:
+                return wait
+
+            self.minute_bucket.consume(1)
+            self.day_bucket.consume(1)
+            if self.token_bucket:
+                self.token_bucket.consume(tokens)
+            self.in_flight += 1
+            self._roll_day()
+            self.daily_count += 1
+            return 0.0
+
+    def _roll_day(self) -> None:
+        """
+        Новые сутки (UTC): счётчик запросов за день начинается с нуля (вызывать под lock)
+        """
+        today = datetime.now(timezone.utc).date()
+        if today != self._count_day:
+            self._count_day = today
+            self.daily_count = 0
+
+    def _release(self) -> None:
+        with self.lock:
+            self.in_flight -= 1
+
+    def _check_deadline(self, deadline: float, wait: float) -> None:
+        if time.monotonic() + wait > deadline:
+            raise RateLimitTimeout(
+                f"Gemini quota not available within {self.max_wait:.0f}s (next slot in {wait:.1f}s)"
+            )
+
+    def acquire(self, tokens: int = 0) -> None:
+        """
+        Дождаться слота (блокирует только вызывающий поток)
+        """
+        deadline = time.monotonic() + self.max_wait
+        with self.lock:
+            self.waiting += 1
+        try:
+            while True:
+                wait = self._try_acquire(tokens)
+                if wait == 0:
+                    return
+                self._check_deadline(deadline, wait)
+                logger.debug(f"⏳ Rate limit: sleeping {wait:.2f}s")
+                time.sleep(wait)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    async def acquire_async(self, tokens: int = 0) -> None:
+        """
+        Дождаться слота, не блокируя event loop
+        """
+        deadline = time.monotonic() + self.max_wait
+        with self.lock:
+            self.waiting += 1
+        try:
+            while True:
+                wait = self._try_acquire(tokens)
+                if wait == 0:
+                    return
+                self._check_deadline(deadline, wait)
+                logger.debug(f"⏳ Rate limit: awaiting {wait:.2f}s")
+                await asyncio.sleep(wait)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    def _on_failure(self, attempt: int, e: Exception) -> float:
+        """
+        Обработать ошибку запроса
+
+        Returns:
+            сколько секунд ждать перед повтором
+        Raises:
+            исходное исключение, если все попытки исчерпаны
+        """
+        if isinstance(e, RateLimitTimeout) or attempt >= self.max_retries:
+            with self.lock:
+                self.failed_count += 1
+            logger.error(f"❌ Request failed after {attempt} retries: {e}")
+            raise e
+
+        with self.lock:
+            self.retry_count += 1
+        wait_time = 2 ** (attempt + 1)  # Exponential backoff: 2s, 4s, 8s
+        logger.warning(
+            f"⚠️  Request failed (attempt {attempt + 1}/{self.max_retries}). "
+            f"Retrying in {wait_time}s... Error: {e}"
+        )
+        return wait_time
+
+    def call(self, func: Callable, *args, tokens: int = 0, **kwargs) -> Any:
+        """
+        Выполнить функцию с соблюдением rate limits (sync)
 
         Args:
             func: функция для вызова (обычно Gemini API call)
+            tokens: оценка количества токенов запроса (для TPM)
             *args, **kwargs: аргументы функции
 
         Returns:
@@ -59,96 +244,72 @@ class GeminiRateLimiter:
         Raises:
             Exception: если все retry попытки исчерпаны
         """
-        future = Future()
-        self.queue.put((func, args, kwargs, future, 0))  # 0 = retry_count
-
-        # Ждем результата (с timeout 60 секунд)
-        try:
-            return future.result(timeout=60)
-        except Exception as e:
-            logger.error(f"❌ Rate limiter call failed: {e}")
-            raise
-
-    def _process_queue(self):
-        """
-        Worker thread для обработки очереди запросов
-        """
+        attempt = 0
         while True:
             try:
-                # Получаем задачу из очереди (блокирующий вызов)
-                func, args, kwargs, future, retry_count = self.queue.get(timeout=1)
-
-                # Проверяем rate limit
-                self._wait_for_rate_limit()
-
-                # Выполняем запрос
+                self.acquire(tokens)
                 try:
-                    result = func(*args, **kwargs)
-                    future.set_result(result)
-                    self.request_count += 1
-                    self.daily_count += 1
-
-                    logger.debug(f"✅ Request successful. Total today: {self.daily_count}")
-
-                except Exception as e:
-                    # Retry logic
-                    if retry_count < self.max_retries:
-                        retry_count += 1
-                        wait_time = 2 ** retry_count  # Exponential backoff: 2s, 4s, 8s
-
-                        logger.warning(
-                            f"⚠️  Request failed (attempt {retry_count}/{self.max_retries}). "
-                            f"Retrying in {wait_time}s... Error: {e}"
-                        )
-
-                        time.sleep(wait_time)
-
-                        # Возвращаем в очередь для повтора
-                        self.queue.put((func, args, kwargs, future, retry_count))
-                    else:
-                        # Исчерпаны все попытки
-                        logger.error(f"❌ Request failed after {self.max_retries} retries: {e}")
-                        future.set_exception(e)
-
-            except Empty:
-                # Очередь пуста, продолжаем
-                continue
+                    return func(*args, **kwargs)
+                finally:
+                    self._release()
             except Exception as e:
-                logger.error(f"❌ Queue processing error: {e}")
+                wait_time = self._on_failure(attempt, e)
+                attempt += 1
+                time.sleep(wait_time)
 
-    def _wait_for_rate_limit(self):
+    async def acall(self, func: Callable[..., Awaitable], *args, tokens: int = 0, **kwargs) -> Any:
         """
-        Ждать если нужно для соблюдения rate limit
-        """
-        with self.lock:
-            current_time = time.time()
-
-            # Сбросить счетчик если прошла минута
-            if current_time - self.last_reset_time >= 60:
-                self.request_count = 0
-                self.last_reset_time = current_time
-
-            # Проверить интервал между запросами
-            time_since_last = current_time - self.last_request_time
-
-            if time_since_last < self.min_interval:
-                sleep_time = self.min_interval - time_since_last
-                logger.debug(f"⏳ Rate limit: sleeping {sleep_time:.2f}s")
-                time.sleep(sleep_time)
+        Выполнить корутину с соблюдением rate limits (async)
 
-            self.last_request_time = time.time()
+        Args:
+            func: функция, возвращающая awaitable (например, model.generate_content_async)
+            tokens: оценка количества токенов запроса (для TPM)
+            *args, **kwargs: аргументы функции
+        """
+        attempt = 0
+        while True:
+            try:
+                await self.acquire_async(tokens)
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self._release()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                wait_time = self._on_failure(attempt, e)
+                attempt += 1
+                await asyncio.sleep(wait_time)
 
     def get_stats(self) -> dict:
         """
         Получить статистику использования
         """
-        return {
-            "rpm_limit": self.rpm,
-            "requests_last_minute": self.request_count,
-            "requests_today": self.daily_count,
-            "queue_size": self.queue.qsize(),
-            "min_interval_sec": self.min_interval
-        }
+        with self.lock:
+            now = time.monotonic()
+            self.minute_bucket.wait_time(0, now)
+            self.day_bucket.wait_time(0, now)
+            self._roll_day()
+            return {
+                "rpm_limit": self.rpm,
+                "rpd_limit": self.rpd,
+                "tpm_limit": self.tpm,
+                "max_concurrent": self.max_concurrent,
+                "requests_available_minute": int(self.minute_bucket.tokens),
+                "requests_available_day": int(self.day_bucket.tokens),
+                "requests_today": self.daily_count,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "retries": self.retry_count,
+                "failed": self.failed_count
+            }
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая оценка количества токенов (~4 символа на токен)
+    """
+    return len(text) // 4 + 1
 
 
 # Глобальный rate limiter (singleton)
@@ -156,7 +317,7 @@ class GeminiRateLimiter:
 _global_limiter = None
 
 
-def get_rate_limiter(rpm: int = 10) -> GeminiRateLimiter:
+def get_rate_limiter(rpm: int = GEMINI_RPM) -> GeminiRateLimiter:
     """
     Получить глобальный rate limiter (singleton)
     """
@@ -180,17 +341,20 @@ if __name__ == "__main__":
     # Получаем rate limiter
     limiter = get_rate_limiter(rpm=10)
 
-    # Тестовые запросы
-    for i in range(5):
-        def make_request():
-            response = model.generate_content("Привет! Как дела?")
-            return response.text
-
-        try:
-            result = limiter.call(make_request)
-            print(f"Request {i+1}: {result[:50]}...")
-        except Exception as e:
-            print(f"Request {i+1} failed: {e}")
+    async def main():
+        # Запросы выполняются конкурентно в пределах квоты
+        prompts = [f"Привет! Как дела? ({i+1})" for i in range(5)]
+        results = await asyncio.gather(
+            *[limiter.acall(model.generate_content_async, prompt) for prompt in prompts],
+            return_exceptions=True
+        )
+        for i, result in enumerate(results):
+            if isinstance(result, Exception):
+                print(f"Request {i+1} failed: {result}")
+            else:
+                print(f"Request {i+1}: {result.text[:50]}...")
+
+    asyncio.run(main())
 
     # Статистика
     stats = limiter.get_stats()
@@ -0,0 +1,320 @@
+"""
+Разбор структурированных (JSON) ответов Gemini
+- Одна схема ответа (Field) описывает и проверку/приведение типов,
+  и response_schema для JSON режима Gemini (если SDK его поддерживает)
+- Быстрый путь: ответ начинается с { или [ - сразу orjson.loads (json, если
+  orjson не установлен); затем снятие markdown блока и поиск JSON в тексте
+  предкомпилированными шаблонами
+- Ответ, не прошедший проверку схемы, - ResponseParseError, без угадывания
+  id из цифр в тексте; для массивов неверные элементы отбрасываются, из
+  обрезанного ответа спасаются целые элементы
+- Метрики разбора по каждому парсеру (get_parser_stats)
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, Optional
+from dotenv import load_dotenv
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    orjson = None
+    ORJSON_AVAILABLE = False
+
+try:
+    import google.ai.generativelanguage as glm
+    JSON_MODE_SUPPORTED = "response_mime_type" in glm.GenerationConfig.meta.fields
+    RESPONSE_SCHEMA_SUPPORTED = "response_schema" in glm.GenerationConfig.meta.fields
+except Exception:
+    JSON_MODE_SUPPORTED = False
+    RESPONSE_SCHEMA_SUPPORTED = False
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+GEMINI_JSON_MODE = os.getenv("GEMINI_JSON_MODE", "true").lower() == "true"
+
+_FENCE_RE = re.compile(r"```(?:json|JSON)?\s*(.*?)\s*(?:```|$)", re.S)
+_JSON_START_RE = re.compile(r"[{\[]")
+
+_json_decoder = json.JSONDecoder()
+
+
+class ResponseParseError(ValueError):
+    """Ответ модели не разобран или не соответствует схеме"""
+
+
+def loads(text: str) -> Any:
+    """
+    JSON -> объект (orjson, если доступен)
+    """
+    if ORJSON_AVAILABLE:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+@dataclass(frozen=True)
+class Field:
+    """
+    Схема значения в ответе
+
+    type: string | number | integer | boolean | array | object
+    items - схема элементов массива, properties - поля объекта
+    minimum/maximum - допустимый диапазон чисел (значение прижимается к границам)
+    """
+    type: str
+    required: bool = False
+    default: Any = None
+    items: Optional["Field"] = None
+    properties: Optional[Dict[str, "Field"]] = None
+    minimum: Optional[float] = None
+    maximum: Optional[float] = None
+
+    def to_gemini_schema(self) -> Dict:
+        schema: Dict[str, Any] = {"type": self.type.upper()}
+        if self.items is not None:
+            schema["items"] = self.items.to_gemini_schema()
+        if self.properties is not None:
+            schema["properties"] = {name: field.to_gemini_schema() for name, field in self.properties.items()}
+            required = [name for name, field in self.properties.items() if field.required]
+            if required:
+                schema["required"] = required
+        return schema
+
+
+def _coerce(value: Any, field: Field, path: str, stats: Dict) -> Any:
+    if field.type == "object":
+        if not isinstance(value, dict):
+            raise ResponseParseError(f"{path}: expected object")
+        result = {}
+        for name, child in (field.properties or {}).items():
+            if name in value and value[name] is not None:
+                result[name] = _coerce(value[name], child, f"{path}.{name}", stats)
+            elif child.required:
+                raise ResponseParseError(f"{path}.{name}: required")
+            else:
+                result[name] = child.default() if callable(child.default) else child.default
+        return result
+
+    if field.type == "array":
+        if isinstance(value, (str, int, float)) and field.items is not None and field.items.type == "string":
+            value = [line for line in str(value).split('\n') if line.strip()]
+        if not isinstance(value, list):
+            raise ResponseParseError(f"{path}: expected array")
+        if field.items is None:
+            return value
+        items = []
+        for index, item in enumerate(value):
+            try:
+                items.append(_coerce(item, field.items, f"{path}[{index}]", stats))
+            except ResponseParseError:
+                stats["dropped_items"] += 1
+        return items
+
+    if field.type == "string":
+        if isinstance(value, (dict, list)):
+            raise ResponseParseError(f"{path}: expected string")
+        return str(value).strip()
+
+    if field.type == "boolean":
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.lower() in ("true", "false"):
+            return value.lower() == "true"
+        if isinstance(value, (int, float)):
+            return bool(value)
+        raise ResponseParseError(f"{path}: expected boolean")
+
+    if field.type in ("number", "integer"):
+        if isinstance(value, bool):
+            raise ResponseParseError(f"{path}: expected {field.type}")
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            raise ResponseParseError(f"{path}: expected {field.type}")
+        if number != number:
+            raise ResponseParseError(f"{path}: NaN")
+        if field.type == "integer":
+            if not number.is_integer():
+                raise ResponseParseError(f"{path}: expected integer")
+            number = int(number)
+        if field.minimum is not None:
+            number = max(field.minimum, number)
+        if field.maximum is not None:
+            number = min(field.maximum, number)
+        return number
+
+    return value
+
+
+def _iter_json_values(text: str) -> Iterator[Any]:
+    """
+    JSON значения, встроенные в текст (объекты и массивы), по порядку
+    """
+    match = _JSON_START_RE.search(text)
+    while match:
+        try:
+            value, end = _json_decoder.raw_decode(text, match.start())
+        except json.JSONDecodeError:
+            match = _JSON_START_RE.search(text, match.start() + 1)
+            continue
+        yield value
+        match = _JSON_START_RE.search(text, end)
+
+
+def _looks_like(values: list, field: Field) -> bool:
+    """
+    Похожи ли значения на field (объекты - есть хотя бы одно поле схемы)
+    """
+    if field.type != "object":
+        return True
+    return all(
+        isinstance(value, dict) and (not field.properties or bool(set(value) & set(field.properties)))
+        for value in values
+    )
+
+
+class ResponseParser:
+    """
+    Парсер ответов одного вида (intent, synthesis, ...) со своей схемой и метриками
+    """
+
+    def __init__(self, name: str, schema: Field):
+        self.name = name
+        self.schema = schema
+        self.stats = {
+            "parsed": 0,
+            "fast_path": 0,
+            "fenced": 0,
+            "extracted": 0,
+            "salvaged": 0,
+            "failed": 0,
+            "invalid": 0,
+            "dropped_items": 0,
+            "parse_ms_total": 0.0
+        }
+        self.lock = threading.Lock()
+
+    @property
+    def generation_config(self) -> Optional[Dict]:
+        """
+        generation_config для JSON режима Gemini (None - SDK не поддерживает / выключено)
+        """
+        if not (GEMINI_JSON_MODE and JSON_MODE_SUPPORTED):
+            return None
+        config: Dict[str, Any] = {"response_mime_type": "application/json"}
+        if RESPONSE_SCHEMA_SUPPORTED:
+            config["response_schema"] = self.schema.to_gemini_schema()
+        return config
+
+    def _decode(self, text: str, counts: Dict) -> Any:
+        stripped = text.strip()
+        if stripped[:1] in ("{", "["):
+            try:
+                value = loads(stripped)
+                counts["fast_path"] += 1
+                return value
+            except ValueError:
+                pass
+
+        fenced = _FENCE_RE.search(stripped)
+        if fenced:
+            try:
+                value = loads(fenced.group(1))
+                counts["fenced"] += 1
+                return value
+            except ValueError:
+                stripped = fenced.group(1)
+
+        values = list(_iter_json_values(stripped))
+        if self.schema.type == "array":
+            # Массив в тексте или (обрезанный ответ) целые элементы массива
+            item_schema = self.schema.items or Field("object")
+            arrays = [value for value in values if isinstance(value, list) and value and _looks_like(value, item_schema)]
+            if arrays:
+                counts["extracted"] += 1
+                return arrays[0]
+            items = [value for value in values if _looks_like([value], item_schema)]
+            if items:
+                counts["salvaged"] += 1
+                return items
+        else:
+            objects = [value for value in values if _looks_like([value], self.schema)]
+            if objects:
+                counts["extracted"] += 1
+                return objects[0]
+
+        raise ResponseParseError(f"{self.name}: no JSON in response")
+
+    def parse(self, text: str) -> Any:
+        """
+        Разобрать и проверить ответ по схеме
+
+        Raises:
+            ResponseParseError: JSON не найден или не соответствует схеме
+        """
+        started = time.perf_counter()
+        counts = {key: 0 for key in ("fast_path", "fenced", "extracted", "salvaged", "dropped_items")}
+        outcome = "parsed"
+        try:
+            try:
+                value = self._decode(text or "", counts)
+            except ResponseParseError:
+                outcome = "failed"
+                raise
+
+            if self.schema.type == "array" and isinstance(value, dict):
+                # {"items": [...]} вместо массива
+                value = next((item for item in value.values() if isinstance(item, list)), [value])
+
+            try:
+                return _coerce(value, self.schema, self.name, counts)
+            except ResponseParseError:
+                outcome = "invalid"
+                raise
+        finally:
+            with self.lock:
+                self.stats[outcome] += 1
+                for key, count in counts.items():
+                    self.stats[key] += count
+                self.stats["parse_ms_total"] += (time.perf_counter() - started) * 1000
+            if outcome != "parsed":
+                logger.warning(f"⚠️  {self.name} response not parsed ({outcome}): {(text or '')[:200]!r}")
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            stats = dict(self.stats)
+        total = stats["parsed"] + stats["failed"] + stats["invalid"]
+        stats["parse_ms_total"] = round(stats["parse_ms_total"], 3)
+        stats["avg_parse_ms"] = round(stats["parse_ms_total"] / total, 4) if total else 0.0
+        stats["failure_rate"] = round((stats["failed"] + stats["invalid"]) / total, 4) if total else 0.0
+        return stats
+
+
+_parsers: Dict[str, ResponseParser] = {}
+
+
+def get_response_parser(name: str, schema: Field) -> ResponseParser:
+    """
+    Парсер по имени (один экземпляр на имя, общие метрики)
+    """
+    parser = _parsers.get(name)
+    if parser is None:
+        parser = _parsers.setdefault(name, ResponseParser(name, schema))
+    return parser
+
+
+def get_parser_stats() -> Dict:
+    return {
+        "orjson": ORJSON_AVAILABLE,
+        "json_mode": GEMINI_JSON_MODE and JSON_MODE_SUPPORTED,
+        "response_schema": GEMINI_JSON_MODE and RESPONSE_SCHEMA_SUPPORTED,
+        "parsers": {name: parser.get_stats() for name, parser in _parsers.items()}
+    }
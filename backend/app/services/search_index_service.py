@@ -0,0 +1,467 @@
+"""
+In-memory индексы по approved QA парам
+- InvertedIndex: лемма -> posting list с ID QA пар (keyword tier)
+- BM25Index: ранжированный полнотекстовый поиск с весами полей (full-text tier)
+- Строятся при старте из таблицы keywords + question/answer (и их обработанных версий)
+- Обновляются при approve/update/delete QA пары и ответе на вопрос из Slack;
+  остальные воркеры перечитывают изменённые пары из БД по событию инвалидации
+  (cache_service.register_invalidation_handler)
+- Заменяют ILIKE '%word%' сканирование таблиц на поиск по словарю
+"""
+import heapq
+import logging
+import math
+import threading
+from array import array
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy.orm import Session, selectinload
+
+from app.database import session_scope
+from app.models import QAPair, QAPairStatus
+from app.services.cache_service import register_invalidation_handler
+from app.services.embedding_service import (
+    build_vector_index, index_qa_pair_vector, remove_qa_pair_vector, sync_qa_pair_vector
+)
+from app.services.text_processing_service import extract_keywords, tokenize_lemmas, preload_lemmas
+
+logger = logging.getLogger(__name__)
+
+# Разделители составных терминов ("2-ндфл", "з/п"), части индексируются отдельно
+COMPOUND_SEPARATORS = ('-', '/')
+
+
+def _compound_parts(term: str) -> List[str]:
+    """
+    Части составного термина длиной от 3 символов ("2-ндфл" -> ["ндфл"])
+    """
+    parts = [term]
+    for separator in COMPOUND_SEPARATORS:
+        parts = [piece for part in parts for piece in part.split(separator)]
+    return [part for part in parts if len(part) >= 3 and part != term]
+
+
+def _index_terms(text: Optional[str]) -> Set[str]:
+    """
+    Леммы текста для индексации (включая части составных терминов)
+    """
+    if not text:
+        return set()
+
+    terms = set(extract_keywords(text))
+
+    for term in list(terms):
+        terms.update(_compound_parts(term))
+
+    return terms
+
+
+def get_qa_pair_terms(qa_pair: QAPair) -> Set[str]:
+    """
+    Все термины QA пары: ключевые слова + обработанные вопрос и ответ
+    """
+    terms: Set[str] = set()
+
+    for keyword in qa_pair.keywords:
+        terms.update(_index_terms(keyword.keyword))
+
+    terms.update(_index_terms(qa_pair.question_processed or qa_pair.question))
+    terms.update(_index_terms(qa_pair.answer_processed or qa_pair.answer))
+
+    return terms
+
+
+class InvertedIndex:
+    """
+    Инвертированный индекс: лемма -> множество ID approved QA пар
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Set[int]] = {}
+        self._doc_terms: Dict[int, Set[str]] = {}
+        self._lock = threading.RLock()
+        self.ready = False
+
+    def add(self, qa_id: int, terms: Iterable[str]) -> None:
+        """
+        Добавить (или переиндексировать) документ
+        """
+        with self._lock:
+            self._remove_unlocked(qa_id)
+
+            doc_terms = set(terms)
+            self._doc_terms[qa_id] = doc_terms
+            for term in doc_terms:
+                self._postings.setdefault(term, set()).add(qa_id)
+
+    def remove(self, qa_id: int) -> None:
+        """
+        Удалить документ из индекса
+        """
+        with self._lock:
+            self._remove_unlocked(qa_id)
+
+    def _remove_unlocked(self, qa_id: int) -> None:
+        for term in self._doc_terms.pop(qa_id, ()):
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            posting.discard(qa_id)
+            if not posting:
+                del self._postings[term]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._postings.clear()
+            self._doc_terms.clear()
+
+    def lookup(self, terms: Iterable[str]) -> List[int]:
+        """
+        Найти документы, содержащие хотя бы один из терминов
+
+        Returns:
+            ID QA пар, отсортированные по количеству совпавших терминов
+        """
+        hits: Dict[int, int] = {}
+
+        with self._lock:
+            for term in set(terms):
+                for qa_id in self._postings.get(term, ()):
+                    hits[qa_id] = hits.get(qa_id, 0) + 1
+
+        return sorted(hits, key=lambda qa_id: (-hits[qa_id], qa_id))
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "documents": len(self._doc_terms),
+                "terms": len(self._postings),
+                "postings": sum(len(posting) for posting in self._postings.values())
+            }
+
+    def __len__(self) -> int:
+        return len(self._doc_terms)
+
+
+def get_qa_pair_fields(qa_pair: QAPair) -> Dict[str, List[str]]:
+    """
+    Леммы полей QA пары для BM25 (исходный и обработанный текст поля объединяются)
+    """
+    fields = {}
+
+    for field, original, processed in (
+        ("question", qa_pair.question, qa_pair.question_processed),
+        ("answer", qa_pair.answer, qa_pair.answer_processed),
+    ):
+        texts = [original or ""]
+        if processed and processed != original:
+            texts.append(processed)
+        tokens = tokenize_lemmas(" ".join(texts))
+        fields[field] = tokens + [part for token in tokens for part in _compound_parts(token)]
+
+    return fields
+
+
+class BM25Index:
+    """
+    BM25F индекс с весами полей
+
+    Postings хранятся в array: для каждого поля и леммы - слоты документов
+    и частоты. Удалённые документы помечаются tombstone и вычищаются
+    при компактификации.
+    """
+
+    # Вес поля в итоговой частоте термина
+    FIELD_WEIGHTS = {"question": 2.0, "answer": 1.0}
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self.ready = False
+        self._reset()
+
+    def _reset(self) -> None:
+        # field -> term -> (слоты документов, частоты)
+        self._postings: Dict[str, Dict[str, Tuple[array, array]]] = {
+            field: {} for field in self.FIELD_WEIGHTS
+        }
+        # Длины полей по слотам документов
+        self._lengths: Dict[str, array] = {field: array('f') for field in self.FIELD_WEIGHTS}
+        self._total_lengths: Dict[str, float] = {field: 0.0 for field in self.FIELD_WEIGHTS}
+        # Слот -> ID QA пары (None для удалённых)
+        self._slot_ids: List[Optional[int]] = []
+        self._id_slots: Dict[int, int] = {}
+        # Документная частота термина (по всем полям)
+        self._doc_freq: Dict[str, int] = {}
+        self._slot_terms: Dict[int, Set[str]] = {}
+        self._tombstones = 0
+
+    def add(self, qa_id: int, fields: Dict[str, List[str]]) -> None:
+        """
+        Добавить (или переиндексировать) документ
+        """
+        with self._lock:
+            self._remove_unlocked(qa_id)
+
+            slot = len(self._slot_ids)
+            self._slot_ids.append(qa_id)
+            self._id_slots[qa_id] = slot
+
+            doc_terms: Set[str] = set()
+            for field in self.FIELD_WEIGHTS:
+                tokens = fields.get(field, [])
+                self._lengths[field].append(len(tokens))
+                self._total_lengths[field] += len(tokens)
+
+                frequencies: Dict[str, int] = {}
+                for token in tokens:
+                    frequencies[token] = frequencies.get(token, 0) + 1
+
+                field_postings = self._postings[field]
+                for term, frequency in frequencies.items():
+                    posting = field_postings.get(term)
+                    if posting is None:
+                        posting = field_postings[term] = (array('i'), array('H'))
+                    posting[0].append(slot)
+                    posting[1].append(min(frequency, 65535))
+                    doc_terms.add(term)
+
+            for term in doc_terms:
+                self._doc_freq[term] = self._doc_freq.get(term, 0) + 1
+            self._slot_terms[slot] = doc_terms
+
+            self._maybe_compact()
+
+    def remove(self, qa_id: int) -> None:
+        """
+        Удалить документ из индекса (tombstone)
+        """
+        with self._lock:
+            self._remove_unlocked(qa_id)
+            self._maybe_compact()
+
+    def _remove_unlocked(self, qa_id: int) -> None:
+        slot = self._id_slots.pop(qa_id, None)
+        if slot is None:
+            return
+
+        self._slot_ids[slot] = None
+        for field in self.FIELD_WEIGHTS:
+            self._total_lengths[field] -= self._lengths[field][slot]
+
+        for term in self._slot_terms.pop(slot, ()):
+            self._doc_freq[term] -= 1
+            if self._doc_freq[term] <= 0:
+                del self._doc_freq[term]
+
+        self._tombstones += 1
+
+    def _maybe_compact(self) -> None:
+        if self._tombstones > 64 and self._tombstones > len(self._id_slots):
+            self._compact()
+
+    def _compact(self) -> None:
+        """
+        Перестроить массивы без удалённых документов
+        """
+        live = {}
+        for field in self.FIELD_WEIGHTS:
+            for term, (slots, frequencies) in self._postings[field].items():
+                for slot, frequency in zip(slots, frequencies):
+                    qa_id = self._slot_ids[slot]
+                    if qa_id is not None:
+                        live.setdefault(qa_id, {}).setdefault(field, []).extend([term] * frequency)
+
+        self._reset()
+        for qa_id, fields in live.items():
+            self.add(qa_id, fields)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._reset()
+
+    def search(self, term_weights: Dict[str, float], limit: int = 10) -> List[Tuple[int, float]]:
+        """
+        Top-k документов по BM25F
+
+        Args:
+            term_weights: лемма -> вес термина в запросе
+            limit: количество результатов
+
+        Returns:
+            список (ID QA пары, score), по убыванию score
+        """
+        with self._lock:
+            documents = len(self._id_slots)
+            if not documents or not term_weights:
+                return []
+
+            average_lengths = {
+                field: (self._total_lengths[field] / documents) or 1.0
+                for field in self.FIELD_WEIGHTS
+            }
+
+            scores: Dict[int, float] = {}
+            for term, query_weight in term_weights.items():
+                doc_freq = self._doc_freq.get(term)
+                if not doc_freq:
+                    continue
+
+                idf = math.log(1 + (documents - doc_freq + 0.5) / (doc_freq + 0.5))
+
+                # Взвешенная по полям нормализованная частота термина
+                weighted_tf: Dict[int, float] = {}
+                for field, field_weight in self.FIELD_WEIGHTS.items():
+                    posting = self._postings[field].get(term)
+                    if posting is None:
+                        continue
+                    lengths = self._lengths[field]
+                    average_length = average_lengths[field]
+                    for slot, frequency in zip(*posting):
+                        if self._slot_ids[slot] is None:
+                            continue
+                        norm = 1 - self.b + self.b * lengths[slot] / average_length
+                        weighted_tf[slot] = weighted_tf.get(slot, 0.0) + field_weight * frequency / norm
+
+                for slot, tf in weighted_tf.items():
+                    scores[slot] = scores.get(slot, 0.0) + query_weight * idf * tf / (self.k1 + tf)
+
+            top = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+            return [(self._slot_ids[slot], score) for slot, score in top]
+
+    def coverage(self, qa_id: int, terms: Iterable[str]) -> float:
+        """
+        Доля терминов запроса, встречающихся в документе (0.0 - 1.0)
+        """
+        terms = set(terms)
+        if not terms:
+            return 0.0
+
+        with self._lock:
+            slot = self._id_slots.get(qa_id)
+            if slot is None:
+                return 0.0
+            return len(terms & self._slot_terms.get(slot, set())) / len(terms)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "documents": len(self._id_slots),
+                "terms": len(self._doc_freq),
+                "tombstones": self._tombstones
+            }
+
+
+# Глобальные индексы (singleton), общие для всех запросов воркера
+_global_index = None
+_global_fulltext_index = None
+_reindex_handler_registered = False
+
+
+def get_search_index() -> InvertedIndex:
+    """
+    Получить глобальный инвертированный индекс (singleton)
+    """
+    global _global_index
+    if _global_index is None:
+        _global_index = InvertedIndex()
+    return _global_index
+
+
+def get_fulltext_index() -> BM25Index:
+    """
+    Получить глобальный BM25 индекс (singleton)
+    """
+    global _global_fulltext_index
+    if _global_fulltext_index is None:
+        _global_fulltext_index = BM25Index()
+    return _global_fulltext_index
+
+
+def build_search_index(db: Session) -> InvertedIndex:
+    """
+    Полностью перестроить индексы по всем approved QA парам
+    """
+    index = get_search_index()
+    fulltext_index = get_fulltext_index()
+
+    qa_pairs = db.query(QAPair).options(selectinload(QAPair.keywords)).filter(
+        QAPair.status == QAPairStatus.approved
+    ).all()
+
+    # Таблица лемм словаря БЗ: индексация и последующие запросы не вызывают pymorphy2
+    vocabulary_size = preload_lemmas(
+        text
+        for qa_pair in qa_pairs
+        for text in (
+            qa_pair.question, qa_pair.answer, qa_pair.question_processed, qa_pair.answer_processed,
+            *(keyword.keyword for keyword in qa_pair.keywords)
+        )
+    )
+    logger.info(f"✅ Lemma table: {vocabulary_size} word forms")
+
+    index.clear()
+    fulltext_index.clear()
+    for qa_pair in qa_pairs:
+        index.add(qa_pair.id, get_qa_pair_terms(qa_pair))
+        fulltext_index.add(qa_pair.id, get_qa_pair_fields(qa_pair))
+    index.ready = True
+    fulltext_index.ready = True
+
+    logger.info(f"✅ Search index built: {index.get_stats()}, BM25: {fulltext_index.get_stats()}")
+
+    build_vector_index(db)
+
+    global _reindex_handler_registered
+    if not _reindex_handler_registered:
+        register_invalidation_handler(reindex_qa_pairs, local=False)
+        _reindex_handler_registered = True
+    return index
+
+
+def index_qa_pair(qa_pair: QAPair) -> None:
+    """
+    Обновить QA пару в индексах после изменения
+    Approved пары (пере)индексируются, остальные удаляются из индексов
+    """
+    if qa_pair.status == QAPairStatus.approved:
+        get_search_index().add(qa_pair.id, get_qa_pair_terms(qa_pair))
+        get_fulltext_index().add(qa_pair.id, get_qa_pair_fields(qa_pair))
+        index_qa_pair_vector(qa_pair)
+    else:
+        remove_qa_pair(qa_pair.id)
+
+
+def remove_qa_pair(qa_id: int) -> None:
+    """
+    Удалить QA пару из индексов
+    """
+    get_search_index().remove(qa_id)
+    get_fulltext_index().remove(qa_id)
+    remove_qa_pair_vector(qa_id)
+
+
+def reindex_qa_pairs(qa_ids: List[int]) -> None:
+    """
+    QA пары изменены в другом воркере: перечитать их из БД и обновить индексы
+    этого воркера (не approved и удалённые пары убираются)
+    """
+    with session_scope() as db:
+        qa_pairs = {
+            qa_pair.id: qa_pair
+            for qa_pair in db.query(QAPair).options(selectinload(QAPair.keywords)).filter(QAPair.id.in_(qa_ids))
+        }
+        for qa_id in qa_ids:
+            qa_pair = qa_pairs.get(qa_id)
+            if qa_pair is not None and qa_pair.status == QAPairStatus.approved:
+                get_search_index().add(qa_id, get_qa_pair_terms(qa_pair))
+                get_fulltext_index().add(qa_id, get_qa_pair_fields(qa_pair))
+                sync_qa_pair_vector(qa_id, qa_pair)
+            else:
+                get_search_index().remove(qa_id)
+                get_fulltext_index().remove(qa_id)
+                sync_qa_pair_vector(qa_id, None)
+    logger.info(f"Индексы обновлены по событию другого воркера: QA пары {qa_ids}")
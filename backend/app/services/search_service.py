@@ -1,32 +1,71 @@
 from sqlalchemy.orm import Session
 from sqlalchemy import or_
 from app.models import QAPair, Keyword, QAPairStatus
-from app.services.gemini_service import semantic_search
-from app.services.cache_service import get_cached_result, set_cached_result
-from app.services.text_processing_service import expand_query_with_synonyms, extract_keywords
-from typing import List
+from app.database import read_session_scope
+from app.services.gemini_service import semantic_search, semantic_search_async
+from app.services.cache_service import get_cached_result, get_kb_version, set_cached_result, CACHE_RESULT_TTL
+from app.services.query_analysis_service import AnalyzedQuery, as_analyzed
+from app.services.search_index_service import get_search_index, get_fulltext_index
+from app.services.embedding_service import semantic_candidates
+from app.services.pg_search_service import use_postgres_search, search_keywords_pg, search_full_text_pg
+from app.services.executor_service import run_blocking
+from typing import List, Optional, Tuple, Union
+from dotenv import load_dotenv
+import os
 
-def search_by_keywords(db: Session, query: str) -> List[QAPair]:
+load_dotenv()
+
+# Вес лемм, добавленных расширением синонимами, в BM25 запросе
+SYNONYM_TERM_WEIGHT = 0.5
+
+# Семантический поиск по векторному индексу
+SEMANTIC_TOP_K = int(os.getenv("SEMANTIC_TOP_K", "10"))
+SEMANTIC_MIN_SIMILARITY = float(os.getenv("SEMANTIC_MIN_SIMILARITY", "0.2"))
+# При такой similarity лучший кандидат считается найденным без Gemini
+SEMANTIC_CONFIDENT_SIMILARITY = float(os.getenv("SEMANTIC_CONFIDENT_SIMILARITY", "0.8"))
+# Сколько кандидатов отправлять в Gemini на reranking
+SEMANTIC_LLM_CANDIDATES = int(os.getenv("SEMANTIC_LLM_CANDIDATES", "5"))
+SEMANTIC_LLM_RERANK = os.getenv("SEMANTIC_LLM_RERANK", "true").lower() == "true"
+
+def search_by_keywords(db: Session, query: Union[str, AnalyzedQuery]) -> List[QAPair]:
     """
     Поиск по ключевым словам с расширением синонимами
+    - Использует in-memory инвертированный индекс (лемма -> ID QA пар)
+    - На PostgreSQL (SEARCH_BACKEND=postgres или пока индекс не построен) -
+      trigram индекс по таблице keywords
+    - Иначе, пока индекс не построен, работает через ILIKE по таблице keywords
     """
-    # Извлекаем ключевые слова из запроса (с лемматизацией)
-    keywords = extract_keywords(query)
+    # Ключевые слова запроса (с лемматизацией) вместе с синонимами
+    all_keywords = as_analyzed(query).all_keywords
 
-    # Расширяем синонимами
-    expanded_query = expand_query_with_synonyms(query)
-    expanded_keywords = extract_keywords(expanded_query)
+    index = get_search_index()
+    if use_postgres_search(db, index.ready):
+        return search_keywords_pg(db, all_keywords)
+    if not index.ready:
+        return _search_by_keywords_ilike(db, all_keywords)
 
-    # Объединяем все ключевые слова
-    all_keywords = list(set(keywords + expanded_keywords))
+    # Поиск по индексу: ID отсортированы по количеству совпавших лемм
+    qa_pair_ids = index.lookup(all_keywords)
+
+    if not qa_pair_ids:
+        return []
 
-    if not all_keywords:
-        # Fallback к простому разбиению
-        all_keywords = query.lower().split()
+    qa_pairs = db.query(QAPair).filter(
+        QAPair.id.in_(qa_pair_ids),
+        QAPair.status == QAPairStatus.approved
+    ).all()
 
-    # Поиск в БД
+    # Сохраняем порядок ранжирования индекса
+    qa_pairs_dict = {qa.id: qa for qa in qa_pairs}
+    return [qa_pairs_dict[qa_id] for qa_id in qa_pair_ids if qa_id in qa_pairs_dict]
+
+def _search_by_keywords_ilike(db: Session, all_keywords: List[str]) -> List[QAPair]:
+    """
+    Fallback поиск по ключевым словам через ILIKE (полный скан keywords)
+    и по нормальной форме ключевого слова (keywords.lemma, индекс)
+    """
     keyword_matches = db.query(Keyword).filter(
-        or_(*[Keyword.keyword.ilike(f"%{word}%") for word in all_keywords])
+        or_(Keyword.lemma.in_(all_keywords), *[Keyword.keyword.ilike(f"%{word}%") for word in all_keywords])
     ).all()
 
     qa_pair_ids = list(set([kw.qa_pair_id for kw in keyword_matches]))
@@ -41,22 +80,46 @@ def search_by_keywords(db: Session, query: str) -> List[QAPair]:
 
     return qa_pairs
 
-def search_full_text(db: Session, query: str) -> List[QAPair]:
+def search_full_text(db: Session, query: Union[str, AnalyzedQuery], limit: int = 10) -> List[QAPair]:
     """
     Полнотекстовый поиск с расширением синонимами
+    - Ранжирование BM25 по полям question/answer (in-memory индекс)
+    - На PostgreSQL (SEARCH_BACKEND=postgres или пока индекс не построен) -
+      tsvector + ts_rank
+    - Иначе, пока индекс не построен, работает через ILIKE (без ранжирования)
     """
     # Получаем ключевые слова с синонимами
-    keywords = extract_keywords(query)
-    expanded_query = expand_query_with_synonyms(query)
-    expanded_keywords = extract_keywords(expanded_query)
+    analyzed = as_analyzed(query)
+    keywords = analyzed.keywords
+    all_keywords = analyzed.all_keywords
 
-    # Объединяем
-    all_keywords = list(set(keywords + expanded_keywords))
+    # Слова из исходного запроса весят больше, чем добавленные синонимы
+    term_weights = {word: SYNONYM_TERM_WEIGHT for word in all_keywords}
+    term_weights.update({word: 1.0 for word in keywords})
 
-    if not all_keywords:
-        all_keywords = query.lower().split()
+    fulltext_index = get_fulltext_index()
+    if use_postgres_search(db, fulltext_index.ready):
+        return search_full_text_pg(db, term_weights, limit=limit)
+    if not fulltext_index.ready:
+        return _search_full_text_ilike(db, all_keywords)[:limit]
+
+    ranked = fulltext_index.search(term_weights, limit=limit)
+    if not ranked:
+        return []
 
-    # Поиск по всем полям
+    qa_pair_ids = [qa_id for qa_id, _ in ranked]
+    qa_pairs = db.query(QAPair).filter(
+        QAPair.id.in_(qa_pair_ids),
+        QAPair.status == QAPairStatus.approved
+    ).all()
+
+    qa_pairs_dict = {qa.id: qa for qa in qa_pairs}
+    return [qa_pairs_dict[qa_id] for qa_id in qa_pair_ids if qa_id in qa_pairs_dict]
+
+def _search_full_text_ilike(db: Session, all_keywords: List[str]) -> List[QAPair]:
+    """
+    Fallback полнотекстовый поиск через ILIKE по всем полям
+    """
     qa_pairs = db.query(QAPair).filter(
         QAPair.status == QAPairStatus.approved,
         or_(
@@ -69,11 +132,101 @@ def search_full_text(db: Session, query: str) -> List[QAPair]:
 
     return qa_pairs
 
-def search_semantic(db: Session, query: str) -> List[QAPair]:
+def _semantic_shortlist(db: Session, query: AnalyzedQuery) -> Optional[Tuple[List[QAPair], bool]]:
     """
-    Семантический поиск через Gemini 2.0 Flash
-    - Убран лимит на количество QA пар
-    - Использует все approved пары для максимальной точности
+    Кандидаты из векторного индекса
+
+    Returns:
+        (кандидаты по убыванию similarity, нужен ли reranking через Gemini)
+        или None, если индекс ещё не построен
+    """
+    candidates = semantic_candidates(
+        query.text,
+        vector=query.embedding,
+        limit=SEMANTIC_TOP_K,
+        min_similarity=SEMANTIC_MIN_SIMILARITY
+    )
+    if candidates is None:
+        return None
+
+    if not candidates:
+        return [], False
+
+    qa_pair_ids = [qa_id for qa_id, _ in candidates]
+    qa_pairs = db.query(QAPair).filter(
+        QAPair.id.in_(qa_pair_ids),
+        QAPair.status == QAPairStatus.approved
+    ).all()
+    qa_pairs_dict = {qa.id: qa for qa in qa_pairs}
+    ranked = [qa_pairs_dict[qa_id] for qa_id in qa_pair_ids if qa_id in qa_pairs_dict]
+
+    best_similarity = candidates[0][1]
+    needs_rerank = SEMANTIC_LLM_RERANK and best_similarity < SEMANTIC_CONFIDENT_SIMILARITY
+    return ranked, needs_rerank
+
+def _to_qa_list(qa_pairs: List[QAPair]) -> List[dict]:
+    return [
+        {
+            "id": qa.id,
+            "question": qa.question_processed or qa.question,
+            "answer": qa.answer_processed or qa.answer,
+            "qa_pair": qa
+        }
+        for qa in qa_pairs
+    ]
+
+def search_semantic(db: Session, query: Union[str, AnalyzedQuery]) -> List[QAPair]:
+    """
+    Семантический поиск
+    - Cosine top-k по локальному векторному индексу (без запроса к Gemini)
+    - При высокой similarity кандидаты возвращаются сразу
+    - Иначе в Gemini уходят только несколько лучших кандидатов для reranking
+    - Пока индекс не построен, вся БЗ отправляется в Gemini (старый путь)
+    """
+    query = as_analyzed(query)
+    shortlist = _semantic_shortlist(db, query)
+    if shortlist is None:
+        return _search_semantic_llm(db, query)
+
+    ranked, needs_rerank = shortlist
+    if not needs_rerank:
+        return ranked
+
+    results = semantic_search(query.text, _to_qa_list(ranked[:SEMANTIC_LLM_CANDIDATES]))
+
+    return [item["qa_pair"] for item in results]
+
+def _in_new_session(func, *args):
+    with read_session_scope() as db:
+        return func(db, *args)
+
+async def search_semantic_async(db: Optional[Session], query: Union[str, AnalyzedQuery]) -> List[QAPair]:
+    """
+    Async версия search_semantic: запросы к БД в пуле потоков, reranking через async Gemini
+    Если db не передана, используется отдельная сессия (для параллельных вызовов)
+    """
+    if not isinstance(query, AnalyzedQuery):
+        query = await run_blocking(as_analyzed, query)
+    if db is None:
+        shortlist = await run_blocking(_in_new_session, _semantic_shortlist, query)
+    else:
+        shortlist = await run_blocking(_semantic_shortlist, db, query)
+    if shortlist is None:
+        if db is None:
+            return await run_blocking(_in_new_session, _search_semantic_llm, query)
+        return await run_blocking(_search_semantic_llm, db, query)
+
+    ranked, needs_rerank = shortlist
+    if not needs_rerank:
+        return ranked
+
+    results = await semantic_search_async(query.text, _to_qa_list(ranked[:SEMANTIC_LLM_CANDIDATES]))
+
+    return [item["qa_pair"] for item in results]
+
+def _search_semantic_llm(db: Session, query: AnalyzedQuery) -> List[QAPair]:
+    """
+    Семантический поиск через Gemini по всей БЗ (до построения векторного индекса)
     """
     # Получаем ВСЕ approved QA пары (без лимита)
     qa_pairs = db.query(QAPair).filter(
@@ -88,7 +241,7 @@ def search_semantic(db: Session, query: str) -> List[QAPair]:
     if len(qa_pairs) > 100:
         # Сначала быстрый keyword filter, затем semantic на топ-100
         keyword_filtered = search_by_keywords(db, query)
-        fulltext_filtered = search_full_text(db, query)
+        fulltext_filtered = search_full_text(db, query, limit=100)
 
         # Объединяем и убираем дубликаты
         combined = {qa.id: qa for qa in (keyword_filtered + fulltext_filtered)}
@@ -99,21 +252,17 @@ def search_semantic(db: Session, query: str) -> List[QAPair]:
         if pre_filtered:
             qa_pairs = pre_filtered[:100]  # Топ-100 для Gemini
 
-    qa_list = [
-        {
-            "id": qa.id,
-            "question": qa.question_processed or qa.question,
-            "answer": qa.answer_processed or qa.answer,
-            "qa_pair": qa
-        }
-        for qa in qa_pairs
-    ]
-
-    results = semantic_search(query, qa_list)
+    results = semantic_search(query.text, _to_qa_list(qa_pairs))
 
     return [item["qa_pair"] for item in results]
 
-def search(db: Session, query: str) -> List[QAPair]:
+def fulltext_coverage(query: Union[str, AnalyzedQuery], qa_id: int) -> float:
+    """
+    Доля ключевых слов исходного запроса, найденных в QA паре (по BM25 индексу)
+    """
+    return get_fulltext_index().coverage(qa_id, as_analyzed(query).keywords)
+
+def search(db: Session, query: Union[str, AnalyzedQuery]) -> List[QAPair]:
     """
     Каскадный поиск с кэшированием:
     1. Проверяем кэш
@@ -121,9 +270,12 @@ def search(db: Session, query: str) -> List[QAPair]:
     3. Full-text search (средне)
     4. Semantic search через Gemini (медленно, но точно)
     5. Сохраняем результат в кэш
+    Запрос разбирается один раз (AnalyzedQuery) и передаётся во все уровни
     """
+    query = as_analyzed(query)
+
     # 1. Проверяем кэш
-    cached = get_cached_result(query)
+    cached = get_cached_result(query.text, cache_key=query.cache_key)
     if cached is not None:
         # Восстанавливаем QAPair объекты из кэша
         qa_ids = cached.get("qa_ids", [])
@@ -134,6 +286,9 @@ def search(db: Session, query: str) -> List[QAPair]:
             results = [results_dict[qa_id] for qa_id in qa_ids if qa_id in results_dict]
             return results[:10]
 
+    # Версия базы знаний до поиска: результат, найденный во время её изменения, не кэшируется
+    kb_version = get_kb_version()
+
     # 2. Keyword search
     results = search_by_keywords(db, query)
 
@@ -145,13 +300,16 @@ def search(db: Session, query: str) -> List[QAPair]:
     if not results:
         results = search_semantic(db, query)
 
-    # 5. Кэшируем результаты
+    # 5. Кэшируем результаты (инвалидируются при изменении найденных QA пар)
     if results:
+        qa_ids = [qa.id for qa in results[:10]]
         cache_data = {
-            "qa_ids": [qa.id for qa in results[:10]],
+            "qa_ids": qa_ids,
             "found": True
         }
-        set_cached_result(query, cache_data, ttl=3600)  # 1 час
+        set_cached_result(
+            query.text, cache_data, ttl=CACHE_RESULT_TTL, deps=qa_ids, cache_key=query.cache_key, kb_version=kb_version
+        )
 
     return results[:10]
 
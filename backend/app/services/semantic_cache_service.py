@@ -0,0 +1,221 @@
+"""
+Семантический кэш ответов агента
+- Находит ранее отвеченный вопрос, похожий на новый (cosine similarity
+  эмбеддингов >= SEMANTIC_CACHE_THRESHOLD), и переиспользует его ответ и источники
+- Перефразировки одного вопроса ("когда зарплата?", "когда выплачивается зарплата")
+  не платят за intent и синтез в Gemini
+- Ограниченная ёмкость, вытеснение LRU, TTL, метрики попаданий
+- Записи удаляются при изменении/удалении их QA пар-источников
+"""
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from app.services.cache_service import CACHE_RESULT_TTL, normalize_query, register_invalidation_handler
+from app.services.embedding_service import embed_query
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1000"))
+# Порог похожести; подбирается под backend эмбеддингов (для hashing ниже 0.85 не опускать)
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.85"))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", str(CACHE_RESULT_TTL)))
+
+
+class SemanticCache:
+    """
+    Кэш (вопрос -> ответ агента) с поиском по похожести эмбеддингов
+
+    Векторы лежат в заранее выделенной матрице capacity x dim, поиск -
+    одно матричное умножение. Свободные слоты заполнены нулями и никогда
+    не проходят порог.
+    """
+
+    def __init__(self, capacity: int = SEMANTIC_CACHE_SIZE, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 ttl: float = SEMANTIC_CACHE_TTL):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl = ttl
+        self._matrix: Optional[np.ndarray] = None
+        self._entries: List[Optional[Dict]] = [None] * capacity
+        self._last_used = np.zeros(capacity, dtype=np.float64)
+        self._by_question: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._hit_similarity_sum = 0.0
+
+    def _ensure_matrix(self, dim: int) -> None:
+        if self._matrix is None:
+            self._matrix = np.zeros((self.capacity, dim), dtype=np.float32)
+
+    def _free_slot_unlocked(self, slot: int) -> None:
+        entry = self._entries[slot]
+        if entry is None:
+            return
+        self._entries[slot] = None
+        self._matrix[slot] = 0.0
+        self._last_used[slot] = 0.0
+        self._by_question.pop(entry["question"], None)
+
+    def lookup(self, question: str, vector: Optional[np.ndarray] = None) -> Optional[Tuple[Dict, float, str]]:
+        """
+        Найти ответ на похожий вопрос
+
+        Returns:
+            (результат, similarity, исходный вопрос) или None
+        """
+        if self.capacity <= 0:
+            return None
+        if vector is None:
+            vector = embed_query(normalize_query(question))
+
+        with self._lock:
+            if self._matrix is None:
+                self.misses += 1
+                return None
+
+            scores = self._matrix @ vector.astype(np.float32, copy=False)
+            now = time.monotonic()
+            while True:
+                slot = int(np.argmax(scores))
+                similarity = float(scores[slot])
+                entry = self._entries[slot]
+                if entry is None or similarity < self.threshold:
+                    self.misses += 1
+                    return None
+                if entry["expires_at"] > now:
+                    break
+                self._free_slot_unlocked(slot)
+                self.expirations += 1
+                scores[slot] = -1.0
+
+            self._last_used[slot] = now
+            self.hits += 1
+            self._hit_similarity_sum += similarity
+            return entry["result"], similarity, entry["question"]
+
+    def store(self, question: str, result: Dict, sources: List[int], vector: Optional[np.ndarray] = None) -> None:
+        """
+        Сохранить ответ; при заполнении вытесняется давно не использованная запись
+        """
+        if self.capacity <= 0:
+            return
+        question = normalize_query(question)
+        if vector is None:
+            vector = embed_query(question)
+
+        with self._lock:
+            self._ensure_matrix(len(vector))
+            slot = self._by_question.get(question)
+            if slot is None:
+                free = [i for i, entry in enumerate(self._entries) if entry is None]
+                if free:
+                    slot = free[0]
+                else:
+                    slot = int(np.argmin(self._last_used))
+                    self._free_slot_unlocked(slot)
+                    self.evictions += 1
+
+            now = time.monotonic()
+            self._entries[slot] = {
+                "question": question,
+                "result": result,
+                "sources": set(sources),
+                "expires_at": now + self.ttl
+            }
+            self._matrix[slot] = vector
+            self._last_used[slot] = now
+            self._by_question[question] = slot
+
+    def invalidate(self, qa_ids: List[int]) -> int:
+        """
+        Удалить ответы, построенные на изменённых QA парах
+        """
+        qa_ids = set(qa_ids)
+        with self._lock:
+            slots = [
+                slot for slot, entry in enumerate(self._entries)
+                if entry is not None and entry["sources"] & qa_ids
+            ]
+            for slot in slots:
+                self._free_slot_unlocked(slot)
+            self.invalidations += len(slots)
+            return len(slots)
+
+    def clear(self) -> None:
+        with self._lock:
+            for slot in range(self.capacity):
+                self._free_slot_unlocked(slot)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": SEMANTIC_CACHE_ENABLED,
+                "entries": len(self._by_question),
+                "capacity": self.capacity,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / max(self.hits + self.misses, 1) * 100,
+                "avg_hit_similarity": self._hit_similarity_sum / max(self.hits, 1)
+            }
+
+
+# Глобальный экземпляр (singleton)
+_global_semantic_cache = None
+_global_semantic_cache_lock = threading.Lock()
+
+
+def get_semantic_cache() -> SemanticCache:
+    """
+    Получить глобальный семантический кэш (singleton)
+    """
+    global _global_semantic_cache
+    if _global_semantic_cache is None:
+        with _global_semantic_cache_lock:
+            if _global_semantic_cache is None:
+                _global_semantic_cache = SemanticCache()
+                register_invalidation_handler(_global_semantic_cache.invalidate)
+    return _global_semantic_cache
+
+
+def lookup_answer(question: str) -> Optional[Tuple[Dict, float, str]]:
+    """
+    Найти закэшированный ответ на похожий вопрос (None если кэш выключен или промах)
+    """
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+    try:
+        return get_semantic_cache().lookup(question)
+    except Exception as e:
+        logger.error(f"Ошибка поиска в семантическом кэше: {e}")
+        return None
+
+
+def store_answer(question: str, result: Dict) -> None:
+    """
+    Сохранить найденный ответ агента (ответы "не найдено" не кэшируются:
+    похожий вопрос вполне может иметь ответ)
+    """
+    if not SEMANTIC_CACHE_ENABLED or not result.get("found") or not result.get("sources"):
+        return
+    try:
+        get_semantic_cache().store(question, result, result["sources"])
+    except Exception as e:
+        logger.error(f"Ошибка записи в семантический кэш: {e}")
@@ -0,0 +1,276 @@
+"""
+Сервис синонимов
+- Словарь синонимов компилируется в автомат Aho-Corasick над последовательностями
+  лемм: фразы ("заработная плата", "больничный лист") находятся в запросе
+  за один линейный проход, в любой грамматической форме
+- Таблица расширений строится заранее: транзитивное замыкание графа синонимов
+  до глубины SYNONYM_CLOSURE_DEPTH; синоним также расширяется в свой термин
+  и его прямые синонимы ("заработная плата" -> "зарплата", "зп", ...)
+- Горячая перезагрузка: если задан SYNONYMS_FILE (JSON {термин: [синонимы]}),
+  файл перечитывается при изменении без перезапуска воркеров
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from dotenv import load_dotenv
+
+from app.services.lemmatizer_service import get_lemmatizer
+
+load_dotenv()
+
+SYNONYMS_FILE = os.getenv("SYNONYMS_FILE", "")
+SYNONYMS_RELOAD_INTERVAL = float(os.getenv("SYNONYMS_RELOAD_INTERVAL", "5"))
+SYNONYM_CLOSURE_DEPTH = int(os.getenv("SYNONYM_CLOSURE_DEPTH", "2"))
+
+PUNCTUATION = '.,!?:;'
+
+# Встроенный словарь синонимов для финансовых терминов (если не задан SYNONYMS_FILE)
+SYNONYMS = {
+    # Зарплата (все формы приводятся к базовой лемме + контекстные глаголы)
+    "зарплата": ["заработная плата", "з/п", "зп", "оплата труда", "выплата", "заработок", "зарплату", "зарплаты", "платят", "платить", "выплачивают", "переводят"],
+    "зарплату": ["зарплата", "заработная плата", "з/п", "зп", "оплата труда", "выплата", "заработок", "зарплаты", "платят", "платить", "выплачивают", "переводят"],
+    "зарплаты": ["зарплата", "заработная плата", "з/п", "зп", "оплата труда", "выплата", "заработок", "зарплату", "платят", "платить", "выплачивают", "переводят"],
+
+    # Глаголы получения зарплаты
+    "платить": ["выплачивать", "переводить", "выдавать", "получать", "перечислять"],
+    "платят": ["выплачивают", "переводят", "выдают", "получать", "перечисляют", "платить"],
+    "получить": ["оформить", "взять", "забрать", "получать"],
+    "получать": ["получить", "оформить", "взять", "забрать"],
+
+    # Время
+    "когда": ["какого числа", "в какой день", "дата", "срок", "время"],
+    "дата": ["число", "день", "срок", "когда"],
+
+    # Отпуск
+    "отпуск": ["отпускные", "отдых", "vacation", "каникулы"],
+    "отпускные": ["отпуск", "отдых", "vacation"],
+
+    # Больничный
+    "больничный": ["больничный лист", "болезнь", "sick leave", "больничка"],
+
+    # Документы
+    "справка": ["документ", "бумага", "certificate"],
+    "договор": ["контракт", "соглашение", "contract"],
+
+    # Выплаты
+    "премия": ["бонус", "надбавка", "поощрение"],
+    "аванс": ["предоплата", "задаток"],
+
+    # Налоги
+    "налог": ["налоги", "сбор", "отчисление", "tax"],
+    "ндфл": ["подоходный налог", "налог на доходы"],
+
+    # Работа
+    "работа": ["должность", "позиция", "job", "работать"],
+    "уволиться": ["увольнение", "resign", "quit"],
+
+    # Время работы
+    "график": ["расписание", "режим работы", "schedule"],
+    "удаленка": ["удаленная работа", "remote", "дистанционка"],
+
+    # Общие
+    "как": ["каким образом", "способ"],
+    "где": ["место", "адрес", "локация"],
+}
+
+
+def split_words(text: str) -> List[str]:
+    """
+    Слова текста в lowercase без знаков препинания по краям
+    """
+    words = (word.strip(PUNCTUATION) for word in text.lower().split())
+    return [word for word in words if word]
+
+
+def lemma_sequence(text: str) -> Tuple[str, ...]:
+    return tuple(get_lemmatizer().lemmatize_batch(split_words(text)))
+
+
+class _Node:
+    __slots__ = ("goto", "fail", "outputs")
+
+    def __init__(self):
+        self.goto: Dict[str, "_Node"] = {}
+        self.fail: Optional["_Node"] = None
+        # (длина паттерна, паттерн) для всех паттернов, заканчивающихся в узле
+        self.outputs: List[Tuple[int, Tuple[str, ...]]] = []
+
+
+class SynonymMatcher:
+    """
+    Скомпилированный словарь синонимов: автомат Aho-Corasick по леммам
+    + таблица расширений для каждого паттерна
+    """
+
+    def __init__(self, synonyms: Dict[str, List[str]], closure_depth: int = SYNONYM_CLOSURE_DEPTH):
+        self.closure_depth = closure_depth
+        self._root = _Node()
+        self._expansions: Dict[Tuple[str, ...], Set[str]] = {}
+        self._compile(synonyms)
+
+    def _compile(self, synonyms: Dict[str, List[str]]) -> None:
+        surfaces: Dict[Tuple[str, ...], Set[str]] = {}
+        # термин -> синонимы и обратные рёбра синоним -> термины
+        forward: Dict[Tuple[str, ...], Set[Tuple[str, ...]]] = {}
+        reverse: Dict[Tuple[str, ...], Set[Tuple[str, ...]]] = {}
+
+        def phrase(text: str) -> Tuple[str, ...]:
+            lemmas = lemma_sequence(text)
+            if lemmas:
+                surfaces.setdefault(lemmas, set()).add(' '.join(split_words(text)))
+                forward.setdefault(lemmas, set())
+                reverse.setdefault(lemmas, set())
+            return lemmas
+
+        for term, term_synonyms in synonyms.items():
+            source = phrase(term)
+            for synonym in term_synonyms:
+                target = phrase(synonym)
+                if source and target and source != target:
+                    forward[source].add(target)
+                    reverse[target].add(source)
+
+        for pattern in forward:
+            reached = self._closure(pattern, forward, self.closure_depth)
+            for term in reverse[pattern]:
+                reached |= self._closure(term, forward, 1)
+            self._expansions[pattern] = set().union(*(surfaces[other] for other in reached))
+            self._insert(pattern)
+        self._build_fail_links()
+
+    @staticmethod
+    def _closure(pattern: Tuple[str, ...], edges, max_depth: int) -> Set[Tuple[str, ...]]:
+        reached = {pattern}
+        queue = deque([(pattern, 0)])
+        while queue:
+            current, depth = queue.popleft()
+            if depth >= max_depth:
+                continue
+            for other in edges[current]:
+                if other not in reached:
+                    reached.add(other)
+                    queue.append((other, depth + 1))
+        return reached
+
+    def _insert(self, pattern: Tuple[str, ...]) -> None:
+        node = self._root
+        for lemma in pattern:
+            node = node.goto.setdefault(lemma, _Node())
+        node.outputs.append((len(pattern), pattern))
+
+    def _build_fail_links(self) -> None:
+        self._root.fail = self._root
+        queue = deque()
+        for child in self._root.goto.values():
+            child.fail = self._root
+            queue.append(child)
+
+        while queue:
+            node = queue.popleft()
+            for lemma, child in node.goto.items():
+                fail = node.fail
+                while fail is not self._root and lemma not in fail.goto:
+                    fail = fail.fail
+                child.fail = fail.goto.get(lemma, self._root)
+                if child.fail is child:
+                    child.fail = self._root
+                child.outputs = child.outputs + child.fail.outputs
+                queue.append(child)
+
+    def match(self, lemmas: Iterable[str]) -> List[Tuple[int, int, Tuple[str, ...]]]:
+        """
+        Все вхождения паттернов в последовательность лемм (один проход)
+
+        Returns:
+            список (начало, конец, паттерн)
+        """
+        matches = []
+        node = self._root
+        for position, lemma in enumerate(lemmas):
+            while node is not self._root and lemma not in node.goto:
+                node = node.fail
+            node = node.goto.get(lemma, self._root)
+            for length, pattern in node.outputs:
+                matches.append((position - length + 1, position + 1, pattern))
+        return matches
+
+    def expansions(self, pattern: Tuple[str, ...]) -> Set[str]:
+        return self._expansions.get(pattern, set())
+
+    def get_stats(self) -> dict:
+        return {
+            "patterns": len(self._expansions),
+            "closure_depth": self.closure_depth,
+            "expansions": sum(len(values) for values in self._expansions.values())
+        }
+
+
+def _load_synonyms_file(path: str) -> Dict[str, List[str]]:
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError("синонимы должны быть JSON объектом {термин: [синонимы]}")
+    return {str(term): [str(synonym) for synonym in synonyms] for term, synonyms in data.items()}
+
+
+# Текущий скомпилированный словарь (singleton, подменяется при перезагрузке)
+_global_matcher = None
+_matcher_lock = threading.Lock()
+_source_mtime = None
+_checked_at = 0.0
+
+
+def _file_mtime() -> Optional[int]:
+    try:
+        return os.stat(SYNONYMS_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _compile_current(mtime: Optional[int]) -> SynonymMatcher:
+    """
+    Скомпилировать словарь из SYNONYMS_FILE (или встроенный SYNONYMS)
+    При ошибке чтения файла остаётся предыдущий словарь
+    """
+    global _global_matcher, _source_mtime
+    synonyms = SYNONYMS
+    if SYNONYMS_FILE and mtime is not None:
+        try:
+            synonyms = _load_synonyms_file(SYNONYMS_FILE)
+        except Exception as e:
+            print(f"❌ Synonyms file error ({SYNONYMS_FILE}): {e}")
+            if _global_matcher is not None:
+                _source_mtime = mtime
+                return _global_matcher
+
+    started = time.perf_counter()
+    _global_matcher = SynonymMatcher(synonyms)
+    _source_mtime = mtime
+    print(
+        f"✅ Synonyms compiled: {_global_matcher.get_stats()['patterns']} patterns "
+        f"in {(time.perf_counter() - started) * 1000:.1f}ms"
+    )
+    return _global_matcher
+
+
+def get_synonym_matcher() -> SynonymMatcher:
+    """
+    Получить скомпилированный словарь синонимов
+    Если задан SYNONYMS_FILE, не чаще раза в SYNONYMS_RELOAD_INTERVAL секунд
+    проверяет mtime файла и перекомпилирует словарь при изменении
+    """
+    global _checked_at
+    matcher = _global_matcher
+    now = time.monotonic()
+    if matcher is not None and (not SYNONYMS_FILE or now - _checked_at < SYNONYMS_RELOAD_INTERVAL):
+        return matcher
+
+    with _matcher_lock:
+        _checked_at = now
+        mtime = _file_mtime() if SYNONYMS_FILE else None
+        if _global_matcher is None or mtime != _source_mtime:
+            return _compile_current(mtime)
+        return _global_matcher
@@ -4,67 +4,10 @@
 - Расширение запроса синонимами
 - Нормализация текста
 """
-from typing import List, Set
-
-# Инициализация морфологического анализатора для русского языка
-try:
-    import pymorphy2
-    morph = pymorphy2.MorphAnalyzer()
-    PYMORPHY_AVAILABLE = True
-    print("✅ Pymorphy2 loaded successfully")
-except Exception as e:
-    print(f"⚠️  Pymorphy2 not available: {e}. Lemmatization will use simple fallback.")
-    morph = None
-    PYMORPHY_AVAILABLE = False
-
-# Словарь синонимов для финансовых терминов
-SYNONYMS = {
-    # Зарплата (все формы приводятся к базовой лемме + контекстные глаголы)
-    "зарплата": ["заработная плата", "з/п", "зп", "оплата труда", "выплата", "заработок", "зарплату", "зарплаты", "платят", "платить", "выплачивают", "переводят"],
-    "зарплату": ["зарплата", "заработная плата", "з/п", "зп", "оплата труда", "выплата", "заработок", "зарплаты", "платят", "платить", "выплачивают", "переводят"],
-    "зарплаты": ["зарплата", "заработная плата", "з/п", "зп", "оплата труда", "выплата", "заработок", "зарплату", "платят", "платить", "выплачивают", "переводят"],
-
-    # Глаголы получения зарплаты
-    "платить": ["выплачивать", "переводить", "выдавать", "получать", "перечислять"],
-    "платят": ["выплачивают", "переводят", "выдают", "получать", "перечисляют", "платить"],
-    "получить": ["оформить", "взять", "забрать", "получать"],
-    "получать": ["получить", "оформить", "взять", "забрать"],
-
-    # Время
-    "когда": ["какого числа", "в какой день", "дата", "срок", "время"],
-    "дата": ["число", "день", "срок", "когда"],
-
-    # Отпуск
-    "отпуск": ["отпускные", "отдых", "vacation", "каникулы"],
-    "отпускные": ["отпуск", "отдых", "vacation"],
-
-    # Больничный
-    "больничный": ["больничный лист", "болезнь", "sick leave", "больничка"],
-
-    # Документы
-    "справка": ["документ", "бумага", "certificate"],
-    "договор": ["контракт", "соглашение", "contract"],
-
-    # Выплаты
-    "премия": ["бонус", "надбавка", "поощрение"],
-    "аванс": ["предоплата", "задаток"],
-
-    # Налоги
-    "налог": ["налоги", "сбор", "отчисление", "tax"],
-    "ндфл": ["подоходный налог", "налог на доходы"],
-
-    # Работа
-    "работа": ["должность", "позиция", "job", "работать"],
-    "уволиться": ["увольнение", "resign", "quit"],
-
-    # Время работы
-    "график": ["расписание", "режим работы", "schedule"],
-    "удаленка": ["удаленная работа", "remote", "дистанционка"],
-
-    # Общие
-    "как": ["каким образом", "способ"],
-    "где": ["место", "адрес", "локация"],
-}
+from typing import Iterable, List, Set
+
+from app.services.lemmatizer_service import get_lemmatizer
+from app.services.synonym_service import get_synonym_matcher, lemma_sequence, split_words
 
 # Стоп-слова (не несут смысловой нагрузки)
 STOP_WORDS = {
@@ -81,28 +24,22 @@ def lemmatize_word(word: str) -> str:
     - "выплачивается" -> "выплачивать"
     - "работаем" -> "работать"
     """
-    if PYMORPHY_AVAILABLE and morph:
-        try:
-            parsed = morph.parse(word.lower())[0]
-            return parsed.normal_form
-        except:
-            pass
-
-    # Fallback: простое приведение к lowercase
-    return word.lower()
+    return get_lemmatizer().lemmatize(word)
 
 
 def get_synonyms(word: str) -> List[str]:
     """
-    Возвращает список синонимов для слова
+    Возвращает список синонимов для слова (или фразы)
     """
-    lemma = lemmatize_word(word)
-    return SYNONYMS.get(lemma, [])
+    expansions = get_synonym_matcher().expansions(lemma_sequence(word))
+    return sorted(expansions - {' '.join(split_words(word))})
 
 
 def expand_query_with_synonyms(query: str, include_lemmas: bool = True) -> str:
     """
     Расширяет запрос синонимами и леммами
+    Синонимы ищутся по леммам за один проход автомата, включая фразы
+    ("заработная плата", "больничный лист")
 
     Args:
         query: исходный запрос
@@ -114,33 +51,34 @@ def expand_query_with_synonyms(query: str, include_lemmas: bool = True) -> str:
     Пример:
         "Когда зарплата?" -> "когда какого числа дата зарплата з/п оплата труда"
     """
-    words = query.lower().split()
-    expanded_words: Set[str] = set()
+    words = split_words(query)
+    lemmas = get_lemmatizer().lemmatize_batch(words)
+    return ' '.join(sorted(expand_lemmas(words, lemmas, include_lemmas)))
 
-    for word in words:
-        # Убираем знаки препинания
-        clean_word = word.strip('.,!?:;')
 
-        if not clean_word or clean_word in STOP_WORDS:
-            continue
+def expand_lemmas(words: List[str], lemmas: List[str], include_lemmas: bool = True) -> Set[str]:
+    """
+    Расширение уже разобранного запроса (слова + их леммы) синонимами
+    """
+    expanded_words: Set[str] = set()
 
-        # Добавляем исходное слово
-        expanded_words.add(clean_word)
+    for word, lemma in zip(words, lemmas):
+        if word in STOP_WORDS:
+            continue
 
-        # Добавляем лемму
+        # Добавляем исходное слово и лемму
+        expanded_words.add(word)
         if include_lemmas:
-            lemma = lemmatize_word(clean_word)
             expanded_words.add(lemma)
 
-            # Добавляем синонимы леммы
-            synonyms = get_synonyms(lemma)
-            expanded_words.update(synonyms)
-        else:
-            # Синонимы исходного слова
-            synonyms = get_synonyms(clean_word)
-            expanded_words.update(synonyms)
+    matcher = get_synonym_matcher()
+    for start, end, pattern in matcher.match(lemmas):
+        # Одиночные стоп-слова не расширяем
+        if end - start == 1 and words[start] in STOP_WORDS:
+            continue
+        expanded_words.update(matcher.expansions(pattern))
 
-    return ' '.join(sorted(expanded_words))
+    return expanded_words
 
 
 def normalize_query(query: str) -> str:
@@ -158,33 +96,64 @@ def normalize_query(query: str) -> str:
     return ' '.join(query.lower().split())
 
 
-def extract_keywords(text: str, min_length: int = 3) -> List[str]:
+def tokenize_lemmas(text: str, min_length: int = 3) -> List[str]:
     """
-    Извлекает ключевые слова из текста
+    Разбивает текст на леммы с сохранением повторов (для подсчёта частот)
     - Приводит к леммам
     - Убирает стоп-слова
     - Фильтрует по минимальной длине
     """
-    words = text.lower().split()
-    keywords = []
+    # Лемматизация всех слов текста одним batch вызовом
+    lemmas = get_lemmatizer().lemmatize_batch(clean_words(text, min_length))
 
-    for word in words:
-        # Очистка от знаков препинания
-        clean_word = word.strip('.,!?:;-—')
+    # Пропускаем стоп-слова
+    return [lemma for lemma in lemmas if lemma not in STOP_WORDS]
 
-        if not clean_word or len(clean_word) < min_length:
-            continue
 
-        # Лемматизация
-        lemma = lemmatize_word(clean_word)
+def keywords_from_lemmas(lemmas: Iterable[str]) -> List[str]:
+    """
+    Ключевые слова из лемм: без стоп-слов и дубликатов
+    """
+    return list({lemma for lemma in lemmas if lemma not in STOP_WORDS})
+
+
+def clean_words(text: str, min_length: int = 3) -> List[str]:
+    """
+    Слова текста без знаков препинания, не короче min_length
+    """
+    words = (word.strip('.,!?:;-—') for word in text.lower().split())
+    return [word for word in words if word and len(word) >= min_length]
 
-        # Пропускаем стоп-слова
-        if lemma in STOP_WORDS:
-            continue
 
-        keywords.append(lemma)
+def preload_lemmas(texts: Iterable[str]) -> int:
+    """
+    Заранее лемматизировать словарь текстов (например, всей базы знаний),
+    чтобы поиск не вызывал pymorphy2 для известных слов
+    Returns: размер таблицы лемм
+    """
+    vocabulary = set()
+    for text in texts:
+        if text:
+            vocabulary.update(clean_words(text, 1))
+    return get_lemmatizer().preload(vocabulary)
+
+
+def keyword_lemma(keyword: str) -> str:
+    """
+    Нормальная форма ключевого слова для keywords.lemma: леммы слов через пробел
+    Пример: "Выплаты зарплаты" -> "выплата зарплата"
+    """
+    return ' '.join(get_lemmatizer().lemmatize_batch(clean_words(keyword, 1)))
 
-    return list(set(keywords))  # Убираем дубликаты
+
+def extract_keywords(text: str, min_length: int = 3) -> List[str]:
+    """
+    Извлекает ключевые слова из текста
+    - Приводит к леммам
+    - Убирает стоп-слова
+    - Фильтрует по минимальной длине
+    """
+    return list(set(tokenize_lemmas(text, min_length)))  # Убираем дубликаты
 
 
 def enhance_search_query(query: str) -> dict:
@@ -202,7 +171,7 @@ def enhance_search_query(query: str) -> dict:
     return {
         "original": query,
         "normalized": normalize_query(query),
-        "with_lemmas": ' '.join([lemmatize_word(w) for w in query.split()]),
+        "with_lemmas": ' '.join(get_lemmatizer().lemmatize_batch(query.split())),
         "with_synonyms": expand_query_with_synonyms(query),
         "keywords": extract_keywords(query)
     }
@@ -0,0 +1,46 @@
+"""
+Загрузка файлов без буферизации всего тела в памяти
+- spool_upload копирует UploadFile во временный файл блоками по UPLOAD_CHUNK_SIZE
+- Размер ограничивается при копировании (max_bytes), а не после чтения
+"""
+import os
+import tempfile
+from typing import Optional
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    """Загруженный файл больше допустимого размера"""
+
+    def __init__(self, max_bytes: int):
+        super().__init__(f"Файл больше {max_bytes // (1024 * 1024)} МБ")
+        self.max_bytes = max_bytes
+
+
+def spool_upload(upload, suffix: str = "", max_bytes: Optional[int] = None) -> str:
+    """
+    Сохранить загруженный файл во временный файл на диске (копирование блоками)
+
+    Returns:
+        путь к временному файлу (удаляет вызывающий)
+    Raises:
+        UploadTooLarge: файл больше max_bytes (временный файл удаляется)
+    """
+    upload.file.seek(0)
+    written = 0
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as spooled:
+        try:
+            while True:
+                chunk = upload.file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if max_bytes is not None and written > max_bytes:
+                    raise UploadTooLarge(max_bytes)
+                spooled.write(chunk)
+        except BaseException:
+            spooled.close()
+            os.remove(spooled.name)
+            raise
+        return spooled.name
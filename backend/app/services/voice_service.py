@@ -0,0 +1,313 @@
+"""
+Распознавание голосовых записей без буферизации всего файла
+- Загрузка копируется во временный файл блоками (upload_service.spool_upload),
+  размер ограничен VOICE_MAX_UPLOAD_BYTES
+- Реальный MIME тип определяется по сигнатуре файла, а не по Content-Type
+- Длинные WAV (PCM) и MP3 режутся на сегменты по VOICE_SEGMENT_SECONDS
+  (и не больше VOICE_SEGMENT_MAX_BYTES): WAV - по фреймам с новым заголовком,
+  MP3 - по границам MPEG фреймов
+- Сегменты распознаются конкурентно через rate limiter, текст склеивается
+  по порядку и одним запросом делится на вопрос и ответ
+"""
+import asyncio
+import logging
+import mmap
+import os
+import struct
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+from dotenv import load_dotenv
+
+from app.services.executor_service import run_blocking
+from app.services.gemini_service import rate_limiter, split_transcript_async, transcribe_audio_async
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+VOICE_MAX_UPLOAD_BYTES = int(os.getenv("VOICE_MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+VOICE_SEGMENT_SECONDS = int(os.getenv("VOICE_SEGMENT_SECONDS", "120"))
+VOICE_SEGMENT_MAX_BYTES = int(os.getenv("VOICE_SEGMENT_MAX_BYTES", str(15 * 1024 * 1024)))
+
+# Лимит inline данных в запросе Gemini (файлы, которые нельзя разрезать)
+GEMINI_INLINE_MAX_BYTES = 20 * 1024 * 1024
+
+# Сколько байт читать для определения типа
+SIGNATURE_BYTES = 12
+
+# MPEG audio: битрейты (кбит/с) по (версия MPEG1?, layer) и частоты по версии
+MP3_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG1
+    2: [22050, 24000, 16000],  # MPEG2
+    0: [11025, 12000, 8000],   # MPEG2.5
+}
+
+
+class VoiceFileError(Exception):
+    """Файл не является поддерживаемой аудиозаписью"""
+
+
+@dataclass
+class AudioSegment:
+    """
+    Фрагмент записи: байты [offset, offset + length) исходного файла
+    (для WAV - с собственным заголовком)
+    """
+    index: int
+    start: float
+    duration: float
+    offset: int
+    length: int
+    header: bytes = b""
+
+    def read(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            f.seek(self.offset)
+            return self.header + f.read(self.length)
+
+
+def detect_audio_type(path: str) -> Optional[str]:
+    """
+    MIME тип по сигнатуре файла (None - не аудио / неизвестный формат)
+    """
+    with open(path, "rb") as f:
+        head = f.read(SIGNATURE_BYTES)
+
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "audio/wav"
+    if head[:3] == b"ID3":
+        return "audio/mpeg"
+    if head[:4] == b"OggS":
+        return "audio/ogg"
+    if head[:4] == b"fLaC":
+        return "audio/flac"
+    if head[:4] == b"FORM" and head[8:12] in (b"AIFF", b"AIFC"):
+        return "audio/aiff"
+    if head[4:8] == b"ftyp":
+        return "audio/mp4"
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "audio/webm"
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        # Синхрослово MPEG: layer 00 - AAC ADTS, иначе MP3
+        return "audio/aac" if head[1] & 0x06 == 0 else "audio/mpeg"
+    return None
+
+
+def _wav_chunks(data) -> Tuple[Optional[bytes], int, int]:
+    """
+    Найти fmt и data чанки RIFF
+
+    Returns:
+        (содержимое fmt, смещение данных, длина данных)
+    """
+    fmt, position = None, 12
+    while position + 8 <= len(data):
+        chunk_id = bytes(data[position:position + 4])
+        chunk_size = struct.unpack("<I", data[position + 4:position + 8])[0]
+        body = position + 8
+        if chunk_id == b"fmt ":
+            fmt = bytes(data[body:body + chunk_size])
+        elif chunk_id == b"data":
+            return fmt, body, min(chunk_size, len(data) - body)
+        position = body + chunk_size + (chunk_size & 1)
+    return fmt, 0, 0
+
+
+def _wav_header(fmt: bytes, data_length: int) -> bytes:
+    return (
+        b"RIFF" + struct.pack("<I", 4 + 8 + len(fmt) + 8 + data_length) + b"WAVE"
+        + b"fmt " + struct.pack("<I", len(fmt)) + fmt
+        + b"data" + struct.pack("<I", data_length)
+    )
+
+
+def split_wav(path: str, segment_seconds: float, max_bytes: int) -> Tuple[float, List[AudioSegment]]:
+    """
+    Разрезать PCM WAV по целым фреймам
+
+    Returns:
+        (длительность в секундах, сегменты); для не-PCM - один сегмент на весь файл
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        fmt, data_offset, data_length = _wav_chunks(data)
+
+    if not fmt or len(fmt) < 16 or not data_length:
+        raise VoiceFileError("Повреждённый WAV файл")
+
+    format_tag, _, sample_rate, byte_rate, block_align = struct.unpack("<HHIIH", fmt[:14])
+    duration = data_length / byte_rate if byte_rate else 0.0
+    if format_tag != 1 or not block_align or not byte_rate:
+        size = os.path.getsize(path)
+        return duration, [AudioSegment(0, 0.0, duration, 0, size)]
+
+    frames_per_segment = max(1, min(
+        int(segment_seconds * sample_rate),
+        (max_bytes - 64) // block_align
+    ))
+    segment_bytes = frames_per_segment * block_align
+
+    segments = []
+    for index, start in enumerate(range(0, data_length - data_length % block_align, segment_bytes)):
+        length = min(segment_bytes, data_length - start) // block_align * block_align
+        segments.append(AudioSegment(
+            index=index,
+            start=start / byte_rate,
+            duration=length / byte_rate,
+            offset=data_offset + start,
+            length=length,
+            header=_wav_header(fmt, length)
+        ))
+    return duration, segments
+
+
+def _mp3_frame(data, position: int) -> Optional[Tuple[int, int, int]]:
+    """
+    Разобрать заголовок MPEG фрейма
+
+    Returns:
+        (длина фрейма в байтах, сэмплов во фрейме, частота) или None
+    """
+    if position + 4 > len(data):
+        return None
+    b1, b2 = data[position + 1], data[position + 2]
+    if data[position] != 0xFF or b1 & 0xE0 != 0xE0:
+        return None
+
+    version = (b1 >> 3) & 0x03
+    layer = 4 - ((b1 >> 1) & 0x03)
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 0x03
+    padding = (b2 >> 1) & 0x01
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+    if layer == 3 and not mpeg1:
+        return 72 * bitrate // sample_rate + padding, 576, sample_rate
+    return 144 * bitrate // sample_rate + padding, 1152, sample_rate
+
+
+def split_mp3(path: str, segment_seconds: float, max_bytes: int) -> Tuple[float, List[AudioSegment]]:
+    """
+    Разрезать MP3 по границам MPEG фреймов (ID3 теги пропускаются)
+
+    Returns:
+        (длительность в секундах, сегменты)
+    """
+    segments: List[AudioSegment] = []
+    total = 0.0
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        position = 0
+        if data[:3] == b"ID3" and len(data) >= 10:
+            tag_size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+            position = 10 + tag_size
+
+        segment_start, segment_offset, segment_duration = 0.0, None, 0.0
+
+        def close_segment(end: int) -> None:
+            if segment_offset is not None and end > segment_offset:
+                segments.append(AudioSegment(
+                    index=len(segments),
+                    start=segment_start,
+                    duration=segment_duration,
+                    offset=segment_offset,
+                    length=end - segment_offset
+                ))
+
+        while position < len(data):
+            frame = _mp3_frame(data, position)
+            if frame is None or frame[0] <= 0:
+                # Мусор между фреймами / тег в конце - ищем следующее синхрослово
+                next_sync = data.find(b"\xff", position + 1)
+                if next_sync == -1:
+                    break
+                position = next_sync
+                continue
+
+            frame_length, samples, sample_rate = frame
+            frame_duration = samples / sample_rate
+            if segment_offset is None:
+                segment_offset = position
+            elif (segment_duration + frame_duration > segment_seconds
+                  or position + frame_length - segment_offset > max_bytes):
+                close_segment(position)
+                segment_start, segment_offset, segment_duration = total, position, 0.0
+
+            segment_duration += frame_duration
+            total += frame_duration
+            position += frame_length
+
+        close_segment(min(position, len(data)))
+
+    if not segments:
+        raise VoiceFileError("Не найдено MPEG фреймов")
+    return total, segments
+
+
+def plan_segments(path: str, mime_type: str) -> Tuple[Optional[float], List[AudioSegment]]:
+    """
+    Сегменты для распознавания: WAV и MP3 режутся, остальные форматы
+    отправляются целиком (не больше лимита inline данных Gemini)
+
+    Returns:
+        (длительность или None, если неизвестна; сегменты)
+    """
+    if mime_type == "audio/wav":
+        return split_wav(path, VOICE_SEGMENT_SECONDS, VOICE_SEGMENT_MAX_BYTES)
+    if mime_type == "audio/mpeg":
+        return split_mp3(path, VOICE_SEGMENT_SECONDS, VOICE_SEGMENT_MAX_BYTES)
+
+    size = os.path.getsize(path)
+    if size > GEMINI_INLINE_MAX_BYTES:
+        raise VoiceFileError(
+            f"Файл {mime_type} больше {GEMINI_INLINE_MAX_BYTES // (1024 * 1024)} МБ: "
+            f"длинные записи поддерживаются в WAV и MP3"
+        )
+    return None, [AudioSegment(0, 0.0, 0.0, 0, size)]
+
+
+async def transcribe_file_async(path: str, mime_type: str) -> str:
+    """
+    Распознать запись: текст в формате "ВОПРОС: ... ОТВЕТ: ..."
+
+    Одиночный сегмент - один запрос (распознавание и деление на вопрос/ответ),
+    несколько - конкурентное распознавание сегментов, склейка и деление текста
+
+    Raises:
+        VoiceFileError: файл нельзя разобрать
+        VoiceTranscriptionError: ошибка Gemini (в том числе для одного из сегментов)
+    """
+    duration, segments = await run_blocking(plan_segments, path, mime_type)
+    logger.info(
+        f"🎙️ Voice file: {mime_type}, {os.path.getsize(path)} bytes, "
+        f"{f'{duration:.1f}s' if duration is not None else 'unknown duration'}, {len(segments)} segment(s)"
+    )
+
+    if len(segments) == 1:
+        audio = await run_blocking(segments[0].read, path)
+        return await transcribe_audio_async(audio, mime_type)
+
+    semaphore = asyncio.Semaphore(rate_limiter.max_concurrent)
+
+    async def transcribe(segment: AudioSegment) -> str:
+        async with semaphore:
+            # Сегмент читается с диска только на время запроса
+            audio = await run_blocking(segment.read, path)
+            return await transcribe_audio_async(audio, mime_type, split_qa=False)
+
+    transcripts = await asyncio.gather(*[transcribe(segment) for segment in segments])
+    return await split_transcript_async("\n".join(text.strip() for text in transcripts if text.strip()))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный бенчмарк API: p50/p99 латентности при разной конкурентности.
+Если обработчики не блокируют event loop, латентность быстрых запросов
+остаётся примерно постоянной при росте числа одновременных клиентов.
+
+Использование:
+    python benchmark_load.py --url http://localhost:8000 --requests 200 --concurrency 1 8 32
+    python benchmark_load.py --path "/api/slack/search?query=когда зарплата" --api-key $SLACK_API_KEY
+"""
+
+import argparse
+import statistics
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit, urlunsplit
+
+DEFAULT_PATHS = ["/health", "/api/pending", "/api/qa?limit=20"]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def quote_url(url):
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme, parts.netloc, quote(parts.path), quote(parts.query, safe="=&"), ""))
+
+
+def timed_request(url, headers):
+    started = time.perf_counter()
+    try:
+        request = urllib.request.Request(url, headers=headers)
+        with urllib.request.urlopen(request, timeout=60) as response:
+            response.read()
+            ok = 200 <= response.status < 300
+    except Exception:
+        ok = False
+    return (time.perf_counter() - started) * 1000, ok
+
+
+def run_level(url, headers, total, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        started = time.perf_counter()
+        results = list(pool.map(lambda _: timed_request(url, headers), range(total)))
+        elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, ok in results if ok]
+    errors = sum(1 for _, ok in results if not ok)
+    if not latencies:
+        return {"concurrency": concurrency, "errors": errors}
+
+    return {
+        "concurrency": concurrency,
+        "p50_ms": statistics.median(latencies),
+        "p99_ms": percentile(latencies, 99),
+        "rps": len(latencies) / elapsed,
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк FinWiki API")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--path", action="append", help="путь запроса (можно указать несколько раз)")
+    parser.add_argument("--requests", type=int, default=200, help="запросов на каждый уровень")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--api-key", default=None, help="значение заголовка X-API-Key")
+    args = parser.parse_args()
+
+    headers = {"X-API-Key": args.api_key} if args.api_key else {}
+
+    for path in args.path or DEFAULT_PATHS:
+        url = quote_url(args.url.rstrip("/") + path)
+        print(f"\n{path}")
+        print(f"{'conc':>6} {'p50 ms':>10} {'p99 ms':>10} {'rps':>8} {'errors':>7}")
+        for concurrency in args.concurrency:
+            stats = run_level(url, headers, args.requests, concurrency)
+            if "p50_ms" not in stats:
+                print(f"{concurrency:>6} {'-':>10} {'-':>10} {'-':>8} {stats['errors']:>7}")
+                continue
+            print(
+                f"{concurrency:>6} {stats['p50_ms']:>10.1f} {stats['p99_ms']:>10.1f} "
+                f"{stats['rps']:>8.1f} {stats['errors']:>7}"
+            )
+
+
+if __name__ == "__main__":
+    main()
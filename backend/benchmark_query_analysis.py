@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Микро-бенчмарк анализа запроса: стоимость разбора одного запроса
+для всех уровней поиска до и после AnalyzedQuery.
+
+"До": каждый уровень сам вызывает extract_keywords / expand_query_with_synonyms /
+embed_query (keyword + full-text + coverage + semantic), как было раньше.
+"После": один analyze_query на запрос, уровни читают готовые поля.
+
+Использование:
+    python benchmark_query_analysis.py --iterations 2000
+    python benchmark_query_analysis.py --cold   # с очисткой кэша лемм перед каждым запросом
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from app.services.embedding_service import embed_query
+from app.services.lemmatizer_service import get_lemmatizer
+from app.services.query_analysis_service import analyze_query
+from app.services.text_processing_service import expand_query_with_synonyms, extract_keywords
+
+QUERIES = [
+    "Когда зарплата?",
+    "Когда выплачивается заработная плата и аванс",
+    "Как оформить отпуск на следующей неделе?",
+    "Где получить справку 2-НДФЛ для банка",
+    "Больничный лист: куда отправлять и когда оплатят",
+    "График работы в праздники",
+]
+
+
+def analyze_per_tier(query):
+    # search_by_keywords
+    keywords = extract_keywords(query)
+    expanded = extract_keywords(expand_query_with_synonyms(query))
+    # search_full_text
+    keywords = extract_keywords(query)
+    expanded = extract_keywords(expand_query_with_synonyms(query))
+    # fulltext_coverage + проверка уверенности быстрых уровней
+    extract_keywords(query)
+    extract_keywords(query)
+    # search_semantic
+    embed_query(query)
+    return keywords, expanded
+
+
+def analyze_once(query):
+    analyzed = analyze_query(query)
+    analyzed.embedding
+    return analyzed.keywords, analyzed.all_keywords
+
+
+def measure(func, iterations, cold):
+    lemmatizer = get_lemmatizer()
+    elapsed = 0.0
+    for _ in range(iterations):
+        for query in QUERIES:
+            if cold:
+                lemmatizer.clear()
+            started = time.perf_counter()
+            func(query)
+            elapsed += time.perf_counter() - started
+    return elapsed / (iterations * len(QUERIES)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Стоимость анализа запроса до/после AnalyzedQuery")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--cold", action="store_true", help="очищать кэш лемм перед каждым запросом")
+    args = parser.parse_args()
+
+    # Прогрев (компиляция синонимов, backend эмбеддингов)
+    for query in QUERIES:
+        analyze_per_tier(query)
+        analyze_once(query)
+
+    before = measure(analyze_per_tier, args.iterations, args.cold)
+    after = measure(analyze_once, args.iterations, args.cold)
+
+    print(f"{'':<28} {'мкс/запрос':>12}")
+    print(f"{'до (разбор в каждом уровне)':<28} {before:>12.1f}")
+    print(f"{'после (AnalyzedQuery)':<28} {after:>12.1f}")
+    print(f"ускорение: x{before / after:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,7 @@ from dotenv import load_dotenv
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 from app.database import Base
-from app.models import QAPair, Keyword
+from app.models import QAPair, Keyword, Question, Job
 
 load_dotenv()
 
@@ -0,0 +1,62 @@
+from alembic import op
+from sqlalchemy import inspect
+
+
+revision = "20251215_0002"
+down_revision = "20251201_0001"
+branch_labels = None
+depends_on = None
+
+
+# Только для PostgreSQL: на SQLite миграция ничего не делает (остаётся ILIKE поиск)
+SEARCH_VECTOR_SQL = """
+    setweight(to_tsvector('russian', coalesce(question, '') || ' ' || coalesce(question_processed, '')), 'A') ||
+    setweight(to_tsvector('russian', coalesce(answer, '') || ' ' || coalesce(answer_processed, '')), 'B')
+"""
+
+TRIGRAM_INDEXES = {
+    "ix_keywords_keyword_trgm": ("keywords", "keyword"),
+    "ix_qa_pairs_question_trgm": ("qa_pairs", "question"),
+    "ix_qa_pairs_answer_trgm": ("qa_pairs", "answer"),
+}
+
+
+def is_postgres():
+    return op.get_bind().dialect.name == "postgresql"
+
+
+def column_exists(table_name, column_name):
+    bind = op.get_bind()
+    inspector = inspect(bind)
+    return column_name in [column["name"] for column in inspector.get_columns(table_name)]
+
+
+def upgrade():
+    if not is_postgres():
+        return
+
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+    if not column_exists("qa_pairs", "search_vector"):
+        op.execute(
+            f"ALTER TABLE qa_pairs ADD COLUMN search_vector tsvector "
+            f"GENERATED ALWAYS AS ({SEARCH_VECTOR_SQL}) STORED"
+        )
+    op.execute("CREATE INDEX IF NOT EXISTS ix_qa_pairs_search_vector ON qa_pairs USING GIN (search_vector)")
+
+    for index_name, (table_name, column_name) in TRIGRAM_INDEXES.items():
+        op.execute(
+            f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} "
+            f"USING GIN ({column_name} gin_trgm_ops)"
+        )
+
+
+def downgrade():
+    if not is_postgres():
+        return
+
+    for index_name in TRIGRAM_INDEXES:
+        op.execute(f"DROP INDEX IF EXISTS {index_name}")
+    op.execute("DROP INDEX IF EXISTS ix_qa_pairs_search_vector")
+    if column_exists("qa_pairs", "search_vector"):
+        op.execute("ALTER TABLE qa_pairs DROP COLUMN search_vector")
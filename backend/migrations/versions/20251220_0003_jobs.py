@@ -0,0 +1,56 @@
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import inspect
+
+
+revision = "20251220_0003"
+down_revision = "20251215_0002"
+branch_labels = None
+depends_on = None
+
+
+def table_exists(table_name):
+    bind = op.get_bind()
+    inspector = inspect(bind)
+    return table_name in inspector.get_table_names()
+
+
+def upgrade():
+    if not table_exists("jobs"):
+        op.create_table(
+            "jobs",
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("kind", sa.String, nullable=False),
+            sa.Column("payload", sa.Text, nullable=False, server_default="{}"),
+            sa.Column(
+                "status",
+                sa.Enum(
+                    "pending",
+                    "running",
+                    "done",
+                    "dead",
+                    name="jobstatus",
+                ),
+                nullable=False,
+                server_default="pending",
+            ),
+            sa.Column("attempts", sa.Integer, nullable=False, server_default="0"),
+            sa.Column("max_attempts", sa.Integer, nullable=False, server_default="5"),
+            sa.Column("run_after", sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+            sa.Column("locked_by", sa.String, nullable=True),
+            sa.Column("locked_at", sa.DateTime(timezone=True), nullable=True),
+            sa.Column("last_error", sa.Text, nullable=True),
+            sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+            sa.Column("finished_at", sa.DateTime(timezone=True), nullable=True),
+        )
+        op.create_index("ix_jobs_id", "jobs", ["id"])
+        op.create_index("ix_jobs_status_run_after", "jobs", ["status", "run_after"])
+
+
+def downgrade():
+    if table_exists("jobs"):
+        op.drop_index("ix_jobs_status_run_after", table_name="jobs")
+        op.drop_index("ix_jobs_id", table_name="jobs")
+        op.drop_table("jobs")
+        if op.get_bind().dialect.name == "postgresql":
+            op.execute("DROP TYPE IF EXISTS jobstatus")
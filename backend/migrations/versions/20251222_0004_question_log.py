@@ -0,0 +1,35 @@
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import inspect
+
+
+revision = "20251222_0004"
+down_revision = "20251220_0003"
+branch_labels = None
+depends_on = None
+
+
+QUESTION_COLUMNS = (
+    ("confidence", sa.Float),
+    ("sources", sa.Text),
+    ("timings", sa.Text),
+)
+
+
+def column_exists(table_name, column_name):
+    bind = op.get_bind()
+    inspector = inspect(bind)
+    return column_name in [column["name"] for column in inspector.get_columns(table_name)]
+
+
+def upgrade():
+    for name, column_type in QUESTION_COLUMNS:
+        if not column_exists("questions", name):
+            op.add_column("questions", sa.Column(name, column_type, nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("questions") as batch_op:
+        for name, _ in reversed(QUESTION_COLUMNS):
+            if column_exists("questions", name):
+                batch_op.drop_column(name)
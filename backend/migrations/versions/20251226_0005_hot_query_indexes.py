@@ -0,0 +1,81 @@
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import inspect
+
+
+revision = "20251226_0005"
+down_revision = "20251222_0004"
+branch_labels = None
+depends_on = None
+
+
+# Индексы под частые запросы (проверка планов - check_query_plans.py)
+INDEXES = {
+    "ix_qa_pairs_status_created_at": ("qa_pairs", ["status", "created_at"]),
+    "ix_keywords_qa_pair_id": ("keywords", ["qa_pair_id"]),
+    "ix_keywords_lemma": ("keywords", ["lemma"]),
+    "ix_questions_created_at": ("questions", ["created_at"]),
+}
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def column_exists(table_name, column_name):
+    bind = op.get_bind()
+    inspector = inspect(bind)
+    return column_name in [column["name"] for column in inspector.get_columns(table_name)]
+
+
+def index_exists(table_name, index_name):
+    bind = op.get_bind()
+    inspector = inspect(bind)
+    return index_name in [index["name"] for index in inspector.get_indexes(table_name)]
+
+
+def backfill_keyword_lemmas():
+    """
+    keywords.lemma для существующих строк (той же лемматизацией, что и при записи)
+    """
+    from app.services.text_processing_service import keyword_lemma
+
+    bind = op.get_bind()
+    keywords = sa.table("keywords", sa.column("id", sa.Integer), sa.column("keyword", sa.String),
+                        sa.column("lemma", sa.String))
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select(keywords.c.id, keywords.c.keyword)
+            .where(keywords.c.id > last_id, keywords.c.lemma.is_(None))
+            .order_by(keywords.c.id)
+            .limit(BACKFILL_BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            return
+        bind.execute(
+            keywords.update().where(keywords.c.id == sa.bindparam("keyword_id")).values(lemma=sa.bindparam("new_lemma")),
+            [{"keyword_id": row.id, "new_lemma": keyword_lemma(row.keyword)} for row in rows]
+        )
+        last_id = rows[-1].id
+
+
+def upgrade():
+    if not column_exists("keywords", "lemma"):
+        op.add_column("keywords", sa.Column("lemma", sa.String, nullable=True))
+    backfill_keyword_lemmas()
+
+    for index_name, (table_name, columns) in INDEXES.items():
+        if not index_exists(table_name, index_name):
+            op.create_index(index_name, table_name, columns)
+
+    if op.get_bind().dialect.name == "postgresql":
+        for table_name in ("qa_pairs", "keywords", "questions"):
+            op.execute(f"ANALYZE {table_name}")
+
+
+def downgrade():
+    for index_name, (table_name, _) in INDEXES.items():
+        if index_exists(table_name, index_name):
+            op.drop_index(index_name, table_name=table_name)
+    if column_exists("keywords", "lemma"):
+        with op.batch_alter_table("keywords") as batch_op:
+            batch_op.drop_column("lemma")
@@ -0,0 +1,36 @@
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import inspect
+
+
+revision = "20251228_0006"
+down_revision = "20251226_0005"
+branch_labels = None
+depends_on = None
+
+
+def column_exists(table_name, column_name):
+    bind = op.get_bind()
+    inspector = inspect(bind)
+    return column_name in [column["name"] for column in inspector.get_columns(table_name)]
+
+
+def index_exists(table_name, index_name):
+    bind = op.get_bind()
+    inspector = inspect(bind)
+    return index_name in [index["name"] for index in inspector.get_indexes(table_name)]
+
+
+def upgrade():
+    if not column_exists("qa_pairs", "slack_event_id"):
+        op.add_column("qa_pairs", sa.Column("slack_event_id", sa.String, nullable=True))
+    if not index_exists("qa_pairs", "ix_qa_pairs_slack_event_id"):
+        op.create_index("ix_qa_pairs_slack_event_id", "qa_pairs", ["slack_event_id"], unique=True)
+
+
+def downgrade():
+    if index_exists("qa_pairs", "ix_qa_pairs_slack_event_id"):
+        op.drop_index("ix_qa_pairs_slack_event_id", table_name="qa_pairs")
+    if column_exists("qa_pairs", "slack_event_id"):
+        with op.batch_alter_table("qa_pairs") as batch_op:
+            batch_op.drop_column("slack_event_id")
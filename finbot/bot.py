@@ -1,17 +1,14 @@
 import os
-import requests
 import logging
-import time
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from dotenv import load_dotenv
+from http_client import BACKEND_ASK_TIMEOUT, request_with_retry
 
 load_dotenv()
 
 SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
 SLACK_APP_TOKEN = os.getenv("SLACK_APP_TOKEN")
-SLACK_API_KEY = os.getenv("SLACK_API_KEY")
-API_URL = os.getenv("API_URL", "http://localhost:8000")
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,24 +18,6 @@ logger = logging.getLogger(__name__)
 
 app = App(token=SLACK_BOT_TOKEN)
 
-def request_with_retry(method, url, max_retries=2, **kwargs):
-    """Выполняет HTTP запрос с повторами при сетевых ошибках"""
-    for attempt in range(max_retries + 1):
-        try:
-            if method == "GET":
-                return requests.get(url, **kwargs)
-            elif method == "POST":
-                return requests.post(url, **kwargs)
-        except (requests.Timeout, requests.ConnectionError) as e:
-            if attempt < max_retries:
-                wait_time = 2 ** attempt
-                logger.warning(f"Попытка {attempt + 1} не удалась: {type(e).__name__}. Повтор через {wait_time}s...")
-                time.sleep(wait_time)
-            else:
-                logger.error(f"Все попытки исчерпаны: {e}")
-                raise
-    return None
-
 @app.message("")
 def handle_message(message, say):
     user_id = message.get("user")
@@ -47,21 +26,24 @@ def handle_message(message, say):
     if not text:
         return
 
-    headers = {"X-API-Key": SLACK_API_KEY} if SLACK_API_KEY else {}
-
     try:
         logger.info(f"Поиск ответа для вопроса от {user_id}: {text[:50]}...")
 
-        search_response = request_with_retry(
-            "GET",
-            f"{API_URL}/api/slack/search",
-            params={"query": text},
-            headers=headers,
-            timeout=5
+        # Поиск и, если ответа нет, сохранение вопроса менеджеру - один запрос
+        ask_response = request_with_retry(
+            "POST",
+            "/api/slack/ask",
+            json={
+                "question": text,
+                "slack_user": user_id,
+                # Ключ идемпотентности: повтор запроса не создаёт второй тикет
+                "event_id": message.get("client_msg_id") or f"{message.get('channel')}:{message.get('ts')}"
+            },
+            timeout=BACKEND_ASK_TIMEOUT
         )
 
-        if search_response and search_response.status_code == 200:
-            data = search_response.json()
+        if ask_response and ask_response.status_code == 200:
+            data = ask_response.json()
 
             if data.get("found") and not data.get("call_manager"):
                 answer = data.get("answer", "")
@@ -70,31 +52,13 @@ def handle_message(message, say):
                 logger.info(f"Ответ найден (confidence: {confidence}) для {user_id}")
                 say(text=message_text, thread_ts=message.get("ts"))
                 return
-            elif data.get("call_manager"):
-                logger.info(f"AI не уверен в ответе (confidence: {data.get('confidence', 0.0)}), призываем менеджера для {user_id}")
-                pass
-
-        # Ответ не найден или ошибка поиска - сохраняем вопрос
-        logger.info(f"Ответ не найден, сохраняю вопрос для {user_id}...")
-
-        save_response = request_with_retry(
-            "POST",
-            f"{API_URL}/api/slack/question",
-            json={
-                "question": text,
-                "slack_user": user_id
-            },
-            headers=headers,
-            timeout=5
-        )
 
-        if save_response and save_response.status_code == 200:
+            logger.info(f"AI не уверен в ответе (confidence: {data.get('confidence', 0.0)}), вопрос сохранён (ID: {data.get('ticket_id')}) для {user_id}")
             message_text = f"**Вопрос:** {text}\n\nПока я не могу помочь с вашим вопросом. Но я передал его финансовому менеджеру. Пожалуйста, дождитесь ответа."
-            logger.info(f"Вопрос сохранён для {user_id}")
             say(text=message_text, thread_ts=message.get("ts"))
         else:
             message_text = f"**Вопрос:** {text}\n\nВаш вопрос принят. Менеджер ответит позже."
-            logger.warning(f"Не удалось сохранить вопрос (код: {save_response.status_code if save_response else 'нет ответа'}), но отправляю нейтральное сообщение")
+            logger.warning(f"Не удалось обработать вопрос (код: {ask_response.status_code if ask_response else 'нет ответа'}), но отправляю нейтральное сообщение")
             say(text=message_text, thread_ts=message.get("ts"))
 
     except Exception as e:
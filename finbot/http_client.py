@@ -0,0 +1,85 @@
+import os
+import logging
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SLACK_API_KEY = os.getenv("SLACK_API_KEY")
+API_URL = os.getenv("API_URL", "http://localhost:8000")
+# Размер пула keep-alive соединений к backend (не меньше числа воркеров бота)
+BACKEND_POOL_SIZE = int(os.getenv("BACKEND_POOL_SIZE", "10"))
+BACKEND_TIMEOUT = float(os.getenv("BACKEND_TIMEOUT", "5"))
+# /api/slack/ask ждёт ответа агента (Gemini за rate limiter'ом) - таймаут чтения больше
+BACKEND_ASK_TIMEOUT = float(os.getenv("BACKEND_ASK_TIMEOUT", "90"))
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Общая requests.Session с пулом keep-alive соединений к backend
+    (TCP/TLS соединение переиспользуется между сообщениями и потоками)
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=BACKEND_POOL_SIZE, pool_block=True)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                if SLACK_API_KEY:
+                    session.headers["X-API-Key"] = SLACK_API_KEY
+                _session = session
+    return _session
+
+
+def request_with_retry(method, path, max_retries=2, **kwargs):
+    """
+    Запрос к backend (path относительно API_URL) с повторами при сетевых ошибках
+    Таймаут чтения для POST не повторяется: запрос мог уже выполниться на backend
+
+    Returns:
+        Response или None, если backend недоступен
+    """
+    url = f"{API_URL}{path}"
+    kwargs.setdefault("timeout", BACKEND_TIMEOUT)
+
+    for attempt in range(max_retries + 1):
+        try:
+            response = get_session().request(method, url, **kwargs)
+            logger.info(f"Запрос {method} {url} - статус: {response.status_code}")
+            if response.status_code != 200:
+                logger.warning(f"Неуспешный статус {response.status_code} для {url}. Ответ: {response.text[:200]}")
+            return response
+
+        except requests.ReadTimeout as e:
+            if method.upper() == "POST" or attempt == max_retries:
+                logger.error(f"{type(e).__name__} при запросе к {url} (попытка {attempt + 1}/{max_retries + 1}). Без повтора.")
+                return None
+            wait_time = 2 ** attempt
+            logger.warning(f"{type(e).__name__} при запросе к {url} (попытка {attempt + 1}/{max_retries + 1}). Повтор через {wait_time}s...")
+            time.sleep(wait_time)
+
+        except (requests.Timeout, requests.ConnectionError) as e:
+            error_msg = f"{type(e).__name__} при запросе к {url} (попытка {attempt + 1}/{max_retries + 1})"
+            if attempt < max_retries:
+                wait_time = 2 ** attempt
+                logger.warning(f"{error_msg}. Повтор через {wait_time}s...")
+                time.sleep(wait_time)
+            else:
+                logger.error(f"{error_msg}. Все попытки исчерпаны.")
+                return None
+
+        except Exception as e:
+            logger.error(f"Неожиданная ошибка при запросе к {url}: {type(e).__name__}: {e}")
+            return None
+
+    return None